@@ -0,0 +1,68 @@
+import json
+import sqlite3
+import threading
+import time
+
+import utils
+
+
+# on disk cache of objects looked up from pushshift and reddit while backfilling, so rerunning a day after a crash
+# doesn't have to request everything again. Entries are keyed by the api they came from, the object type, either
+# comment or submission, and the id. Ids the api didn't return are saved as known missing. Anything older than the
+# ttl is treated as not cached
+class BackfillCache:
+	def __init__(self, path, ttl_seconds=7 * 24 * 60 * 60):
+		self.path = path
+		self.ttl_seconds = ttl_seconds
+		self.lock = threading.Lock()
+		# several processes can share the file, so use write ahead logging and wait on locks instead of failing
+		self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		self.connection.execute("PRAGMA synchronous=NORMAL")
+		self.connection.execute('''
+			CREATE TABLE IF NOT EXISTS objects (
+				source TEXT NOT NULL,
+				object_type TEXT NOT NULL,
+				id TEXT NOT NULL,
+				object TEXT,
+				fetched INTEGER NOT NULL,
+				PRIMARY KEY (source, object_type, id)
+			)''')
+		self.connection.commit()
+
+	# returns the cached objects in the same order as the ids, the ids known to be missing, and the ids that aren't cached
+	def get(self, source, object_type, ids):
+		cutoff = int(time.time()) - self.ttl_seconds
+		cached = {}
+		with self.lock:
+			for chunk in utils.chunk_list(ids, 500):
+				cursor = self.connection.execute(
+					f"SELECT id, object FROM objects WHERE source = ? AND object_type = ? AND fetched >= ? AND id IN ({','.join('?' * len(chunk))})",
+					(source, object_type, cutoff, *chunk))
+				for str_id, object_string in cursor:
+					cached[str_id] = object_string
+
+		objects = []
+		missing_ids = []
+		uncached_ids = []
+		for str_id in ids:
+			if str_id not in cached:
+				uncached_ids.append(str_id)
+			elif cached[str_id] is None:
+				missing_ids.append(str_id)
+			else:
+				objects.append(json.loads(cached[str_id]))
+		return objects, missing_ids, uncached_ids
+
+	# objects_by_id should only contain the objects as the api returned them, before they're modified by the merge
+	def put(self, source, object_type, objects_by_id, missing_ids):
+		fetched = int(time.time())
+		rows = [(source, object_type, str_id, json.dumps(obj), fetched) for str_id, obj in objects_by_id.items()]
+		rows.extend((source, object_type, str_id, None, fetched) for str_id in missing_ids)
+		with self.lock:
+			self.connection.executemany("INSERT OR REPLACE INTO objects (source, object_type, id, object, fetched) VALUES (?, ?, ?, ?, ?)", rows)
+			self.connection.commit()
+
+	def close(self):
+		with self.lock:
+			self.connection.close()
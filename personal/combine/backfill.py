@@ -0,0 +1,255 @@
+import asyncio
+import functools
+import multiprocessing
+import sys
+import threading
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+import discord_logging
+from praw import endpoints
+import prawcore
+
+log = discord_logging.get_logger()
+
+import utils
+from merge import ObjectType
+
+
+PUSHSHIFT_URL = "https://api.pushshift.io"
+PUSHSHIFT_CHUNK_SIZE = 50
+REDDIT_CHUNK_SIZE = 100
+# requests per second
+PUSHSHIFT_RATE = 10
+REDDIT_RATE = 1.5
+
+
+# rate limiter shared by every request to one api. Refills `rate` tokens a second, up to `capacity`. This uses a
+# thread lock instead of an asyncio one so the same bucket keeps working across the event loop of each backfill
+class TokenBucket:
+	def __init__(self, rate, capacity=None):
+		self.rate = rate
+		self.capacity = capacity if capacity is not None else max(rate, 1)
+		self.tokens = self.capacity
+		self.last_refill = time.monotonic()
+		self.lock = threading.Lock()
+
+	# take a token, returning how long the caller has to wait before it can be used
+	def reserve(self):
+		with self.lock:
+			now = time.monotonic()
+			self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+			self.last_refill = now
+			self.tokens -= 1
+			if self.tokens >= 0:
+				return 0
+			return -self.tokens / self.rate
+
+	async def acquire(self):
+		wait_seconds = self.reserve()
+		if wait_seconds > 0:
+			await asyncio.sleep(wait_seconds)
+
+
+# the same rate limiter, but shared by several processes so running more of them doesn't multiply the rate. The tokens
+# and the time of the last refill are kept in shared memory behind a process lock. Like other shared memory, it has to
+# be handed to the processes when they start, through the pool initializer
+class SharedTokenBucket(TokenBucket):
+	def __init__(self, rate, capacity=None):
+		self.rate = rate
+		self.capacity = capacity if capacity is not None else max(rate, 1)
+		self.state = multiprocessing.RawArray('d', [self.capacity, time.time()])
+		self.lock = multiprocessing.Lock()
+
+	def reserve(self):
+		with self.lock:
+			now = time.time()
+			tokens = min(self.capacity, self.state[0] + max(now - self.state[1], 0) * self.rate) - 1
+			self.state[0] = tokens
+			self.state[1] = now
+			if tokens >= 0:
+				return 0
+			return -tokens / self.rate
+
+
+# looks up lists of missing ids in pushshift and reddit at the same time. The http calls are blocking, so they run in
+# a thread pool sharing one pooled session, and the event loop just bounds how many are in flight at once.
+# praw isn't thread safe, so reddit calls through a praw instance get their own single thread. If reddit is None,
+# reddit_url is queried directly instead, which is mostly useful to point both apis at a local stand-in server. If
+# several processes backfill at once, pass in SharedTokenBucket buckets so they share the rate limits
+class BackfillClient:
+	def __init__(
+			self, reddit, pushshift_token_function, concurrency=8, pushshift_rate=PUSHSHIFT_RATE, reddit_rate=REDDIT_RATE,
+			pushshift_url=PUSHSHIFT_URL, reddit_url=None, sleep_per_attempt=10, cache=None, pushshift_bucket=None, reddit_bucket=None
+	):
+		self.reddit = reddit
+		self.cache = cache
+		self.pushshift_token_function = pushshift_token_function
+		self.pushshift_token = None
+		self.concurrency = concurrency
+		self.pushshift_url = pushshift_url
+		self.reddit_url = reddit_url
+		self.sleep_per_attempt = sleep_per_attempt
+		self.pushshift_bucket = pushshift_bucket if pushshift_bucket is not None else TokenBucket(pushshift_rate)
+		self.reddit_bucket = reddit_bucket if reddit_bucket is not None else TokenBucket(reddit_rate)
+
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=2, pool_maxsize=concurrency)
+		self.session.mount("http://", adapter)
+		self.session.mount("https://", adapter)
+		self.executor = ThreadPoolExecutor(max_workers=concurrency)
+		self.reddit_executor = ThreadPoolExecutor(max_workers=1)
+		self.token_lock = None
+
+	def get_pushshift_token(self):
+		if self.pushshift_token is None:
+			self.pushshift_token = self.pushshift_token_function(None)
+		return self.pushshift_token
+
+	async def run_blocking(self, executor, function, *args, **kwargs):
+		return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(function, *args, **kwargs))
+
+	# several requests will usually fail with the same expired token at once, only the first one re-auths
+	async def refresh_pushshift_token(self, bearer):
+		async with self.token_lock:
+			if self.pushshift_token == bearer:
+				self.pushshift_token = await self.run_blocking(self.executor, self.pushshift_token_function, bearer)
+		return self.pushshift_token
+
+	async def query_pushshift(self, ids, object_type, semaphore):
+		object_name = "comment" if object_type == ObjectType.COMMENT else "submission"
+		url = f"{self.pushshift_url}/reddit/{object_name}/search?limit=1000&ids={','.join(ids)}"
+		log.debug(f"pushshift query: {url}")
+		bearer = self.get_pushshift_token()
+		response = None
+		total_attempts = 100
+		current_attempt = 0
+		async with semaphore:
+			for current_attempt in range(total_attempts):
+				await self.pushshift_bucket.acquire()
+				try:
+					response = await self.run_blocking(
+						self.executor, self.session.get, url, headers={
+							'User-Agent': "In script by /u/Watchful1",
+							'Authorization': f"Bearer {bearer}"}, timeout=20)
+				except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as err:
+					log.info(f"Pushshift failed, sleeping {current_attempt * self.sleep_per_attempt} : {err}")
+					await asyncio.sleep(current_attempt * self.sleep_per_attempt)
+					continue
+				if response.status_code == 200:
+					break
+				if response.status_code == 403:
+					log.warning(f"Pushshift 403, trying reauth: {response.text}")
+					log.warning(url)
+					log.warning(f"'Authorization': Bearer {bearer}")
+					bearer = await self.refresh_pushshift_token(bearer)
+				log.info(f"Pushshift failed, sleeping {current_attempt * self.sleep_per_attempt} : status {response.status_code}")
+				await asyncio.sleep(current_attempt * self.sleep_per_attempt)
+		if response is None:
+			log.warning(f"{current_attempt + 1} requests failed with no response")
+			log.warning(url)
+			log.warning(f"'Authorization': Bearer {bearer}")
+			discord_logging.flush_discord()
+			sys.exit(1)
+		if response.status_code != 200:
+			log.warning(f"{current_attempt + 1} requests failed with status code {response.status_code}")
+			log.warning(url)
+			log.warning(f"'Authorization': Bearer {bearer}")
+			discord_logging.flush_discord()
+			sys.exit(1)
+		if current_attempt > 0:
+			log.info(f"Pushshift call succeeded after {current_attempt + 1} retries")
+		return response.json()['data']
+
+	def request_reddit(self, id_string):
+		if self.reddit is not None:
+			return self.reddit.request(method="GET", path=endpoints.API_PATH["info"], params={"id": id_string})
+		response = self.session.get(
+			f"{self.reddit_url}/api/info.json", params={"id": id_string}, headers={'User-Agent': "In script by /u/Watchful1"}, timeout=20)
+		if response.status_code != 200:
+			raise prawcore.exceptions.ServerError(response)
+		return response.json()
+
+	async def query_reddit(self, ids, object_type, semaphore):
+		id_prefix = 't1_' if object_type == ObjectType.COMMENT else 't3_'
+		id_string = ",".join(utils.fullnames(ids, id_prefix))
+		executor = self.reddit_executor if self.reddit is not None else self.executor
+		response = None
+		async with semaphore:
+			for i in range(20):
+				await self.reddit_bucket.acquire()
+				try:
+					response = await self.run_blocking(executor, self.request_reddit, id_string)
+					break
+				except (
+						prawcore.exceptions.ServerError, prawcore.exceptions.RequestException, prawcore.exceptions.TooManyRequests,
+						requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as err:
+					log.info(f"No response from reddit api for {object_type}, sleeping {i * 5} seconds: {err} : {id_string}")
+					await asyncio.sleep(i * 5)
+		if response is None:
+			log.warning("Reddit api failed, aborting")
+			return None
+		return response['data']['children']
+
+	# returns the pushshift and reddit results for the ids, each in the same order the sequential chunks would have been.
+	# Ids that are in the cache, either as an object or as known missing, aren't requested again
+	async def backfill_async(self, ids, object_type):
+		# asyncio primitives are tied to the loop that first uses them, so make new ones for each run
+		self.token_lock = asyncio.Lock()
+		pushshift_semaphore = asyncio.Semaphore(self.concurrency)
+		reddit_semaphore = asyncio.Semaphore(self.concurrency)
+		type_name = "comment" if object_type == ObjectType.COMMENT else "submission"
+
+		pushshift_ids, reddit_ids = ids, ids
+		if self.cache is not None:
+			pushshift_cached, pushshift_known_missing, pushshift_ids = self.cache.get("pushshift", type_name, ids)
+			reddit_cached, reddit_known_missing, reddit_ids = self.cache.get("reddit", type_name, ids)
+			log.debug(
+				f"Cache has {len(pushshift_cached)}/{len(pushshift_known_missing)} pushshift and "
+				f"{len(reddit_cached)}/{len(reddit_known_missing)} reddit objects/missing of {len(ids)} ids")
+
+		pushshift_tasks = [self.query_pushshift(chunk, object_type, pushshift_semaphore) for chunk in utils.chunk_list(pushshift_ids, PUSHSHIFT_CHUNK_SIZE)]
+		reddit_tasks = [self.query_reddit(chunk, object_type, reddit_semaphore) for chunk in utils.chunk_list(reddit_ids, REDDIT_CHUNK_SIZE)]
+		results = await asyncio.gather(*pushshift_tasks, *reddit_tasks)
+
+		pushshift_by_id = {}
+		for result in results[:len(pushshift_tasks)]:
+			for obj in result:
+				pushshift_by_id[obj['id']] = obj
+		reddit_by_id = {}
+		reddit_failed = False
+		for result in results[len(pushshift_tasks):]:
+			if result is None:
+				reddit_failed = True
+				continue
+			for obj in result:
+				reddit_by_id[obj['data']['id']] = obj
+
+		if self.cache is not None:
+			self.cache.put("pushshift", type_name, pushshift_by_id, [str_id for str_id in pushshift_ids if str_id not in pushshift_by_id])
+			# a failed reddit call doesn't mean the ids are missing, so only save what was actually returned
+			current_timestamp = int(datetime.utcnow().timestamp())
+			for obj in reddit_by_id.values():
+				obj['data'].setdefault('retrieved_on', current_timestamp)
+			self.cache.put("reddit", type_name, reddit_by_id, [] if reddit_failed else [str_id for str_id in reddit_ids if str_id not in reddit_by_id])
+
+			for obj in pushshift_cached:
+				pushshift_by_id[obj['id']] = obj
+			for obj in reddit_cached:
+				reddit_by_id[obj['data']['id']] = obj
+
+		pushshift_objects = [pushshift_by_id[str_id] for str_id in ids if str_id in pushshift_by_id]
+		reddit_objects = [reddit_by_id[str_id] for str_id in ids if str_id in reddit_by_id]
+		return pushshift_objects, reddit_objects
+
+	def backfill(self, ids, object_type):
+		if not len(ids):
+			return [], []
+		return asyncio.run(self.backfill_async(ids, object_type))
+
+	def close(self):
+		self.executor.shutdown()
+		self.reddit_executor.shutdown()
+		self.session.close()
@@ -4,6 +4,8 @@ import discord_logging
 import sys
 import zstandard
 import json
+import queue
+import threading
 from enum import Enum
 from sortedcontainers import SortedList
 from collections import defaultdict
@@ -76,7 +78,7 @@ class ApiRequest:
 		log.debug(f"Set result: {self}")
 
 	def id_string(self):
-		return f"{self.get_prefix()}{(f',{self.get_prefix()}'.join(self.ids))}"
+		return ",".join(utils.fullnames(self.ids, self.get_prefix()))
 
 	def __str__(self):
 		return \
@@ -180,6 +182,72 @@ class OutputHandle:
 			self.handle.close()
 
 
+# reads and decodes each minute's ingest files on a background thread, so the next minutes are ready by the time
+# the main loop finishes backfilling the current window
+class MinuteReader(threading.Thread):
+	def __init__(self, file_minutes, max_pending):
+		super().__init__(daemon=True)
+		self.file_minutes = file_minutes
+		self.queue = queue.Queue(max_pending)
+
+	def run(self):
+		try:
+			for minute, ingest_files in self.file_minutes.items():
+				minute_objects = []
+				for ingest_file, ingest_type in ingest_files:
+					for obj in utils.read_obj_zst(ingest_file):
+						minute_objects.append((obj, ingest_type))
+				self.queue.put((minute, minute_objects))
+		except Exception as err:
+			self.queue.put((None, err))
+
+	def next_minute(self):
+		minute, minute_objects = self.queue.get()
+		if minute is None:
+			raise minute_objects
+		return minute, minute_objects
+
+
+# serializes and compresses finished minutes on a background thread while the main loop moves on to the next window
+class MinuteWriter(threading.Thread):
+	def __init__(self, max_pending):
+		super().__init__(daemon=True)
+		self.queue = queue.Queue(max_pending)
+		self.error = None
+
+	def run(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				break
+			if self.error is not None:
+				continue
+			output_path, minute_objects, log_string = item
+			try:
+				# the file is closed even if a write fails, since the error only comes out the next time write is called
+				with open(output_path, 'wb') as output_file:
+					output_handle = zstandard.ZstdCompressor().stream_writer(output_file)
+					for obj in minute_objects:
+						output_handle.write(json.dumps(obj, sort_keys=True).encode('utf-8'))
+						output_handle.write(NEWLINE_ENCODED)
+					output_handle.close()
+				log.info(log_string)
+			except Exception as err:
+				self.error = err
+
+	def write(self, output_path, minute_objects, log_string):
+		if self.error is not None:
+			raise self.error
+		self.queue.put((output_path, minute_objects, log_string))
+
+	# wait for every queued minute to be written
+	def finish(self):
+		self.queue.put(None)
+		self.join()
+		if self.error is not None:
+			raise self.error
+
+
 class IngestType(Enum):
 	INGEST = 1
 	RESCAN = 2
@@ -261,19 +329,25 @@ class ObjectDict:
 			return [], None, None
 		missing_ids = []
 		count_ignored_ids = 0
-		for int_id in range(start_id, end_id + 1):
-			ignored = False
-			for ignore_start, ignore_end in ignore_ids:
-				if ignore_start <= int_id <= ignore_end:
-					count_ignored_ids += 1
-					ignored = True
-					break
-			if ignored:
-				continue
-
-			string_id = utils.base36encode(int_id)
-			if not self.contains_id(string_id):
-				missing_ids.append(string_id)
+		# split the range into the stretches between ignored ranges, then encode each stretch in bulk
+		ranges = [(start_id, end_id)]
+		for ignore_start, ignore_end in ignore_ids:
+			split_ranges = []
+			for range_start, range_end in ranges:
+				if ignore_end < range_start or ignore_start > range_end:
+					split_ranges.append((range_start, range_end))
+					continue
+				count_ignored_ids += min(ignore_end, range_end) - max(ignore_start, range_start) + 1
+				if range_start < ignore_start:
+					split_ranges.append((range_start, ignore_start - 1))
+				if ignore_end < range_end:
+					split_ranges.append((ignore_end + 1, range_end))
+			ranges = split_ranges
+
+		for range_start, range_end in sorted(ranges):
+			for string_id in utils.base36encode_range(range_start, range_end):
+				if string_id not in self.by_id:
+					missing_ids.append(string_id)
 		if count_ignored_ids > 0:
 			log.warning(f"Ignored {count_ignored_ids} ids in range {utils.base36encode(start_id)}-{utils.base36encode(end_id)}")
 		return missing_ids, start_id, end_id
@@ -5,12 +5,8 @@ import discord_logging
 import argparse
 import os
 import re
-import zstandard
 from datetime import datetime, timedelta
-import json
 import praw
-from praw import endpoints
-import prawcore
 import logging.handlers
 
 sys.path.append('personal')
@@ -18,13 +14,18 @@ sys.path.append('personal')
 log = discord_logging.get_logger(init=True)
 
 import utils
+import backfill_cache
 import classes
+import backfill
 from classes import IngestType
 from merge import ObjectType
 
 
 NEWLINE_ENCODED = "\n".encode('utf-8')
 reg = re.compile(r"\d\d-\d\d-\d\d_\d\d-\d\d")
+# how many minutes the reader thread can decode ahead of the merge, and how many finished minutes can wait to be written
+PREFETCH_MINUTES = 15
+PENDING_WRITE_MINUTES = 15
 
 
 def get_pushshift_token(old_token):
@@ -78,79 +79,19 @@ def re_auth_pushshift(old_token):
 		sys.exit(1)
 
 
-def query_pushshift(ids, bearer, object_type, pushshift_token_function):
-	object_name = "comment" if object_type == ObjectType.COMMENT else "submission"
-	url = f"https://api.pushshift.io/reddit/{object_name}/search?limit=1000&ids={','.join(ids)}"
-	log.debug(f"pushshift query: {url}")
-	response = None
-	total_attempts = 100
-	current_attempt = 0
-	sleep_per_attempt = 10
-	for current_attempt in range(total_attempts):
-		try:
-			response = requests.get(url, headers={
-				'User-Agent': "In script by /u/Watchful1",
-				'Authorization': f"Bearer {bearer}"}, timeout=20)
-		except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as err:
-			log.info(f"Pushshift failed, sleeping {current_attempt * sleep_per_attempt} : {err}")
-			time.sleep(current_attempt * sleep_per_attempt)
-			continue
-		if response is None:
-			log.info(f"Pushshift failed, sleeping {current_attempt * sleep_per_attempt} : no response")
-			time.sleep(current_attempt * sleep_per_attempt)
-			continue
-		if response.status_code == 200:
-			break
-		if response.status_code == 403:
-			log.warning(f"Pushshift 403, trying reauth: {response.json()}")
-			log.warning(url)
-			log.warning(f"'Authorization': Bearer {bearer}")
-			bearer = pushshift_token_function(bearer)
-		log.info(f"Pushshift failed, sleeping {current_attempt * sleep_per_attempt} : status {response.status_code}")
-		time.sleep(current_attempt * sleep_per_attempt)
-	if response is None:
-		log.warning(f"{current_attempt + 1} requests failed with no response")
-		log.warning(url)
-		log.warning(f"'Authorization': Bearer {bearer}")
-		discord_logging.flush_discord()
-		sys.exit(1)
-	if response.status_code != 200:
-		log.warning(f"{current_attempt + 1} requests failed with status code {response.status_code}")
-		log.warning(url)
-		log.warning(f"'Authorization': Bearer {bearer}")
-		discord_logging.flush_discord()
-		sys.exit(1)
-	if current_attempt > 0:
-		log.info(f"Pushshift call succeeded after {current_attempt + 1} retries")
-	return response.json()['data'], bearer
-
-
-def query_reddit(ids, reddit, object_type):
-	id_prefix = 't1_' if object_type == ObjectType.COMMENT else 't3_'
-	id_string = f"{id_prefix}{(f',{id_prefix}'.join(ids))}"
-	response = None
-	for i in range(20):
-		try:
-			response = reddit.request(method="GET", path=endpoints.API_PATH["info"], params={"id": id_string})
-			break
-		except (prawcore.exceptions.ServerError, prawcore.exceptions.RequestException, prawcore.exceptions.TooManyRequests) as err:
-			log.info(f"No response from reddit api for {object_type}, sleeping {i * 5} seconds: {err} : {id_string}")
-			time.sleep(i * 5)
-	if response is None:
-		log.warning(f"Reddit api failed, aborting")
-		return []
-	return response['data']['children']
-
-
 def end_of_day(input_minute):
 	return input_minute.replace(hour=0, minute=0, second=0) + timedelta(days=1)
 
 
-def build_day(day_to_process, input_folders, output_folder, object_type, reddit, ignore_ids, pushshift_token_function):
+def build_day(
+		day_to_process, input_folders, output_folder, object_type, reddit, ignore_ids, pushshift_token_function, backfill_concurrency=8, cache=None,
+		pushshift_bucket=None, reddit_bucket=None
+):
 	file_type = "comments" if object_type == ObjectType.COMMENT else "submissions"
 
-	pushshift_token = pushshift_token_function(None)
-	log.info(f"{file_type}: Using pushshift token: {pushshift_token}")
+	backfill_client = backfill.BackfillClient(
+		reddit, pushshift_token_function, concurrency=backfill_concurrency, cache=cache, pushshift_bucket=pushshift_bucket, reddit_bucket=reddit_bucket)
+	log.info(f"{file_type}: Using pushshift token: {backfill_client.get_pushshift_token()}")
 
 	file_minutes = {}
 	minute_iterator = day_to_process - timedelta(minutes=2)
@@ -176,11 +117,15 @@ def build_day(day_to_process, input_folders, output_folder, object_type, reddit,
 	minute_iterator = day_to_process - timedelta(minutes=2)
 	working_lowest_minute = day_to_process
 	last_minute_of_day = end_of_day(day_to_process) - timedelta(minutes=1)
+	minute_reader = classes.MinuteReader(file_minutes, PREFETCH_MINUTES)
+	minute_reader.start()
+	minute_writer = classes.MinuteWriter(PENDING_WRITE_MINUTES)
+	minute_writer.start()
 	while minute_iterator <= end_time:
-		for ingest_file, ingest_type in file_minutes[minute_iterator]:
-			for obj in utils.read_obj_zst(ingest_file):
-				if objects.add_object(obj, ingest_type):
-					unmatched_field = True
+		_, minute_objects = minute_reader.next_minute()
+		for obj, ingest_type in minute_objects:
+			if objects.add_object(obj, ingest_type):
+				unmatched_field = True
 		log.info(f"{file_type}: Loaded {minute_iterator.strftime('%y-%m-%d_%H-%M')} : {objects.get_counts_string_by_minute(minute_iterator, [IngestType.INGEST, IngestType.RESCAN, IngestType.DOWNLOAD])}")
 
 		if minute_iterator >= end_time or objects.count_minutes() >= 11:
@@ -197,17 +142,14 @@ def build_day(day_to_process, input_folders, output_folder, object_type, reddit,
 				f"{file_type}: Backfilling from: {working_lowest_minute.strftime('%y-%m-%d_%H-%M')} ({utils.base36encode(start_id)}|{start_id}) to "
 				f"{working_highest_minute.strftime('%y-%m-%d_%H-%M')} ({utils.base36encode(end_id)}|{end_id}) with {len(missing_ids)} ({end_id - start_id}) ids")
 
-			for chunk in utils.chunk_list(missing_ids, 50):
-				pushshift_objects, pushshift_token = query_pushshift(chunk, pushshift_token, object_type, pushshift_token_function)
-				for pushshift_object in pushshift_objects:
-					if objects.add_object(pushshift_object, IngestType.PUSHSHIFT):
-						unmatched_field = True
+			pushshift_objects, reddit_objects = backfill_client.backfill(missing_ids, object_type)
+			for pushshift_object in pushshift_objects:
+				if objects.add_object(pushshift_object, IngestType.PUSHSHIFT):
+					unmatched_field = True
 
-			for chunk in utils.chunk_list(missing_ids, 100):
-				reddit_objects = query_reddit(chunk, reddit, object_type)
-				for reddit_object in reddit_objects:
-					if objects.add_object(reddit_object['data'], IngestType.BACKFILL):
-						unmatched_field = True
+			for reddit_object in reddit_objects:
+				if objects.add_object(reddit_object['data'], IngestType.BACKFILL):
+					unmatched_field = True
 
 			for missing_id in missing_ids:
 				if missing_id not in objects.by_id:
@@ -219,35 +161,37 @@ def build_day(day_to_process, input_folders, output_folder, object_type, reddit,
 				if not os.path.exists(folder):
 					os.makedirs(folder)
 				output_path = os.path.join(folder, f"{('RC' if object_type == ObjectType.COMMENT else 'RS')}_{working_lowest_minute.strftime('%y-%m-%d_%H-%M')}.zst")
-				output_handle = zstandard.ZstdCompressor().stream_writer(open(output_path, 'wb'))
 
-				for obj in objects.by_minute[working_lowest_minute].obj_list:
-					output_handle.write(json.dumps(obj, sort_keys=True).encode('utf-8'))
-					output_handle.write(NEWLINE_ENCODED)
+				minute_objects = list(objects.by_minute[working_lowest_minute].obj_list)
+				for obj in minute_objects:
 					objects.delete_object_id(obj['id'])
-				log.info(
+				minute_writer.write(
+					output_path,
+					minute_objects,
 					f"{file_type}: Wrote up to {working_lowest_minute.strftime('%y-%m-%d_%H-%M')} : "
 					f"{objects.get_counts_string_by_minute(working_lowest_minute, [IngestType.PUSHSHIFT, IngestType.BACKFILL, IngestType.MISSING])}")
-				output_handle.close()
 				working_lowest_minute += timedelta(minutes=1)
 
 			objects.rebuild_minute_dict()
 
 		discord_logging.flush_discord()
 		if unmatched_field:
+			minute_writer.finish()
 			log.warning(f"{file_type}: Unmatched field, aborting")
 			discord_logging.flush_discord()
 			sys.exit(1)
 
 		minute_iterator += timedelta(minutes=1)
 
+	minute_writer.finish()
+	backfill_client.close()
 	log.info(f"{file_type}: Finished day {day_to_process.strftime('%y-%m-%d')}: {objects.get_counts_string()}")
 
 
-def merge_and_backfill(start_date, end_date, input_folders, output_folder, object_type, ignore_ids, reddit_username, pushshift_token_function):
+def merge_and_backfill(start_date, end_date, input_folders, output_folder, object_type, ignore_ids, reddit_username, pushshift_token_function, backfill_concurrency=8, cache=None):
 	reddit = praw.Reddit(reddit_username)
 	while start_date <= end_date:
-		build_day(start_date, input_folders, output_folder, object_type, reddit, ignore_ids, pushshift_token_function)
+		build_day(start_date, input_folders, output_folder, object_type, reddit, ignore_ids, pushshift_token_function, backfill_concurrency, cache)
 		start_date = end_of_day(start_date)
 
 
@@ -261,6 +205,9 @@ if __name__ == "__main__":
 	parser.add_argument('--pushshift', help='The pushshift token')
 	parser.add_argument("--debug", help="Enable debug logging", action='store_const', const=True, default=False)
 	parser.add_argument("--ignore_ids", help="Ignore ids between the id ranges listed", default=None)
+	parser.add_argument("--concurrency", help="How many backfill requests to each api can be in flight at once", default=8, type=int)
+	parser.add_argument("--cache", help="Sqlite file to cache backfill lookups in. Set to an empty string to disable", default="backfill_cache.db")
+	parser.add_argument("--cache_hours", help="How many hours cached lookups are used for", default=7 * 24, type=int)
 	args = parser.parse_args()
 
 	if args.debug:
@@ -316,5 +263,7 @@ if __name__ == "__main__":
 		object_type,
 		ignore_ids,
 		"Watchful12",
-		get_pushshift_token
+		get_pushshift_token,
+		args.concurrency,
+		backfill_cache.BackfillCache(args.cache, args.cache_hours * 60 * 60) if args.cache else None
 	)
@@ -59,6 +59,7 @@ class FileConfig:
 		self.new_compressed_size = new_compressed_size
 
 		self.total_lines = total_lines
+		self.index = None
 
 	def __str__(self):
 		return f"{self.input_path} : {self.output_path} : {self.complete} : {self.old_compressed_size} - {self.uncompressed_size} - {self.new_compressed_size}"
@@ -143,13 +144,40 @@ def load_file_list(status_json):
 		return None, None, None
 
 
-# base of each separate process. Loads a file, iterates through lines and writes out
-# the ones where the `field` of the object matches `value`. Also passes status
-# information back to the parent via a queue
-def process_file(file, queue, threads, level):
-	queue.put(file)
+# how often the parent logs progress
+PROGRESS_SECONDS = 5
+
+# the sizes of every completed file are kept in a shared array, with a slot of these fields for each file. Each worker
+# only writes to the slot of the file it's working on and the parent only reads, so there's no need for a lock
+COUNTER_FIELDS = 4
+OLD_BYTES, UNCOMPRESSED_BYTES, NEW_BYTES, TOTAL_LINES = range(COUNTER_FIELDS)
+shared_counters = None
+
+
+# runs at the start of each worker process to keep a reference to the shared counters
+def init_worker(counters):
+	global shared_counters
+	shared_counters = counters
+
+
+def update_counters(counters, file):
+	offset = file.index * COUNTER_FIELDS
+	if file.complete:
+		counters[offset + OLD_BYTES] = file.old_compressed_size
+		counters[offset + UNCOMPRESSED_BYTES] = file.uncompressed_size if file.uncompressed_size is not None else 0
+		counters[offset + NEW_BYTES] = file.new_compressed_size if file.new_compressed_size is not None else 0
+		counters[offset + TOTAL_LINES] = file.total_lines if file.total_lines is not None else 0
+
+
+def sum_counter(counters, field):
+	return sum(counters[field::COUNTER_FIELDS])
+
+
+# base of each separate process. Recompresses a file and returns it to the parent with the sizes filled in, which
+# also go into the shared counters. Takes a single tuple so it can be used with imap_unordered
+def process_file(arguments):
+	file, threads, level = arguments
 	file.total_lines, file.uncompressed_size = count_lines_bytes(file.input_path)
-	queue.put(file)
 
 	try:
 		decompressor = zstandard.ZstdDecompressor(max_window_size=2**31)
@@ -161,7 +189,8 @@ def process_file(file, queue, threads, level):
 	except Exception as err:
 		file.error_message = str(err)
 	#log.info(f"{read_count:,} to {write_count:,} in {seconds:,.2f} with {threads} threads")
-	queue.put(file)
+	update_counters(shared_counters, file)
+	return file
 
 
 if __name__ == '__main__':
@@ -185,7 +214,6 @@ if __name__ == '__main__':
 	log.info(f"Writing output to: {args.output}")
 
 	multiprocessing.set_start_method('spawn')
-	queue = multiprocessing.Manager().Queue()
 	status_json = os.path.join(args.working, "status.json")
 	input_files, saved_arg_string, saved_type = load_file_list(status_json)
 	if saved_arg_string and saved_arg_string != arg_string:
@@ -211,6 +239,10 @@ if __name__ == '__main__':
 
 	files_processed, total_old_bytes, processed_old_bytes, processed_uncompressed_bytes, processed_new_bytes, processed_lines = 0, 0, 0, 0, 0, 0
 	files_to_process = []
+	counters = multiprocessing.Array('q', len(input_files) * COUNTER_FIELDS, lock=False)
+	for i, file in enumerate(input_files):
+		file.index = i
+		update_counters(counters, file)
 	# calculate the total file size for progress reports, build a list of incomplete files to process
 	# do this largest to smallest by file size so that we aren't processing a few really big files with only a few threads at the end
 	for file in sorted(input_files, key=lambda item: item.old_compressed_size, reverse=True):
@@ -231,48 +263,44 @@ if __name__ == '__main__':
 		progress_queue = Queue(40)
 		progress_queue.put([start_time, processed_old_bytes])
 		speed_queue = Queue(40)
+		files_errored = 0
+		last_log_time = start_time
 		# start the workers
-		with multiprocessing.Pool(processes=min(args.processes, len(files_to_process))) as pool:
-			workers = pool.starmap_async(process_file, [(file, queue, args.threads, args.level) for file in files_to_process], chunksize=1, error_callback=log.info)
-			while not workers.ready() or not queue.empty():
-				# loop until the workers are all done, pulling in status messages as they are sent
-				file_update = queue.get()
-				if file_update.error_message is not None:
-					log.warning(f"File failed {file_update.input_path}: {file_update.error_message}")
-
-				# this is the workers telling us they are starting a new file, print the debug message but nothing else
-				if not file_update.complete:
-					if file_update.uncompressed_size is not None:
-						log.debug(f"Calculated uncompressed size: {file_update.input_path} : {file_update.uncompressed_size:,}")
+		with multiprocessing.Pool(processes=min(args.processes, len(files_to_process)), initializer=init_worker, initargs=(counters,)) as pool:
+			workers = pool.imap_unordered(process_file, [(file, args.threads, args.level) for file in files_to_process])
+			files_remaining = len(files_to_process)
+			while files_remaining > 0:
+				# loop until the workers are all done. Finished files come back from the pool, the sizes are read from the counters
+				try:
+					file_update = workers.next(timeout=PROGRESS_SECONDS)
+					files_remaining -= 1
+					input_files[file_update.index] = file_update
+					if file_update.error_message is not None:
+						log.warning(f"File failed {file_update.input_path}: {file_update.error_message}")
+						files_errored += 1
 					else:
-						log.debug(f"Starting file: {file_update.input_path} : {file_update.old_compressed_size:,}")
-					continue
-
-				# I'm going to assume that the list of files is short enough that it's no
-				# big deal to just iterate each time since that saves a bunch of work
-				files_processed, processed_old_bytes, processed_uncompressed_bytes, processed_new_bytes, processed_lines, files_errored, i = 0, 0, 0, 0, 0, 0, 0
-				for file in input_files:
-					if file.input_path == file_update.input_path:
-						input_files[i] = file_update
-						file = file_update
-					if file.complete:
-						processed_old_bytes += file.old_compressed_size
-						processed_uncompressed_bytes += file.uncompressed_size if file.uncompressed_size is not None else 0
-						processed_new_bytes += file.new_compressed_size if file.new_compressed_size is not None else 0
-						processed_lines += file.total_lines if file.total_lines is not None else 0
-					files_processed += 1 if file.complete or file.error_message is not None else 0
-					files_errored += 1 if file.error_message is not None else 0
-					i += 1
-				if file_update.complete or file_update.error_message is not None:
+						log.debug(f"Finished file: {file_update.input_path}")
+					files_processed += 1
 					save_file_list(input_files, args.working, status_json, arg_string, script_type)
-					log.debug(f"Finished file: {file_update.input_path}")
+				except multiprocessing.TimeoutError:
+					pass
+
 				current_time = time.time()
+				if current_time - last_log_time < PROGRESS_SECONDS and files_remaining > 0:
+					continue
+				last_log_time = current_time
+				processed_old_bytes = sum_counter(counters, OLD_BYTES)
+				processed_uncompressed_bytes = sum_counter(counters, UNCOMPRESSED_BYTES)
+				processed_new_bytes = sum_counter(counters, NEW_BYTES)
+				processed_lines = sum_counter(counters, TOTAL_LINES)
+				if processed_old_bytes == 0:
+					continue
 				progress_queue.put([current_time, processed_old_bytes])
 
 				first_time, first_bytes = progress_queue.peek()
 				bytes_per_second = int((processed_old_bytes - first_bytes)/(current_time - first_time))
 				speed_queue.put(bytes_per_second)
-				seconds_left = int((total_old_bytes - processed_old_bytes) / int(sum(speed_queue.list) / len(speed_queue.list)))
+				seconds_left = int((total_old_bytes - processed_old_bytes) / max(int(sum(speed_queue.list) / len(speed_queue.list)), 1))
 				minutes_left = int(seconds_left / 60)
 				hours_left = int(minutes_left / 60)
 				days_left = int(hours_left / 24)
@@ -0,0 +1,81 @@
+import utils
+import discord_logging
+import zstandard
+import argparse
+import time
+import os
+
+log = discord_logging.init_logging()
+
+
+# decompress the whole file without doing anything with the lines, so the time is only the reading and decompressing
+def decompress_file(file_name, read_ahead_depth, use_mmap):
+	uncompressed_bytes = 0
+	with utils.open_input(file_name, read_ahead_depth, use_mmap) as file_handle:
+		reader = zstandard.ZstdDecompressor(max_window_size=2**31).stream_reader(file_handle)
+		while True:
+			chunk = reader.read(2**27)
+			if not chunk:
+				break
+			uncompressed_bytes += len(chunk)
+		reader.close()
+	return uncompressed_bytes
+
+
+def count_objects(file_name, read_ahead_depth, use_mmap):
+	count = 0
+	for obj in utils.read_obj_zst(file_name, read_ahead_depth, use_mmap):
+		count += 1
+	return count
+
+
+def count_blocks_rows(file_name, use_mmap):
+	count = 0
+	for obj in utils.read_obj_zst_blocks(file_name, use_mmap):
+		count += 1
+	return count
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Time reading a zst or zst_blocks file with a regular file handle, read ahead and memory mapping")
+	parser.add_argument("input", help="The file to read")
+	parser.add_argument("--runs", help="How many times to read the file with each reader. The fastest run is kept", default=3, type=int)
+	parser.add_argument("--read_ahead", help="How many reads to keep running in the background for the read ahead reader", default=4, type=int)
+	parser.add_argument("--parse", help="Also parse the json of every line, instead of only decompressing", action="store_true")
+	args = parser.parse_args()
+
+	file_size = os.stat(args.input).st_size
+	if args.input.endswith(".zst_blocks"):
+		readers = {
+			"buffered": lambda: count_blocks_rows(args.input, False),
+			"mmap": lambda: count_blocks_rows(args.input, True),
+		}
+	elif args.parse:
+		readers = {
+			"buffered": lambda: count_objects(args.input, 0, False),
+			"read ahead": lambda: count_objects(args.input, args.read_ahead, False),
+			"mmap": lambda: count_objects(args.input, 0, True),
+		}
+	else:
+		readers = {
+			"buffered": lambda: decompress_file(args.input, 0, False),
+			"read ahead": lambda: decompress_file(args.input, args.read_ahead, False),
+			"mmap": lambda: decompress_file(args.input, 0, True),
+		}
+
+	# the first read of the file fills the os cache, so take turns between the readers and keep the best run of each
+	log.info(f"Reading {args.input} : {file_size / (2**20):,.0f} mb, {args.runs} runs of each reader")
+	best_seconds = {}
+	results = {}
+	for run in range(args.runs):
+		for name, reader in readers.items():
+			start_time = time.perf_counter()
+			results[name] = reader()
+			seconds = time.perf_counter() - start_time
+			log.info(f"Run {run + 1} : {name} : {seconds:.2f} seconds : {(file_size / (2**20)) / seconds:,.0f} mb/s")
+			if name not in best_seconds or seconds < best_seconds[name]:
+				best_seconds[name] = seconds
+
+	buffered_seconds = best_seconds["buffered"]
+	for name, seconds in best_seconds.items():
+		log.info(f"{name} : {results[name]:,} : {seconds:.2f} seconds : {(file_size / (2**20)) / seconds:,.0f} mb/s : {buffered_seconds / seconds:.2f}x buffered")
@@ -5,6 +5,8 @@ import sys
 from datetime import datetime
 import logging.handlers
 from collections import defaultdict
+sys.path.append('personal')
+import utils
 
 
 log = logging.getLogger("bot")
@@ -54,17 +56,29 @@ if __name__ == "__main__":
 				total_size += file_size
 				input_files.append([input_path, file_size])
 
+	# counting every value of every field exactly runs out of memory on fields like author or id. If this is set, the
+	# number of different values and the most common ones are estimated in a fixed amount of memory for each field instead
+	use_sketches = False
+
 	log.info(f"Processing {len(input_files)} files of {(total_size / (2**30)):.2f} gigabytes")
 
 	total_lines = 0
 	fields = defaultdict(lambda: defaultdict(int))
+	field_occurrences = defaultdict(int)
+	field_distinct = defaultdict(utils.HyperLogLog)
+	field_top = defaultdict(lambda: utils.SpaceSaving(100))
 	for input_file in input_files:
 		file_lines = 0
 		created = None
 		for obj in read_lines_zst(input_file[0]):
 			for key, value in obj.items():
 				value = str(value)[:20]
-				fields[key][value] += 1
+				if use_sketches:
+					field_occurrences[key] += 1
+					field_distinct[key].add(value)
+					field_top[key].add(value)
+				else:
+					fields[key][value] += 1
 
 			created = datetime.utcfromtimestamp(int(obj['created_utc']))
 			file_lines += 1
@@ -76,6 +90,10 @@ if __name__ == "__main__":
 		log.info(f"{created.strftime('%Y-%m-%d %H:%M:%S')} : {file_lines + total_lines:,}")
 
 	sorted_fields = []
+	for key, total_occurrences in field_occurrences.items():
+		unique_values = field_distinct[key].count()
+		examples = [value_name for value_name, count, error in field_top[key].top(3)]
+		sorted_fields.append((total_occurrences, f"{key}: {(total_occurrences / total_lines) * 100:.2f} : ~{unique_values:,} : {','.join(examples)}"))
 	for key, values in fields.items():
 		total_occurrences = 0
 		unique_values = 0
@@ -5,10 +5,13 @@ import sys
 import time
 import argparse
 import re
+import heapq
 from collections import defaultdict
 from datetime import datetime
 import logging.handlers
 import multiprocessing
+sys.path.append('personal')
+import utils
 
 
 # sets up logging to the console as well as a file
@@ -39,6 +42,7 @@ class FileConfig:
 		self.lines_processed = lines_processed if complete else 0
 		self.error_message = None
 		self.error_lines = error_lines
+		self.index = None
 
 	def __str__(self):
 		return f"{self.input_path} : {self.output_path} : {self.file_size} : {self.complete} : {self.bytes_processed} : {self.lines_processed}"
@@ -124,11 +128,100 @@ def read_lines_zst(file_name):
 		reader.close()
 
 
-# base of each separate process. Loads a file, iterates through lines and writes out
-# the ones where the `field` of the object matches `value`. Also passes status
-# information back to the parent via a queue
-def process_file(file, queue, field):
-	output_file = None
+# how often the workers update their progress counters, and how often the parent logs them
+PROGRESS_LINES = 100000
+PROGRESS_SECONDS = 5
+
+# the progress of every file is kept in a shared array, with a slot of these fields for each file. Each worker only
+# writes to the slot of the file it's working on and the parent only reads, so there's no need for a lock
+COUNTER_FIELDS = 3
+LINES_PROCESSED, BYTES_PROCESSED, ERROR_LINES = range(COUNTER_FIELDS)
+shared_counters = None
+
+
+# runs at the start of each worker process to keep a reference to the shared counters
+def init_worker(counters):
+	global shared_counters
+	shared_counters = counters
+
+
+def update_counters(counters, file):
+	offset = file.index * COUNTER_FIELDS
+	counters[offset + LINES_PROCESSED] = file.lines_processed
+	counters[offset + BYTES_PROCESSED] = file.bytes_processed
+	counters[offset + ERROR_LINES] = file.error_lines
+
+
+def sum_counter(counters, field):
+	return sum(counters[field::COUNTER_FIELDS])
+
+
+# count files have a value and its count on each line, separated by a tab, sorted by the value so they can be merged
+# without reading them all into memory. Backslashes, tabs and newlines in the value are escaped so a value like a title
+# stays on one line, and lone surrogates from json are written as is so one odd value doesn't fail the whole file
+COUNT_FILE_ESCAPES = {"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"}
+COUNT_FILE_UNESCAPES = {"\\": "\\", "t": "\t", "n": "\n", "r": "\r"}
+count_file_escape_regex = re.compile(r"[\\\t\n\r]")
+count_file_unescape_regex = re.compile(r"\\(.)")
+
+
+def write_count_line(output_handle, value, count):
+	output_handle.write(f"{count_file_escape_regex.sub(lambda match: COUNT_FILE_ESCAPES[match.group()], value)}\t{count}\n")
+
+
+def write_count_file(path, counts):
+	with open(path, 'w', encoding="utf-8", errors="surrogatepass") as output_handle:
+		for value, count in sorted(counts.items()):
+			write_count_line(output_handle, value, count)
+
+
+def read_count_file(path):
+	with open(path, 'r', encoding="utf-8", errors="surrogatepass") as input_handle:
+		for line in input_handle:
+			try:
+				value, count = line.rstrip("\n").rsplit("\t", 1)
+				count = int(count)
+			except ValueError:
+				log.info(f"Line failed in file {path}: {line}")
+				continue
+			yield count_file_unescape_regex.sub(lambda match: COUNT_FILE_UNESCAPES.get(match.group(1), match.group(1)), value), count
+
+
+# k-way merge of sorted count files, adding up the counts for each value. Only one line from each file is in memory
+# at a time, and the values come out in sorted order
+def merge_count_files(paths):
+	current_value = None
+	current_count = 0
+	for value, count in heapq.merge(*[read_count_file(path) for path in paths]):
+		if value != current_value:
+			if current_value is not None:
+				yield current_value, current_count
+			current_value = value
+			current_count = 0
+		current_count += count
+	if current_value is not None:
+		yield current_value, current_count
+
+
+# in sketch mode each file saves its sketches next to where its count file would go
+def get_sketch_path(file):
+	return f"{file.count_file_path}_sketch.json"
+
+
+# base of each separate process. Loads a file, iterates through lines and counts how many times each value of `field`
+# shows up. The counts are kept in memory, but if there are more than max_values different values they're written out
+# to a sorted file and cleared, then those files are merged at the end. The finished counts are written to the count
+# file for the month. In sketch mode nothing is counted exactly, instead the number of different values is estimated
+# with a hyperloglog and the most common values with a space saving summary, both in a fixed amount of memory, and
+# saved for the parent to merge. Progress goes into the shared counters and the finished file is returned to the
+# parent. Takes a single tuple so it can be used with imap_unordered
+def process_file(arguments):
+	file, field, max_values, sketch, top_size = arguments
+	counts = defaultdict(int)
+	spill_paths = []
+	if sketch:
+		distinct_sketch = utils.HyperLogLog()
+		top_sketch = utils.SpaceSaving(top_size)
 	try:
 		for line, file_bytes_processed in read_lines_zst(file.input_path):
 			try:
@@ -136,25 +229,45 @@ def process_file(file, queue, field):
 				observed = obj[field].lower()
 				if observed is None or observed == "":
 					continue
-				if output_file is None:
-					output_file = open(file.output_path, 'w', encoding="utf-8")
-				output_file.write(observed)
-				output_file.write("\n")
+				if sketch:
+					distinct_sketch.add(observed)
+					top_sketch.add(observed)
+				else:
+					counts[observed] += 1
+					if len(counts) >= max_values:
+						spill_path = f"{file.output_path}_{len(spill_paths)}.txt"
+						write_count_file(spill_path, counts)
+						spill_paths.append(spill_path)
+						counts = defaultdict(int)
 			except (KeyError, json.JSONDecodeError) as err:
 				file.error_lines += 1
 			file.lines_processed += 1
-			if file.lines_processed % 1000000 == 0:
+			if file.lines_processed % PROGRESS_LINES == 0:
 				file.bytes_processed = file_bytes_processed
-				queue.put(file)
+				update_counters(shared_counters, file)
 
-		if output_file is not None:
-			output_file.close()
+		if sketch:
+			with open(get_sketch_path(file), 'w', encoding="utf-8") as sketch_handle:
+				json.dump({"distinct": distinct_sketch.to_dict(), "top": top_sketch.to_dict()}, sketch_handle)
+		elif not spill_paths:
+			write_count_file(file.count_file_path, counts)
+		else:
+			spill_path = f"{file.output_path}_{len(spill_paths)}.txt"
+			write_count_file(spill_path, counts)
+			spill_paths.append(spill_path)
+			counts = None
+			with open(file.count_file_path, 'w', encoding="utf-8", errors="surrogatepass") as output_handle:
+				for value, count in merge_count_files(spill_paths):
+					write_count_line(output_handle, value, count)
+			for spill_path in spill_paths:
+				os.remove(spill_path)
 
 		file.complete = True
 		file.bytes_processed = file.file_size
 	except Exception as err:
 		file.error_message = str(err)
-	queue.put(file)
+	update_counters(shared_counters, file)
+	return file
 
 
 if __name__ == '__main__':
@@ -166,6 +279,20 @@ if __name__ == '__main__':
 	parser.add_argument("--field", help="Which field to count", default="subreddit")
 	parser.add_argument("--min_count", help="Dont write any counts below this number", default=1000, type=int)
 	parser.add_argument("--processes", help="Number of processes to use", default=10, type=int)
+	parser.add_argument(
+		"--max_values",
+		help="The most different values each process counts in memory at once. Past this they're written to a sorted file in the working "
+		"folder and merged at the end of the input file. Lower this if memory runs out counting a field like author",
+		default=5000000, type=int)
+	parser.add_argument(
+		"--sketch",
+		help="Estimate instead of counting exactly, in a fixed amount of memory. Writes the approximate number of different values for "
+		"each file and in total to {output}_distinct.txt and the approximate counts of the most common values to {output}_top.txt",
+		action="store_true")
+	parser.add_argument(
+		"--top_size",
+		help="How many of the most common values to keep track of in sketch mode. The counts are more accurate the more are kept",
+		default=10000, type=int)
 	parser.add_argument("--file_filter", help="Regex filenames have to match to be processed", default="^rc_|rs_")
 	parser.add_argument(
 		"--error_rate", help=
@@ -186,7 +313,6 @@ if __name__ == '__main__':
 		log.info(f"Writing output to working folder")
 
 	multiprocessing.set_start_method('spawn')
-	queue = multiprocessing.Manager().Queue()
 	status_json = os.path.join(args.working, "status.json")
 	input_files, saved_type, stage = load_file_list(status_json)
 
@@ -194,6 +320,11 @@ if __name__ == '__main__':
 		log.warning(f"Script type doesn't match type from json file. Delete working folder")
 		sys.exit(0)
 
+	# older versions of the script had a "sum" stage that re-read text intermediate files, which this one can't resume from
+	if stage not in ("count", "agg"):
+		log.warning(f"Stage {stage} from json file is from an older version of this script. Delete working folder")
+		sys.exit(0)
+
 	if stage == "count":
 		# if the file list wasn't loaded from the json, this is the first run, find what files we need to process
 		if input_files is None:
@@ -204,7 +335,8 @@ if __name__ == '__main__':
 					if file_name.endswith(".zst") and re.search(args.file_filter, file_name, re.IGNORECASE) is not None:
 						input_path = os.path.join(subdir, file_name)
 						output_path = os.path.join(args.working, file_name[:-4])
-						input_files.append(FileConfig(input_path, output_path=output_path))
+						count_file_path = os.path.join(args.monthly_count_folder, file_name[:-4])
+						input_files.append(FileConfig(input_path, output_path=output_path, count_file_path=count_file_path))
 
 			save_file_list(input_files, args.working, status_json, script_type, "count")
 		else:
@@ -216,6 +348,10 @@ if __name__ == '__main__':
 		total_lines_processed = 0
 		total_lines_errored = 0
 		files_to_process = []
+		counters = multiprocessing.Array('q', len(input_files) * COUNTER_FIELDS, lock=False)
+		for i, file in enumerate(input_files):
+			file.index = i
+			update_counters(counters, file)
 		# calculate the total file size for progress reports, build a list of incomplete files to process
 		# do this largest to smallest by file size so that we aren't processing a few really big files with only a few threads at the end
 		for file in sorted(input_files, key=lambda item: item.file_size, reverse=True):
@@ -229,6 +365,8 @@ if __name__ == '__main__':
 				files_to_process.append(file)
 
 		log.info(f"Processed {files_processed} of {len(input_files)} files with {(total_bytes_processed / (2**30)):.2f} of {(total_bytes / (2**30)):.2f} gigabytes")
+		if not os.path.exists(args.monthly_count_folder):
+			os.makedirs(args.monthly_count_folder)
 
 		start_time = time.time()
 		if len(files_to_process):
@@ -237,41 +375,40 @@ if __name__ == '__main__':
 			speed_queue = Queue(40)
 			for file in files_to_process:
 				log.info(f"Processing file: {file.input_path}")
+			files_errored = 0
+			last_log_time = start_time
 			# start the workers
-			with multiprocessing.Pool(processes=min(args.processes, len(files_to_process))) as pool:
-				workers = pool.starmap_async(process_file, [(file, queue, args.field) for file in files_to_process], chunksize=1, error_callback=log.info)
-				while not workers.ready() or not queue.empty():
-					# loop until the workers are all done, pulling in status messages as they are sent
-					file_update = queue.get()
-					if file_update.error_message is not None:
-						log.warning(f"File failed {file_update.input_path}: {file_update.error_message}")
-					# I'm going to assume that the list of files is short enough that it's no
-					# big deal to just iterate each time since that saves a bunch of work
-					total_lines_processed = 0
-					total_bytes_processed = 0
-					total_lines_errored = 0
-					files_processed = 0
-					files_errored = 0
-					i = 0
-					for file in input_files:
-						if file.input_path == file_update.input_path:
-							input_files[i] = file_update
-							file = file_update
-						total_lines_processed += file.lines_processed
-						total_bytes_processed += file.bytes_processed
-						total_lines_errored += file.error_lines
-						files_processed += 1 if file.complete or file.error_message is not None else 0
-						files_errored += 1 if file.error_message is not None else 0
-						i += 1
-					if file_update.complete or file_update.error_message is not None:
+			with multiprocessing.Pool(processes=min(args.processes, len(files_to_process)), initializer=init_worker, initargs=(counters,)) as pool:
+				workers = pool.imap_unordered(
+					process_file, [(file, args.field, args.max_values, args.sketch, args.top_size) for file in files_to_process])
+				files_remaining = len(files_to_process)
+				while files_remaining > 0:
+					# loop until the workers are all done. Finished files come back from the pool, everything else is read from the counters
+					try:
+						file_update = workers.next(timeout=PROGRESS_SECONDS)
+						files_remaining -= 1
+						input_files[file_update.index] = file_update
+						if file_update.error_message is not None:
+							log.warning(f"File failed {file_update.input_path}: {file_update.error_message}")
+							files_errored += 1
+						files_processed += 1
 						save_file_list(input_files, args.working, status_json, script_type, stage)
+					except multiprocessing.TimeoutError:
+						pass
+
 					current_time = time.time()
+					if current_time - last_log_time < PROGRESS_SECONDS:
+						continue
+					last_log_time = current_time
+					total_lines_processed = sum_counter(counters, LINES_PROCESSED)
+					total_bytes_processed = sum_counter(counters, BYTES_PROCESSED)
+					total_lines_errored = sum_counter(counters, ERROR_LINES)
 					progress_queue.put([current_time, total_lines_processed, total_bytes_processed])
 
 					first_time, first_lines, first_bytes = progress_queue.peek()
 					bytes_per_second = int((total_bytes_processed - first_bytes)/(current_time - first_time))
 					speed_queue.put(bytes_per_second)
-					seconds_left = int((total_bytes - total_bytes_processed) / int(sum(speed_queue.list) / len(speed_queue.list)))
+					seconds_left = int((total_bytes - total_bytes_processed) / max(int(sum(speed_queue.list) / len(speed_queue.list)), 1))
 					minutes_left = int(seconds_left / 60)
 					hours_left = int(minutes_left / 60)
 					days_left = int(hours_left / 24)
@@ -282,15 +419,17 @@ if __name__ == '__main__':
 						f"{files_processed}({files_errored})/{len(input_files)} files : "
 						f"{(str(days_left) + 'd ' if days_left > 0 else '')}{hours_left - (days_left * 24)}:{minutes_left - (hours_left * 60):02}:{seconds_left - (minutes_left * 60):02} remaining")
 
+			total_lines_processed = sum_counter(counters, LINES_PROCESSED)
+			total_bytes_processed = sum_counter(counters, BYTES_PROCESSED)
+			total_lines_errored = sum_counter(counters, ERROR_LINES)
+
 		log.info(f"{total_lines_processed:,}, {total_lines_errored} errored : {(total_bytes_processed / (2**30)):.2f} gb, {(total_bytes_processed / total_bytes) * 100:.0f}% : {files_processed}/{len(input_files)}")
-		stage = "sum"
+		stage = "agg"
 		save_file_list(input_files, args.working, status_json, script_type, stage)
 
-	if stage == "sum":
-		#working_file_paths = []
+	if stage == "agg":
 		count_incomplete = 0
-		# build a list of output files to combine
-		input_files = sorted(input_files, key=lambda item: os.path.split(item.output_path)[1])
+		count_file_paths = []
 		for file in input_files:
 			if not file.complete:
 				if file.error_message is not None:
@@ -304,58 +443,49 @@ if __name__ == '__main__':
 						f"File {file.input_path} has {file.error_lines:,} errored lines out of {file.lines_processed:,}, "
 						f"{(file.error_lines / file.lines_processed) * (args.error_rate * 0.01):.2f}% which is above the limit of {args.error_rate}%")
 					count_incomplete += 1
+				else:
+					count_file_paths.append(file.count_file_path)
 
 		if count_incomplete > 0:
 			log.info(f"{count_incomplete} files were not completed, errored or don't exist, something went wrong. Aborting")
 			sys.exit()
 
-		log.info(f"Processing complete, combining {len(input_files)} result files")
-
-		if not os.path.exists(args.monthly_count_folder):
-			os.makedirs(args.monthly_count_folder)
-		input_lines = 0
-		files_counted = 0
-		monthly_count_folder_paths = []
-		for file in input_files:
-			files_counted += 1
-			if not os.path.exists(file.output_path):
-				log.info(f"Output file {file.output_path} does not exist, skipping")
-				continue
-			monthly_counts = defaultdict(int)
-			log.info(f"Reading {files_counted}/{len(input_files)} : {input_lines:,} : {os.path.split(file.output_path)[1]}")
-			with open(file.output_path, 'r') as input_file:
-				for line in input_file:
-					input_lines += 1
-					monthly_counts[line.strip()] += 1
-
-			file.count_file_path = os.path.join(args.monthly_count_folder, os.path.basename(file.output_path))
-			with open(file.count_file_path, 'w') as output_handle:
-				for field, count in sorted(monthly_counts.items(), key=lambda item: item[1], reverse=True):
-					output_handle.write(f"{field}	{count}\n")
-
-		log.info(f"Finished combining files into monthlies, {input_lines:,} lines read. Combining into result output")
-		stage = "agg"
-		save_file_list(input_files, args.working, status_json, script_type, stage)
-
-	if stage == "agg":
-		field_counts = defaultdict(int)
-		for file in input_files:
-			with open(file.count_file_path, 'r') as input_handle:
-				for line in input_handle:
-					try:
-						field, count = line.strip().split("\t")
-						field_counts[field] += int(count)
-					except Exception as err:
-						log.info(f"Line failed in file {file.count_file_path}: {line}")
-						continue
+		if args.sketch:
+			log.info(f"Processing complete, merging {len(input_files)} sketches")
+			distinct_sketch = utils.HyperLogLog()
+			top_sketch = utils.SpaceSaving(args.top_size)
+			with open(f"{args.output}_distinct.txt", 'w', encoding="utf-8") as output_handle:
+				for file in input_files:
+					with open(get_sketch_path(file), 'r', encoding="utf-8") as sketch_handle:
+						sketch_dict = json.load(sketch_handle)
+					file_distinct_sketch = utils.HyperLogLog.from_dict(sketch_dict["distinct"])
+					output_handle.write(f"{os.path.basename(file.count_file_path)}	{file_distinct_sketch.count()}\n")
+					distinct_sketch.merge(file_distinct_sketch)
+					top_sketch.merge(utils.SpaceSaving.from_dict(sketch_dict["top"]))
+				output_handle.write(f"total	{distinct_sketch.count()}\n")
+
+			# the error is how much higher than the real count the count could be
+			with open(f"{args.output}_top.txt", 'w', encoding="utf-8") as output_handle:
+				for field, count, error in top_sketch.top():
+					output_handle.write(f"{field}	{count}	{error}\n")
+
+			log.info(f"Finished merging sketches, about {distinct_sketch.count():,} different values, top {len(top_sketch.counts):,} written")
+			sys.exit()
 
-		sorted_counts = sorted(field_counts.items(), key=lambda item: item[1], reverse=True)
+		# the monthly count files are sorted by value, so they can all be merged at once and only the values above the
+		# minimum count have to be kept in memory to sort by count
+		log.info(f"Processing complete, merging {len(count_file_paths)} monthly count files")
+		field_counts = []
+		values_merged = 0
+		for field, count in merge_count_files(count_file_paths):
+			values_merged += 1
+			if count >= args.min_count:
+				field_counts.append((field, count))
 
 		output_counts = 0
-		with open(f"{args.output}.txt", 'w') as output_handle:
-			for field, count in sorted_counts:
-				if count >= args.min_count:
-					output_counts += 1
-					output_handle.write(f"{field}	{count}\n")
+		with open(f"{args.output}.txt", 'w', encoding="utf-8", errors="surrogatepass") as output_handle:
+			for field, count in sorted(field_counts, key=lambda item: item[1], reverse=True):
+				output_counts += 1
+				write_count_line(output_handle, field, count)
 
-		log.info(f"Finished combining files, {output_counts:,} field counts written")
+		log.info(f"Finished combining files, {output_counts:,} of {values_merged:,} field counts written")
@@ -38,6 +38,7 @@ class FileConfig:
 		self.lines_processed = lines_processed if complete else 0
 		self.error_message = None
 		self.error_lines = error_lines
+		self.index = None
 
 	def __str__(self):
 		return f"{self.input_path} : {self.output_path} : {self.file_size} : {self.complete} : {self.bytes_processed} : {self.lines_processed}"
@@ -118,7 +119,35 @@ def read_lines_zst(file_name):
 		reader.close()
 
 
-def process_file(file, queue):
+# how often the workers update their progress counters, and how often the parent logs them
+PROGRESS_LINES = 100000
+PROGRESS_SECONDS = 5
+
+# the progress of every file is kept in a shared array, with a slot of these fields for each file. Each worker only
+# writes to the slot of the file it's working on and the parent only reads, so there's no need for a lock
+COUNTER_FIELDS = 3
+LINES_PROCESSED, BYTES_PROCESSED, ERROR_LINES = range(COUNTER_FIELDS)
+shared_counters = None
+
+
+# runs at the start of each worker process to keep a reference to the shared counters
+def init_worker(counters):
+	global shared_counters
+	shared_counters = counters
+
+
+def update_counters(counters, file):
+	offset = file.index * COUNTER_FIELDS
+	counters[offset + LINES_PROCESSED] = file.lines_processed
+	counters[offset + BYTES_PROCESSED] = file.bytes_processed
+	counters[offset + ERROR_LINES] = file.error_lines
+
+
+def sum_counter(counters, field):
+	return sum(counters[field::COUNTER_FIELDS])
+
+
+def process_file(file):
 	try:
 		for line, file_bytes_processed in read_lines_zst(file.input_path):
 			try:
@@ -128,60 +157,16 @@ def process_file(file, queue):
 			except (KeyError, json.JSONDecodeError) as err:
 				file.error_lines += 1
 			file.lines_processed += 1
-			if file.lines_processed % 1000000 == 0:
+			if file.lines_processed % PROGRESS_LINES == 0:
 				file.bytes_processed = file_bytes_processed
-				queue.put(file)
+				update_counters(shared_counters, file)
 
 		file.complete = True
 		file.bytes_processed = file.file_size
 	except Exception as err:
 		file.error_message = str(err)
-	queue.put(file)
-
-
-def process_update(input_files, queue, last_log_time, force_write):
-	file_update = queue.get()
-	if file_update.error_message is not None:
-		log.warning(f"File failed {file_update.input_path}: {file_update.error_message}")
-	current_time = time.time()
-
-	input_files[file_update.input_path] = file_update
-	if force_write or last_log_time is None or (current_time - last_log_time) > 5 or queue.empty():
-		total_lines_processed = 0
-		total_bytes_processed = 0
-		total_lines_errored = 0
-		files_processed = 0
-		files_errored = 0
-		i = 0
-		for file in input_files.values():
-			total_lines_processed += file.lines_processed
-			total_bytes_processed += file.bytes_processed
-			total_lines_errored += file.error_lines
-			files_processed += 1 if file.complete or file.error_message is not None else 0
-			files_errored += 1 if file.error_message is not None else 0
-			i += 1
-		if file_update.complete or file_update.error_message is not None:
-			save_file_list(input_files, status_json, script_type)
-		progress_queue.put([current_time, total_lines_processed, total_bytes_processed])
-
-		first_time, first_lines, first_bytes = progress_queue.peek()
-		bytes_per_second = int((total_bytes_processed - first_bytes)/(current_time - first_time))
-		speed_queue.put(bytes_per_second)
-		seconds_left = int((total_bytes - total_bytes_processed) / int(sum(speed_queue.list) / len(speed_queue.list)))
-		minutes_left = int(seconds_left / 60)
-		hours_left = int(minutes_left / 60)
-		days_left = int(hours_left / 24)
-
-		log.info(
-			f"{total_lines_processed:,} lines at {(total_lines_processed - first_lines)/(current_time - first_time):,.0f}/s, {total_lines_errored:,} errored : "
-			f"{(total_bytes_processed / (2**30)):.2f} gb at {(bytes_per_second / (2**20)):,.0f} mb/s, {(total_bytes_processed / total_bytes) * 100:.0f}% : "
-			f"{files_processed}({files_errored})/{len(input_files)} files : "
-			f"{(str(days_left) + 'd ' if days_left > 0 else '')}{hours_left - (days_left * 24)}:{minutes_left - (hours_left * 60):02}:{seconds_left - (minutes_left * 60):02} remaining : "
-			f"{queue.qsize()} files in queue : {current_time} : {last_log_time} : {current_time - last_log_time if last_log_time is not None else 0} : "
-			f"{(current_time - last_log_time) > 5 if last_log_time is not None else 0} : {int(current_time - last_log_time) > 5 if last_log_time is not None else 0} : "
-			f"{last_log_time is None or (current_time - last_log_time) > 5 or queue.empty()} : {queue.empty()}")
-		last_log_time = time.time()
-	return last_log_time
+	update_counters(shared_counters, file)
+	return file
 
 
 if __name__ == '__main__':
@@ -199,7 +184,6 @@ if __name__ == '__main__':
 	log.info(f"Loading files from: {args.input}")
 
 	multiprocessing.set_start_method('spawn')
-	queue = multiprocessing.Manager().Queue()
 	status_json = "status.json"
 	input_files, saved_type = load_file_list(status_json)
 
@@ -227,6 +211,10 @@ if __name__ == '__main__':
 	total_lines_processed = 0
 	total_lines_errored = 0
 	files_to_process = []
+	counters = multiprocessing.Array('q', len(input_files) * COUNTER_FIELDS, lock=False)
+	for i, file in enumerate(input_files.values()):
+		file.index = i
+		update_counters(counters, file)
 	# calculate the total file size for progress reports, build a list of incomplete files to process
 	# do this largest to smallest by file size so that we aren't processing a few really big files with only a few threads at the end
 	for file in sorted(input_files.values(), key=lambda item: item.file_size, reverse=True):
@@ -242,22 +230,54 @@ if __name__ == '__main__':
 	log.info(f"Processed {files_processed} of {len(input_files)} files with {(total_bytes_processed / (2**30)):.2f} of {(total_bytes / (2**30)):.2f} gigabytes")
 
 	start_time = time.time()
-	last_log_time = None
 	if len(files_to_process):
 		progress_queue = Queue(40)
 		progress_queue.put([start_time, total_lines_processed, total_bytes_processed])
 		speed_queue = Queue(40)
 		for file in files_to_process:
 			log.debug(f"Processing file: {file.input_path}")
+		files_errored = 0
+		last_log_time = start_time
 		# start the workers
-		with multiprocessing.Pool(processes=min(args.processes, len(files_to_process))) as pool:
-			workers = pool.starmap_async(process_file, [(file, queue) for file in files_to_process], chunksize=1, error_callback=log.info)
-			while not workers.ready():
-				# loop until the workers are all done, pulling in status messages as they are sent
-				last_log_time = process_update(input_files, queue, last_log_time, False)
-
-			while not queue.empty():
-
+		with multiprocessing.Pool(processes=min(args.processes, len(files_to_process)), initializer=init_worker, initargs=(counters,)) as pool:
+			workers = pool.imap_unordered(process_file, files_to_process)
+			files_remaining = len(files_to_process)
+			while files_remaining > 0:
+				# loop until the workers are all done. Finished files come back from the pool, everything else is read from the counters
+				try:
+					file_update = workers.next(timeout=PROGRESS_SECONDS)
+					files_remaining -= 1
+					input_files[file_update.input_path] = file_update
+					if file_update.error_message is not None:
+						log.warning(f"File failed {file_update.input_path}: {file_update.error_message}")
+						files_errored += 1
+					files_processed += 1
+					save_file_list(input_files, status_json, script_type)
+				except multiprocessing.TimeoutError:
+					pass
+
+				current_time = time.time()
+				if current_time - last_log_time < PROGRESS_SECONDS and files_remaining > 0:
+					continue
+				last_log_time = current_time
+				total_lines_processed = sum_counter(counters, LINES_PROCESSED)
+				total_bytes_processed = sum_counter(counters, BYTES_PROCESSED)
+				total_lines_errored = sum_counter(counters, ERROR_LINES)
+				progress_queue.put([current_time, total_lines_processed, total_bytes_processed])
+
+				first_time, first_lines, first_bytes = progress_queue.peek()
+				bytes_per_second = int((total_bytes_processed - first_bytes)/(current_time - first_time))
+				speed_queue.put(bytes_per_second)
+				seconds_left = int((total_bytes - total_bytes_processed) / max(int(sum(speed_queue.list) / len(speed_queue.list)), 1))
+				minutes_left = int(seconds_left / 60)
+				hours_left = int(minutes_left / 60)
+				days_left = int(hours_left / 24)
+
+				log.info(
+					f"{total_lines_processed:,} lines at {(total_lines_processed - first_lines)/(current_time - first_time):,.0f}/s, {total_lines_errored:,} errored : "
+					f"{(total_bytes_processed / (2**30)):.2f} gb at {(bytes_per_second / (2**20)):,.0f} mb/s, {(total_bytes_processed / total_bytes) * 100:.0f}% : "
+					f"{files_processed}({files_errored})/{len(input_files)} files : "
+					f"{(str(days_left) + 'd ' if days_left > 0 else '')}{hours_left - (days_left * 24)}:{minutes_left - (hours_left * 60):02}:{seconds_left - (minutes_left * 60):02} remaining")
 
 	log.info(f"{total_lines_processed:,}, {total_lines_errored} errored : {(total_bytes_processed / (2**30)):.2f} gb, {(total_bytes_processed / total_bytes) * 100:.0f}% : {files_processed}/{len(input_files)}")
 
@@ -25,6 +25,8 @@ discord_logging.init_discord_logging(
 multiprocessing_logging.install_mp_handler(log)
 
 import utils
+import backfill_cache
+import backfill
 from transform import split_blocks_by_minutes
 from combine.merge_and_backfill import build_day, IngestType, ObjectType
 from combine import build_month
@@ -32,21 +34,20 @@ from combine import build_month
 
 def get_pushshift_token(old_token):
 	global pushshift_lock
-	pushshift_lock.acquire()
-	saved_token = load_pushshift_token()
-	if saved_token is None or saved_token == "" or old_token == saved_token:
-		if old_token is None:
-			log.warning("No saved or passed in token")
-			save_pushshift_token("")
-			raise ValueError("No saved or passed in token")
-
-		log.info(f"Requesting new token")
-		result_token = re_auth_pushshift(old_token)
-		save_pushshift_token(result_token)
-	else:
-		result_token = saved_token
+	with pushshift_lock:
+		saved_token = load_pushshift_token()
+		if saved_token is None or saved_token == "" or old_token == saved_token:
+			if old_token is None:
+				log.warning("No saved or passed in token")
+				save_pushshift_token("")
+				raise ValueError("No saved or passed in token")
+
+			log.info(f"Requesting new token")
+			result_token = re_auth_pushshift(old_token)
+			save_pushshift_token(result_token)
+		else:
+			result_token = saved_token
 
-	pushshift_lock.release()
 	return result_token
 
 
@@ -91,9 +92,32 @@ def re_auth_pushshift(old_token):
 		return old_token
 
 
-def init(p_lock):
-	global pushshift_lock
+# the rate limit buckets are shared by all the processes, so the apis see the same request rate however many days are
+# merged at once
+def init(p_lock, p_cache_path, p_cache_hours, p_pushshift_bucket, p_reddit_bucket):
+	global pushshift_lock, reddit, cache, cache_path, cache_hours, pushshift_bucket, reddit_bucket
 	pushshift_lock = p_lock
+	pushshift_bucket = p_pushshift_bucket
+	reddit_bucket = p_reddit_bucket
+	reddit = None
+	cache = None
+	cache_path = p_cache_path
+	cache_hours = p_cache_hours
+
+
+# each worker process keeps its own reddit instance for all the days it merges
+def get_reddit(reddit_username):
+	global reddit
+	if reddit is None:
+		reddit = praw.Reddit(reddit_username)
+	return reddit
+
+
+def get_cache():
+	global cache
+	if cache is None and cache_path:
+		cache = backfill_cache.BackfillCache(cache_path, cache_hours * 60 * 60)
+	return cache
 
 
 def save_status(status_json, stages, month):
@@ -112,19 +136,23 @@ def load_status(status_json):
 		with open(status_json, 'r') as status_json_file:
 			output_dict = json.load(status_json_file)
 			for stage_type, stage in output_dict["stages"].items():
-				if stage["merge"] is not None:
-					stage["merge"] = datetime.strptime(stage["merge"], "%Y-%m-%d %H:%M:%S")
+				if stage["merge"] is None:
+					stage["merge"] = []
+				elif isinstance(stage["merge"], str):
+					# older status files saved the day the merge had reached instead of the list of merged days
+					merged_up_to = datetime.strptime(stage["merge"], "%Y-%m-%d %H:%M:%S")
+					stage["merge"] = [day.strftime("%y-%m-%d") for day in get_days(output_dict["month"]) if day < merged_up_to]
 			return output_dict["stages"], output_dict["month"]
 	else:
 		stages = {
 			"comment": {
 				"split": False,
-				"merge": None,  # 24-02-01
+				"merge": [],  # 24-02-01, 24-02-02
 				"build": False,
 			},
 			"submission": {
 				"split": False,
-				"merge": None,  # 24-02-01
+				"merge": [],  # 24-02-01, 24-02-02
 				"build": False,
 			}
 		}
@@ -135,106 +163,127 @@ def end_of_day(input_minute):
 	return input_minute.replace(hour=0, minute=0, second=0) + timedelta(days=1)
 
 
-def process(queue, base_folder, month, file_type, type_stages, reddit_username, compression_level, ignore_ids):
+def get_days(month):
+	start_date = datetime.strptime(month, "%y-%m")
+	if start_date.month == 12:
+		end_date = start_date.replace(year=start_date.year + 1, month=1)
+	else:
+		end_date = start_date.replace(month=start_date.month + 1)
+	days = []
+	while start_date < end_date:
+		days.append(start_date)
+		start_date = end_of_day(start_date)
+	return days
+
+
+def report_error(queue, file_type, stage, err):
+	log.warning(f"Error in {file_type} {stage}: {err}")
+	log.warning(traceback.format_exc())
+	queue.put((file_type, "error", str(err)))
+	discord_logging.flush_discord()
+
+
+# every task puts exactly one message in the queue when it finishes, either its stage result or an error. build_day
+# calls sys.exit when it hits a field it doesn't understand, so catch that too rather than losing the worker
+def split(queue, base_folder, month, file_type):
 	try:
-		# for stage, status in type_stages.items():
-		# 	log.info(f"{file_type} {stage}: {status}")
 		file_prefix = "RC" if file_type == "comment" else "RS"
-		if not type_stages["split"]:
-			original_split_file = os.path.join(base_folder, "reddit", "blocks", f"{file_prefix}_20{month}.zst")
-			split_file = os.path.join(base_folder, "reddit", "blocks", f"{file_prefix}B_20{month}.zst")
-			if os.path.exists(original_split_file):
-				os.rename(original_split_file, split_file)
-
+		original_split_file = os.path.join(base_folder, "reddit", "blocks", f"{file_prefix}_20{month}.zst")
+		split_file = os.path.join(base_folder, "reddit", "blocks", f"{file_prefix}B_20{month}.zst")
+		if os.path.exists(original_split_file):
+			os.rename(original_split_file, split_file)
+
+		if not os.path.exists(split_file):
+			log.info(f"{file_type}: File {split_file} doesn't exist, checking for blocks")
+			split_file = os.path.join(base_folder, "reddit", "blocks", f"{file_prefix}_20{month}.zst_blocks")
 			if not os.path.exists(split_file):
-				log.info(f"{file_type}: File {split_file} doesn't exist, checking for blocks")
-				split_file = os.path.join(base_folder, "reddit", "blocks", f"{file_prefix}_20{month}.zst_blocks")
-				if not os.path.exists(split_file):
-					log.error(f"{file_type}: File {split_file} doesn't exist, aborting")
-					return False
+				log.error(f"{file_type}: File {split_file} doesn't exist, aborting")
+				queue.put((file_type, "error", f"File {split_file} doesn't exist"))
+				return
 
-			split_folder = os.path.join(base_folder, "ingest", "download")
+		split_folder = os.path.join(base_folder, "ingest", "download")
 
-			log.info(f"{file_type}: Starting {file_type} split")
-			log.info(f"{file_type}: Reading from: {split_file}")
-			log.info(f"{file_type}: Writing to: {split_folder}")
-			split_blocks_by_minutes.split_by_minutes(split_file, split_folder)
+		log.info(f"{file_type}: Starting {file_type} split")
+		log.info(f"{file_type}: Reading from: {split_file}")
+		log.info(f"{file_type}: Writing to: {split_folder}")
+		split_blocks_by_minutes.split_by_minutes(split_file, split_folder)
+
+		log.warning(f"{file_type}: {file_type} split complete")
+		discord_logging.flush_discord()
+		queue.put((file_type, "split", True))
+	except (Exception, SystemExit) as err:
+		report_error(queue, file_type, "split", err)
 
-			log.warning(f"{file_type}: {file_type} split complete")
-			discord_logging.flush_discord()
-			queue.put((file_type, "split", True))
 
+def merge_day(queue, base_folder, file_type, day, reddit_username, ignore_ids):
+	try:
+		input_folders = [
+			(os.path.join(base_folder, "ingest", "ingest"), IngestType.INGEST),
+			(os.path.join(base_folder, "ingest", "rescan"), IngestType.RESCAN),
+			(os.path.join(base_folder, "ingest", "download"), IngestType.DOWNLOAD),
+		]
+		combined_folder = os.path.join(base_folder, "ingest", "combined")
+		log.info(f"{file_type}: Starting {file_type} merge of {day.strftime('%y-%m-%d')}")
+		build_day(
+			day,
+			input_folders,
+			combined_folder,
+			ObjectType.COMMENT if file_type == "comment" else ObjectType.SUBMISSION,
+			get_reddit(reddit_username),
+			ignore_ids,
+			get_pushshift_token,
+			cache=get_cache(),
+			pushshift_bucket=pushshift_bucket,
+			reddit_bucket=reddit_bucket
+		)
+		queue.put((file_type, "merge", day.strftime('%y-%m-%d')))
+	except (Exception, SystemExit) as err:
+		report_error(queue, file_type, f"merge {day.strftime('%y-%m-%d')}", err)
+
+
+def build(queue, base_folder, month, file_type, compression_level):
+	try:
+		log.info(f"{file_type}: Starting {file_type} build")
 		start_date = datetime.strptime(month, "%y-%m")
-		if start_date.month == 12:
-			end_date = start_date.replace(year=start_date.year + 1, month=1)
-		else:
-			end_date = start_date.replace(month=start_date.month + 1)
-		if type_stages["merge"] is None or type_stages["merge"] < end_date:
-			if type_stages["merge"] is not None:
-				start_date = type_stages["merge"]
-
-			log.info(f"{file_type}: Starting {file_type} merge from {start_date}")
-
-			reddit = praw.Reddit(reddit_username)
-
-			input_folders = [
-				(os.path.join(base_folder, "ingest", "ingest"), IngestType.INGEST),
-				(os.path.join(base_folder, "ingest", "rescan"), IngestType.RESCAN),
-				(os.path.join(base_folder, "ingest", "download"), IngestType.DOWNLOAD),
-			]
-			for input_folder in input_folders:
-				log.info(f"{file_type}: Reading from: {input_folder[0]} : {input_folder[1]}")
-			combined_folder = os.path.join(base_folder, "ingest", "combined")
-			log.info(f"{file_type}: Writing to: {combined_folder}")
-			while start_date < end_date:
-				build_day(
-					start_date,
-					input_folders,
-					combined_folder,
-					ObjectType.COMMENT if file_type == "comment" else ObjectType.SUBMISSION,
-					reddit,
-					ignore_ids,
-					get_pushshift_token
-				)
-				start_date = end_of_day(start_date)
-				queue.put((file_type, "merge", start_date))
-			log.warning(f"{file_type}: {file_type} merge complete")
-			discord_logging.flush_discord()
 
-		if not type_stages["build"]:
-			log.info(f"{file_type}: Starting {file_type} build")
-			start_date = datetime.strptime(month, "%y-%m")
-
-			input_folder = os.path.join(base_folder, "ingest", "combined")
-			output_folder = os.path.join(base_folder, "reddit")
-			log.info(f"{file_type}: Reading from: {input_folder}")
-			log.info(f"{file_type}: Writing to: {output_folder}")
-			build_month.build_month(
-				start_date,
-				input_folder,
-				output_folder,
-				file_type+"s",
-				compression_level
-			)
-			queue.put((file_type, "build", True))
-			log.warning(f"{file_type}: {file_type} build complete")
-			discord_logging.flush_discord()
+		input_folder = os.path.join(base_folder, "ingest", "combined")
+		output_folder = os.path.join(base_folder, "reddit")
+		log.info(f"{file_type}: Reading from: {input_folder}")
+		log.info(f"{file_type}: Writing to: {output_folder}")
+		build_month.build_month(
+			start_date,
+			input_folder,
+			output_folder,
+			file_type+"s",
+			compression_level
+		)
+		log.warning(f"{file_type}: {file_type} build complete")
+		discord_logging.flush_discord()
+		queue.put((file_type, "build", True))
+	except (Exception, SystemExit) as err:
+		report_error(queue, file_type, "build", err)
 
-		log.warning(f"{file_type}: {file_type} all steps complete")
 
-		log.info(f'torrenttools create -a "https://academictorrents.com/announce.php" -c "Reddit comments and submissions from 20{month}" --include ".*(comments|submissions).*R._20{month}.zst$" -o reddit_20{month}.torrent reddit')
+# queue up the next incomplete stage for a type and return how many tasks were started. The days of a merge are
+# independent of each other, since each only reads the couple minutes on either side, so they all go in at once
+def start_next_stage(pool, queue, stages, file_type, base_folder, month, reddit_username, compression_level, ignore_ids):
+	type_stages = stages[file_type]
+	if not type_stages["split"]:
+		pool.apply_async(split, (queue, base_folder, month, file_type))
+		return 1
 
-		discord_logging.flush_discord()
+	days_to_merge = [day for day in get_days(month) if day.strftime('%y-%m-%d') not in type_stages["merge"]]
+	if len(days_to_merge):
+		log.info(f"{file_type}: Starting {file_type} merge of {len(days_to_merge)} days")
+		for day in days_to_merge:
+			pool.apply_async(merge_day, (queue, base_folder, file_type, day, reddit_username, ignore_ids))
+		return len(days_to_merge)
 
-		# for stage, status in type_stages.items():
-		# 	log.info(f"{file_type} {stage}: {status}")
-	except Exception as err:
-		log.warning(f"Error in {type}: {err}")
-		log.warning(traceback.format_exc())
-		queue.put((file_type, "error", str(err)))
-		discord_logging.flush_discord()
-		# for stage, status in type_stages.items():
-		# 	log.info(f"{file_type} {stage}: {status}")
+	if not type_stages["build"]:
+		pool.apply_async(build, (queue, base_folder, month, file_type, compression_level))
+		return 1
+
+	return 0
 
 
 if __name__ == "__main__":
@@ -243,6 +292,9 @@ if __name__ == "__main__":
 	parser.add_argument('folder', help='Folder under which all the files are stored')
 	parser.add_argument("--ignore_ids", help="Ignore ids between the id ranges listed", default=None)
 	parser.add_argument("--level", help="The compression ratio to output at", default="22")
+	parser.add_argument("--processes", help="Number of processes to use. Each merges one day at a time", default=4, type=int)
+	parser.add_argument("--cache", help="Sqlite file to cache backfill lookups in. Set to an empty string to disable", default="backfill_cache.db")
+	parser.add_argument("--cache_hours", help="How many hours cached lookups are used for", default=7 * 24, type=int)
 	args = parser.parse_args()
 
 	ignore_ids = []
@@ -268,17 +320,43 @@ if __name__ == "__main__":
 	multiprocessing.set_start_method('spawn', force=True)
 	queue = multiprocessing.Manager().Queue()
 	p_lock = multiprocessing.Lock()
-	with multiprocessing.Pool(processes=2, initializer=init, initargs=(p_lock,)) as pool:
-		arguments = []
-		for file_type, type_stages in stages.items():
-			arguments.append((queue, args.folder, month, file_type, type_stages, "Watchful12", level, ignore_ids))
-		workers = pool.starmap_async(process, arguments, chunksize=1, error_callback=log.info)
-		while not workers.ready() or not queue.empty():
+	days_in_month = len(get_days(month))
+	errored_types = set()
+	pushshift_bucket = backfill.SharedTokenBucket(backfill.PUSHSHIFT_RATE)
+	reddit_bucket = backfill.SharedTokenBucket(backfill.REDDIT_RATE)
+	with multiprocessing.Pool(
+			processes=args.processes, initializer=init, initargs=(p_lock, args.cache, args.cache_hours, pushshift_bucket, reddit_bucket)) as pool:
+		pending_tasks = 0
+		for file_type in stages:
+			pending_tasks += start_next_stage(pool, queue, stages, file_type, args.folder, month, "Watchful12", level, ignore_ids)
+		while pending_tasks > 0:
 			file_type, stage, status = queue.get()
+			pending_tasks -= 1
 			if stage == "error":
 				log.error(f"Error in {file_type}: {status}")
-			stages[file_type][stage] = status
+				errored_types.add(file_type)
+			elif stage == "merge":
+				stages[file_type]["merge"].append(status)
+				stages[file_type]["merge"].sort()
+				merged_days = len(stages[file_type]["merge"])
+				log.info(f"{file_type}: Merged {status}, {merged_days}/{days_in_month} days")
+				if merged_days >= days_in_month:
+					log.warning(f"{file_type}: {file_type} merge complete")
+			else:
+				stages[file_type][stage] = status
 			save_status(status_file, stages, month)
 			discord_logging.flush_discord()
-			#log.info(f"workers {workers.ready()} : queue {queue.empty()}")
+
+			# only move a type on to its next stage once the current one is entirely done
+			stage_finished = stage == "split" or stage == "build" or (stage == "merge" and len(stages[file_type]["merge"]) >= days_in_month)
+			if stage_finished and file_type not in errored_types:
+				pending_tasks += start_next_stage(pool, queue, stages, file_type, args.folder, month, "Watchful12", level, ignore_ids)
+
+	for file_type, type_stages in stages.items():
+		if type_stages["build"]:
+			log.warning(f"{file_type}: {file_type} all steps complete")
+		else:
+			log.warning(f"{file_type}: {file_type} not complete")
+	if all(type_stages["build"] for type_stages in stages.values()):
+		log.info(f'torrenttools create -a "https://academictorrents.com/announce.php" -c "Reddit comments and submissions from 20{month}" --include ".*(comments|submissions).*R._20{month}.zst$" -o reddit_20{month}.torrent reddit')
 	discord_logging.flush_discord()
@@ -1,11 +1,17 @@
 import zstandard
 import json
+import mmap
 import os
+import threading
+import hashlib
+import math
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from zst_blocks import ZstBlocksFile
 
 
-def read_obj_zst(file_name):
-	with open(file_name, 'rb') as file_handle:
+def read_obj_zst(file_name, read_ahead_depth=0, use_mmap=False):
+	with open_input(file_name, read_ahead_depth, use_mmap) as file_handle:
 		buffer = ''
 		reader = zstandard.ZstdDecompressor(max_window_size=2**31).stream_reader(file_handle)
 		while True:
@@ -35,8 +41,8 @@ def read_and_decode(reader, chunk_size, max_window_size, previous_chunk=None, by
 		return read_and_decode(reader, chunk_size, max_window_size, chunk, bytes_read)
 
 
-def read_obj_zst_meta(file_name):
-	with open(file_name, 'rb') as file_handle:
+def read_obj_zst_meta(file_name, read_ahead_depth=0, use_mmap=False):
+	with open_input(file_name, read_ahead_depth, use_mmap) as file_handle:
 		buffer = ''
 		reader = zstandard.ZstdDecompressor(max_window_size=2**31).stream_reader(file_handle)
 		while True:
@@ -57,6 +63,140 @@ def read_obj_zst_meta(file_name):
 		reader.close()
 
 
+# reads a file ahead of whatever is using it, with up to depth reads of chunk_size bytes running on background threads
+# at once. Decompression doesn't have to stop and wait for every read, which matters a lot on network shares where each
+# read has a lot of latency. Only reads straight through from start_offset to end_offset, but otherwise acts like a file
+# opened in 'rb' mode. On local disks the os is also told the file will be read sequentially so it can read ahead too
+class ReadAheadFile:
+	def __init__(self, path, start_offset=0, end_offset=None, chunk_size=2**23, depth=4):
+		self.file = open(path, 'rb')
+		self.end_offset = os.fstat(self.file.fileno()).st_size if end_offset is None else end_offset
+		self.chunk_size = chunk_size
+		self.position = start_offset
+		self.next_offset = start_offset
+		self.chunk = b''
+		self.chunk_position = 0
+		self.lock = threading.Lock()
+		if hasattr(os, 'posix_fadvise'):
+			os.posix_fadvise(self.file.fileno(), start_offset, self.end_offset - start_offset, os.POSIX_FADV_SEQUENTIAL)
+		self.executor = ThreadPoolExecutor(max_workers=depth)
+		self.reads = deque()
+		for i in range(depth):
+			self.queue_read()
+
+	# pread doesn't move the file position, so the threads can read at the same time. It's not on windows, where the
+	# reads have to take turns, but still run while the data before them is being decompressed
+	def read_chunk(self, offset, size):
+		parts = []
+		while size > 0:
+			if hasattr(os, 'pread'):
+				part = os.pread(self.file.fileno(), size, offset)
+			else:
+				with self.lock:
+					self.file.seek(offset)
+					part = self.file.read(size)
+			if not part:
+				break
+			parts.append(part)
+			offset += len(part)
+			size -= len(part)
+		return b''.join(parts)
+
+	def queue_read(self):
+		if self.next_offset < self.end_offset:
+			size = min(self.chunk_size, self.end_offset - self.next_offset)
+			self.reads.append(self.executor.submit(self.read_chunk, self.next_offset, size))
+			self.next_offset += size
+
+	def read(self, size=-1):
+		if size < 0:
+			size = self.end_offset - self.position
+		parts = []
+		while size > 0:
+			if self.chunk_position >= len(self.chunk):
+				if not self.reads:
+					break
+				self.chunk = self.reads.popleft().result()
+				self.chunk_position = 0
+				self.queue_read()
+				if not self.chunk:
+					break
+			part = self.chunk[self.chunk_position:self.chunk_position + size]
+			self.chunk_position += len(part)
+			size -= len(part)
+			parts.append(part)
+		data = parts[0] if len(parts) == 1 else b''.join(parts)
+		self.position += len(data)
+		return data
+
+	def tell(self):
+		return self.position
+
+	def close(self):
+		self.executor.shutdown(cancel_futures=True)
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, exc_traceback):
+		self.close()
+
+
+# maps a file into memory and hands out slices of it without copying them, so zstd decompresses straight from the
+# mapped pages instead of going through a buffered reader. Best on local disks, on a network share use a ReadAheadFile.
+# Reads straight through from start_offset to end_offset like a file opened in 'rb' mode
+class MappedFile:
+	def __init__(self, path, start_offset=0, end_offset=None):
+		self.file = open(path, 'rb')
+		file_size = os.fstat(self.file.fileno()).st_size
+		self.end_offset = file_size if end_offset is None else end_offset
+		self.position = start_offset
+		self.mapped = None
+		self.view = memoryview(b'')
+		# an empty file can't be mapped
+		if file_size > 0:
+			self.mapped = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+			if hasattr(mmap, 'MADV_SEQUENTIAL'):
+				self.mapped.madvise(mmap.MADV_SEQUENTIAL)
+			self.view = memoryview(self.mapped)
+
+	def read(self, size=-1):
+		end = self.end_offset if size < 0 else min(self.position + size, self.end_offset)
+		data = self.view[self.position:end]
+		self.position = max(self.position, end)
+		return data
+
+	def tell(self):
+		return self.position
+
+	def close(self):
+		try:
+			self.view.release()
+			if self.mapped is not None:
+				self.mapped.close()
+		except BufferError:
+			# something is still holding a slice, like a zstd reader that wasn't closed. The mapping is closed once it's let go
+			pass
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, exc_traceback):
+		self.close()
+
+
+# open a file to read straight through. Either memory mapped, with read_ahead_depth reads running in the background, or
+# normally if read_ahead_depth is 0
+def open_input(file_name, read_ahead_depth=0, use_mmap=False):
+	if use_mmap:
+		return MappedFile(file_name)
+	if read_ahead_depth > 0:
+		return ReadAheadFile(file_name, depth=read_ahead_depth)
+	return open(file_name, 'rb')
+
+
 class OutputZst:
 	def __init__(self, file_name):
 		output_file = open(file_name, 'wb')
@@ -77,29 +217,250 @@ class OutputZst:
 		return True
 
 
+# keeps a bounded number of zst output files open at once, so splitting by a field with tens of thousands of values
+# doesn't run out of file handles or memory for compressors. Lines for files that aren't open are buffered and written
+# in batches. When too many files are open the least recently used one is closed, which ends its zstd frame. If it's
+# written to again it's reopened in append mode and starts a new frame, which is still a valid zst file
+class WriterPool:
+	newline_encoded = "\n".encode('utf-8')
+
+	def __init__(self, max_open_handles=100, flush_bytes=2**20, max_buffered_bytes=2**29):
+		self.max_open_handles = max_open_handles
+		self.flush_bytes = flush_bytes
+		self.max_buffered_bytes = max_buffered_bytes
+		self.handles = OrderedDict()
+		self.buffers = {}
+		self.buffer_sizes = {}
+		self.buffered_bytes = 0
+		self.opened_paths = set()
+
+	def get_handle(self, path):
+		handle = self.handles.get(path)
+		if handle is not None:
+			self.handles.move_to_end(path)
+			return handle
+		while len(self.handles) >= self.max_open_handles:
+			_, old_handle = self.handles.popitem(last=False)
+			old_handle.close()
+		# the first open truncates anything left over from a previous run, after that append a new frame
+		handle = zstandard.ZstdCompressor().stream_writer(open(path, 'ab' if path in self.opened_paths else 'wb'))
+		self.opened_paths.add(path)
+		self.handles[path] = handle
+		return handle
+
+	def flush_buffer(self, path):
+		lines = self.buffers.pop(path)
+		self.buffered_bytes -= self.buffer_sizes.pop(path)
+		handle = self.get_handle(path)
+		lines.append(b"")
+		handle.write(WriterPool.newline_encoded.join(lines))
+
+	def write_line(self, path, line):
+		encoded_line = line.encode('utf-8')
+		handle = self.handles.get(path)
+		if handle is not None:
+			self.handles.move_to_end(path)
+			handle.write(encoded_line)
+			handle.write(WriterPool.newline_encoded)
+			return
+
+		buffer = self.buffers.get(path)
+		if buffer is None:
+			buffer = []
+			self.buffers[path] = buffer
+			self.buffer_sizes[path] = 0
+		buffer.append(encoded_line)
+		self.buffer_sizes[path] += len(encoded_line) + 1
+		self.buffered_bytes += len(encoded_line) + 1
+		if self.buffer_sizes[path] >= self.flush_bytes:
+			self.flush_buffer(path)
+		elif self.buffered_bytes >= self.max_buffered_bytes:
+			# too much buffered overall, write out the biggest buffers until we're down to half
+			for buffer_path in sorted(self.buffer_sizes, key=self.buffer_sizes.get, reverse=True):
+				self.flush_buffer(buffer_path)
+				if self.buffered_bytes < self.max_buffered_bytes / 2:
+					break
+
+	def count_paths(self):
+		return len(self.opened_paths) + len(self.buffers)
+
+	def close(self):
+		for path in list(self.buffers):
+			self.flush_buffer(path)
+		for handle in self.handles.values():
+			handle.close()
+		self.handles = OrderedDict()
+
+
+# estimates how many different values were added, using a fixed 2^precision bytes of memory no matter how many there
+# are. The standard error is about 1.04 / sqrt(2^precision), so 0.8% at the default. Values are hashed with blake2b
+# instead of hash(), which is different in every process, so sketches from different processes can be merged
+class HyperLogLog:
+	def __init__(self, precision=14, registers=None):
+		self.precision = precision
+		self.registers = bytearray(1 << precision) if registers is None else registers
+
+	def add(self, value):
+		hashed = int.from_bytes(hashlib.blake2b(value.encode('utf-8', errors='surrogatepass'), digest_size=8).digest(), 'little')
+		index = hashed >> (64 - self.precision)
+		remaining_bits = 64 - self.precision
+		rank = remaining_bits - (hashed & ((1 << remaining_bits) - 1)).bit_length() + 1
+		if rank > self.registers[index]:
+			self.registers[index] = rank
+
+	def merge(self, other):
+		self.registers = bytearray(map(max, self.registers, other.registers))
+
+	def count(self):
+		size = len(self.registers)
+		estimate = (0.7213 / (1 + 1.079 / size)) * size * size / sum(2.0 ** -register for register in self.registers)
+		# the estimate is biased for small counts, where counting the empty registers is more accurate
+		empty_registers = self.registers.count(0)
+		if estimate <= 2.5 * size and empty_registers > 0:
+			estimate = size * math.log(size / empty_registers)
+		return int(estimate)
+
+	def to_dict(self):
+		return {"precision": self.precision, "registers": self.registers.hex()}
+
+	@staticmethod
+	def from_dict(sketch_dict):
+		return HyperLogLog(sketch_dict["precision"], bytearray.fromhex(sketch_dict["registers"]))
+
+
+# keeps approximate counts of the most common values in a fixed amount of memory, using the space saving algorithm.
+# Up to twice capacity values are counted, then everything but the top capacity is dropped. A value that was dropped
+# could have been seen up to floor times, so new values start at floor. That way a count is never lower than the real
+# one, and never more than its error higher. Any value seen more than floor times is guaranteed to be counted
+class SpaceSaving:
+	def __init__(self, capacity=10000):
+		self.capacity = capacity
+		self.counts = {}
+		self.errors = {}
+		self.floor = 0
+
+	def add(self, value, count=1):
+		if value in self.counts:
+			self.counts[value] += count
+		else:
+			self.counts[value] = self.floor + count
+			self.errors[value] = self.floor
+			if len(self.counts) >= self.capacity * 2:
+				self.prune()
+
+	def prune(self):
+		if len(self.counts) <= self.capacity:
+			return
+		ordered = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+		self.floor = max(self.floor, ordered[self.capacity][1])
+		self.counts = dict(ordered[:self.capacity])
+		self.errors = {value: self.errors[value] for value in self.counts}
+
+	# values missing from one of the summaries could have been seen up to its floor times there
+	def merge(self, other):
+		for value in self.counts.keys() - other.counts.keys():
+			self.counts[value] += other.floor
+			self.errors[value] += other.floor
+		for value, count in other.counts.items():
+			if value in self.counts:
+				self.counts[value] += count
+				self.errors[value] += other.errors[value]
+			else:
+				self.counts[value] = count + self.floor
+				self.errors[value] = other.errors[value] + self.floor
+		self.floor += other.floor
+		self.prune()
+
+	# the top values as tuples of value, count and error, largest count first
+	def top(self, limit=None):
+		items = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+		return [(value, count, self.errors[value]) for value, count in items]
+
+	def to_dict(self):
+		return {"capacity": self.capacity, "floor": self.floor, "counts": self.top()}
+
+	@staticmethod
+	def from_dict(sketch_dict):
+		sketch = SpaceSaving(sketch_dict["capacity"])
+		sketch.floor = sketch_dict["floor"]
+		for value, count, error in sketch_dict["counts"]:
+			sketch.counts[value] = count
+			sketch.errors[value] = error
+		return sketch
+
+
 # copied from https://github.com/ArthurHeitmann/zst_blocks_format
-def read_obj_zst_blocks(file_name):
+def read_obj_zst_blocks(file_name, use_mmap=False):
 	with open(file_name, "rb") as file:
-		for row in ZstBlocksFile.streamRows(file):
-			line = row.decode()
-			yield json.loads(line.strip())
+		if use_mmap:
+			if os.fstat(file.fileno()).st_size == 0:
+				return
+			with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+				for row in ZstBlocksFile.streamRowsMapped(view):
+					line = row.decode()
+					yield json.loads(line.strip())
+		else:
+			for row in ZstBlocksFile.streamRows(file):
+				line = row.decode()
+				yield json.loads(line.strip())
+
+
+BASE36_CHARS = '0123456789abcdefghijklmnopqrstuvwxyz'
+# every three digit base36 string, zero padded, so encoding only needs one divmod per three characters
+BASE36_TRIPLE_SIZE = 36 ** 3
+BASE36_TRIPLES = [a + b + c for a in BASE36_CHARS for b in BASE36_CHARS for c in BASE36_CHARS]
+BASE36_TRIPLES_UNPADDED = [triple.lstrip('0') for triple in BASE36_TRIPLES]
 
 
 def base36encode(integer: int) -> str:
-	chars = '0123456789abcdefghijklmnopqrstuvwxyz'
-	sign = '-' if integer < 0 else ''
-	integer = abs(integer)
-	result = ''
-	while integer > 0:
-		integer, remainder = divmod(integer, 36)
-		result = chars[remainder] + result
-	return sign + result
+	if integer < 0:
+		return '-' + base36encode(-integer)
+	if integer < BASE36_TRIPLE_SIZE:
+		return BASE36_TRIPLES_UNPADDED[integer]
+	integer, remainder = divmod(integer, BASE36_TRIPLE_SIZE)
+	result = BASE36_TRIPLES[remainder]
+	while integer >= BASE36_TRIPLE_SIZE:
+		integer, remainder = divmod(integer, BASE36_TRIPLE_SIZE)
+		result = BASE36_TRIPLES[remainder] + result
+	return BASE36_TRIPLES_UNPADDED[integer] + result
 
 
 def base36decode(base36: str) -> int:
 	return int(base36, 36)
 
 
+# yield the base36 string of every id from start_id to end_id inclusive. Contiguous ids share everything but
+# the last three characters, so the prefix is only encoded once every 46656 ids
+def base36encode_range(start_id, end_id):
+	if start_id < 0:
+		raise ValueError(f"Can't encode a range of negative ids: {start_id}")
+	high = start_id // BASE36_TRIPLE_SIZE
+	while high * BASE36_TRIPLE_SIZE <= end_id:
+		low_start = max(start_id - high * BASE36_TRIPLE_SIZE, 0)
+		low_end = min(end_id - high * BASE36_TRIPLE_SIZE, BASE36_TRIPLE_SIZE - 1) + 1
+		if high == 0:
+			yield from BASE36_TRIPLES_UNPADDED[low_start:low_end]
+		else:
+			prefix = base36encode(high)
+			for triple in BASE36_TRIPLES[low_start:low_end]:
+				yield prefix + triple
+		high += 1
+
+
+def base36encode_list(integers):
+	return [base36encode(integer) for integer in integers]
+
+
+def base36decode_list(base36_strings):
+	return [int(base36, 36) for base36 in base36_strings]
+
+
+# yield the ids with the type prefix reddit uses for fullnames, t1_ for comments and t3_ for submissions
+def fullnames(ids, prefix):
+	for str_id in ids:
+		yield prefix + str_id
+
+
 def merge_lowest_highest_id(str_id, lowest_id, highest_id):
 	int_id = base36decode(str_id)
 	if lowest_id is None or int_id < lowest_id:
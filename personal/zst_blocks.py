@@ -90,6 +90,41 @@ class ZstBlocksFile:
 			ZstBlock(rows).write(file, rowPositions,
 								 compressionLevel=compressionLevel)
 
+	# the same as the functions above, but reading from the bytes of a memory
+	# mapped file, so getting to a block is a slice instead of a seek and read
+	@staticmethod
+	def readBlockRowAtMapped(data: memoryview, rowPosition: RowPosition) -> bytes:
+		return ZstBlock.readRowMapped(data, rowPosition.blockOffset, rowPosition.rowIndex)
+
+	@staticmethod
+	def readMultipleBlocksMapped(data: memoryview, rowPositions: list[RowPosition]) -> \
+	list[bytes]:
+		blockGroupsDict: dict[int, list[RowIndex]] = {}
+		for i, rowPosition in enumerate(rowPositions):
+			blockGroupsDict.setdefault(rowPosition.blockOffset, []).append(
+				RowIndex(rowPosition.rowIndex, i))
+
+		rows: list = [None] * len(rowPositions)
+		for blockOffset, rowIndices in blockGroupsDict.items():
+			blockRows = ZstBlock.readSpecificRowsMapped(data, blockOffset, [
+				rowIndex.withinBlockIndex for rowIndex in rowIndices])
+			for originalPosition, row in zip(rowIndices, blockRows):
+				rows[originalPosition.originalRowIndex] = row
+
+		return rows
+
+	@staticmethod
+	def streamRowsMapped(data: memoryview, blockIndexProgressCallback: Callable[[
+		int], None] | None = None) -> Iterable[bytes]:
+		blockOffset = 0
+		blockIndex = 0
+		while blockOffset < len(data):
+			decompressedData, blockOffset = ZstBlock.decompressMapped(data, blockOffset)
+			yield from ZstBlock.splitRows(decompressedData)
+			blockIndex += 1
+			if blockIndexProgressCallback is not None:
+				blockIndexProgressCallback(blockIndex)
+
 	@staticmethod
 	def countBlocks(file: BinaryIO) -> int:
 		fileSize = os.path.getsize(file.name)
@@ -171,6 +206,60 @@ class ZstBlock:
 		return decompressedData[
 			   dataStart + row.offset: dataStart + row.offset + row.size]
 
+	# decompress the block starting at blockOffset in the mapped data,
+	# returning it along with the offset of the next block
+	@staticmethod
+	def decompressMapped(data: memoryview, blockOffset: int) -> tuple[bytes, int]:
+		compressedSize = _uint32Struct.unpack_from(data, blockOffset)[0]
+		dataStart = blockOffset + 4
+		decompressedData = ZstdDecompressor().decompress(
+			data[dataStart:dataStart + compressedSize])
+		return decompressedData, dataStart + compressedSize
+
+	@staticmethod
+	def readRowInfos(decompressedData: bytes) -> tuple[list[ZstRowInfo], int]:
+		memoryView = memoryview(decompressedData)
+		count = _uint32Struct.unpack(memoryView[0:4])[0]
+		rows: list[ZstRowInfo] = [None] * count
+		for i in range(count):
+			rows[i] = ZstRowInfo.read(memoryView, 4 + i * ZstRowInfo.structSize)
+		return rows, 4 + count * ZstRowInfo.structSize
+
+	@classmethod
+	def splitRows(cls, decompressedData: bytes) -> list[bytes]:
+		rows, dataStart = cls.readRowInfos(decompressedData)
+		return [
+			decompressedData[
+			dataStart + row.offset: dataStart + row.offset + row.size]
+			for row in rows
+		]
+
+	@classmethod
+	def readSpecificRowsMapped(cls, data: memoryview, blockOffset: int,
+							   rowIndices: Iterable[int]) -> list[bytes]:
+		decompressedData, _ = cls.decompressMapped(data, blockOffset)
+		rows, dataStart = cls.readRowInfos(decompressedData)
+		return [
+			decompressedData[
+			dataStart + rows[rowIndex].offset: dataStart + rows[
+				rowIndex].offset + rows[rowIndex].size]
+			for rowIndex in rowIndices
+		]
+
+	@classmethod
+	def readRowMapped(cls, data: memoryview, blockOffset: int, rowIndex: int) -> bytes:
+		decompressedData, _ = cls.decompressMapped(data, blockOffset)
+
+		memoryView = memoryview(decompressedData)
+		count = _uint32Struct.unpack(memoryView[0:4])[0]
+		if rowIndex >= count:
+			raise Exception("Row index out of range")
+		row = ZstRowInfo.read(memoryView, 4 + rowIndex * ZstRowInfo.structSize)
+
+		dataStart = 4 + count * ZstRowInfo.structSize
+		return decompressedData[
+			   dataStart + row.offset: dataStart + row.offset + row.size]
+
 	def write(self, file: BinaryIO,
 			  rowPositions: list[RowPosition] | None = None,
 			  compressionLevel=_defaultCompressionLevel) -> None:
@@ -20,11 +20,19 @@
 import zstandard
 import os
 import json
+import mmap
 import sys
 import time
 import argparse
+import bisect
+import hashlib
+import queue
 import re
-from collections import defaultdict
+import shutil
+import threading
+import zlib
+from collections import defaultdict, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import logging.handlers
 import multiprocessing
 from enum import Enum
@@ -61,16 +69,27 @@ class FileType(Enum):
 
 # convenience object used to pass status information between processes
 class FileConfig:
-	def __init__(self, input_path, output_path=None, complete=False, lines_processed=0, error_lines=0, lines_matched=0):
+	def __init__(
+			self, input_path, output_path=None, complete=False, lines_processed=0, error_lines=0, lines_matched=0, output_offset=None,
+			start_offset=None, end_offset=None
+	):
 		self.input_path = input_path
 		self.output_path = output_path
-		self.file_size = os.stat(input_path).st_size
+		self.output_offset = output_offset
+		# if set, only process this byte range of the input file
+		self.start_offset = start_offset
+		self.end_offset = end_offset
+		if start_offset is not None:
+			self.file_size = end_offset - start_offset
+		else:
+			self.file_size = os.stat(input_path).st_size
 		self.complete = complete
 		self.bytes_processed = self.file_size if complete else 0
 		self.lines_processed = lines_processed if complete else 0
 		self.error_message = None
 		self.error_lines = error_lines
 		self.lines_matched = lines_matched
+		self.index = None
 		file_name = os.path.split(input_path)[1]
 		if file_name.startswith("RS"):
 			self.file_type = FileType.SUBMISSION
@@ -83,15 +102,225 @@ class FileConfig:
 		return f"{self.input_path} : {self.output_path} : {self.file_size} : {self.complete} : {self.bytes_processed} : {self.lines_processed}"
 
 
+# wraps a file handle so reading stops after length bytes
+class RangeFile:
+	def __init__(self, handle, length):
+		self.handle = handle
+		self.remaining = length
+		self.bytes_read = 0
+
+	def read(self, size=-1):
+		if size < 0 or size > self.remaining:
+			size = self.remaining
+		data = self.handle.read(size)
+		self.remaining -= len(data)
+		self.bytes_read += len(data)
+		return data
+
+
+# reads a file ahead of whatever is using it, with up to depth reads of chunk_size bytes running on background threads
+# at once. Decompression doesn't have to stop and wait for every read, which matters a lot on network shares where each
+# read has a lot of latency. Only reads straight through from start_offset to end_offset, but otherwise acts like a file
+# opened in 'rb' mode. On local disks the os is also told the file will be read sequentially so it can read ahead too
+class ReadAheadFile:
+	def __init__(self, path, start_offset=0, end_offset=None, chunk_size=2**23, depth=4):
+		self.file = open(path, 'rb')
+		self.end_offset = os.fstat(self.file.fileno()).st_size if end_offset is None else end_offset
+		self.chunk_size = chunk_size
+		self.position = start_offset
+		self.next_offset = start_offset
+		self.chunk = b''
+		self.chunk_position = 0
+		self.lock = threading.Lock()
+		if hasattr(os, 'posix_fadvise'):
+			os.posix_fadvise(self.file.fileno(), start_offset, self.end_offset - start_offset, os.POSIX_FADV_SEQUENTIAL)
+		self.executor = ThreadPoolExecutor(max_workers=depth)
+		self.reads = deque()
+		for i in range(depth):
+			self.queue_read()
+
+	# pread doesn't move the file position, so the threads can read at the same time. It's not on windows, where the
+	# reads have to take turns, but still run while the data before them is being decompressed
+	def read_chunk(self, offset, size):
+		parts = []
+		while size > 0:
+			if hasattr(os, 'pread'):
+				part = os.pread(self.file.fileno(), size, offset)
+			else:
+				with self.lock:
+					self.file.seek(offset)
+					part = self.file.read(size)
+			if not part:
+				break
+			parts.append(part)
+			offset += len(part)
+			size -= len(part)
+		return b''.join(parts)
+
+	def queue_read(self):
+		if self.next_offset < self.end_offset:
+			size = min(self.chunk_size, self.end_offset - self.next_offset)
+			self.reads.append(self.executor.submit(self.read_chunk, self.next_offset, size))
+			self.next_offset += size
+
+	def read(self, size=-1):
+		if size < 0:
+			size = self.end_offset - self.position
+		parts = []
+		while size > 0:
+			if self.chunk_position >= len(self.chunk):
+				if not self.reads:
+					break
+				self.chunk = self.reads.popleft().result()
+				self.chunk_position = 0
+				self.queue_read()
+				if not self.chunk:
+					break
+			part = self.chunk[self.chunk_position:self.chunk_position + size]
+			self.chunk_position += len(part)
+			size -= len(part)
+			parts.append(part)
+		data = parts[0] if len(parts) == 1 else b''.join(parts)
+		self.position += len(data)
+		return data
+
+	def tell(self):
+		return self.position
+
+	def close(self):
+		self.executor.shutdown(cancel_futures=True)
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, exc_traceback):
+		self.close()
+
+
+# maps a file into memory and hands out slices of it without copying them, so zstd decompresses straight from the
+# mapped pages instead of going through a buffered reader. Best on local disks, on a network share use a ReadAheadFile.
+# Reads straight through from start_offset to end_offset like a file opened in 'rb' mode
+class MappedFile:
+	def __init__(self, path, start_offset=0, end_offset=None):
+		self.file = open(path, 'rb')
+		file_size = os.fstat(self.file.fileno()).st_size
+		self.end_offset = file_size if end_offset is None else end_offset
+		self.position = start_offset
+		self.mapped = None
+		self.view = memoryview(b'')
+		# an empty file can't be mapped
+		if file_size > 0:
+			self.mapped = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+			if hasattr(mmap, 'MADV_SEQUENTIAL'):
+				self.mapped.madvise(mmap.MADV_SEQUENTIAL)
+			self.view = memoryview(self.mapped)
+
+	def read(self, size=-1):
+		end = self.end_offset if size < 0 else min(self.position + size, self.end_offset)
+		data = self.view[self.position:end]
+		self.position = max(self.position, end)
+		return data
+
+	def tell(self):
+		return self.position
+
+	def close(self):
+		try:
+			self.view.release()
+			if self.mapped is not None:
+				self.mapped.close()
+		except BufferError:
+			# something is still holding a slice, like a zstd reader that wasn't closed. The mapping is closed once it's let go
+			pass
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, exc_traceback):
+		self.close()
+
+
+# find where each zstd frame in a file starts by reading only the frame and block headers and seeking over the
+# compressed data. A file written in one frame can't be split up, so give up and return None as soon as a frame turns
+# out to be bigger than max_frame_size
+def get_frame_offsets(path, max_frame_size):
+	offsets = []
+	with open(path, 'rb') as handle:
+		file_size = os.fstat(handle.fileno()).st_size
+		position = 0
+		while position < file_size:
+			handle.seek(position)
+			header = handle.read(18)
+			if len(header) < 8:
+				raise ValueError(f"File ends in the frame header at {position:,} in {path}")
+			magic = int.from_bytes(header[:4], 'little')
+			if magic & 0xFFFFFFF0 == 0x184D2A50:
+				# skippable frame, the next four bytes are its size
+				position += 8 + int.from_bytes(header[4:8], 'little')
+				continue
+			if magic != 0xFD2FB528:
+				raise ValueError(f"No zstd frame at {position:,} in {path}")
+			frame_start = position
+			offsets.append(frame_start)
+			descriptor = header[4]
+			single_segment = (descriptor >> 5) & 1
+			position += 5 + (0 if single_segment else 1) + (0, 1, 2, 4)[descriptor & 3] + (single_segment, 2, 4, 8)[descriptor >> 6]
+			if position - frame_start > len(header):
+				raise ValueError(f"File ends in the frame header at {frame_start:,} in {path}")
+			while True:
+				handle.seek(position)
+				block_bytes = handle.read(3)
+				if len(block_bytes) != 3:
+					raise ValueError(f"File ends in the frame at {frame_start:,} in {path}")
+				block_header = int.from_bytes(block_bytes, 'little')
+				# rle blocks are a single byte repeated, otherwise the size is how many bytes follow
+				position += 3 + (1 if (block_header >> 1) & 3 == 1 else block_header >> 3)
+				if position - frame_start > max_frame_size:
+					return None
+				if block_header & 1:
+					break
+			if (descriptor >> 2) & 1:
+				position += 4
+			if position > file_size:
+				raise ValueError(f"File ends in the frame at {frame_start:,} in {path}")
+	return offsets
+
+
+# split a file into byte ranges of about split_size on frame boundaries, or None if it can't be split
+def get_file_ranges(path, split_size):
+	frame_offsets = get_frame_offsets(path, split_size)
+	if frame_offsets is None or len(frame_offsets) < 2:
+		return None
+	file_size = os.stat(path).st_size
+	ranges = []
+	range_start = 0
+	for frame_offset in frame_offsets[1:]:
+		if frame_offset - range_start >= split_size:
+			ranges.append((range_start, frame_offset))
+			range_start = frame_offset
+	ranges.append((range_start, file_size))
+	if len(ranges) < 2:
+		return None
+	return ranges
+
+
 # another convenience object to read and write from both zst files and ndjson files
 class FileHandle:
 	newline_encoded = "\n".encode('utf-8')
 	ext_len = len(".zst")
 
-	def __init__(self, path, is_split=False):
+	def __init__(self, path, is_split=False, split_buckets=None, read_ahead=0, use_mmap=False):
 		self.path = path
 		self.is_split = is_split
+		self.split_buckets = split_buckets
+		self.read_ahead = read_ahead
+		self.use_mmap = use_mmap
 		self.handles = {}
+		self.files = {}
+		self.append = False
+		self.checkpoint_offsets = {}
 
 	def get_paths(self, character_filter=None):
 		if self.is_split:
@@ -99,7 +328,7 @@ class FileHandle:
 			for file in os.listdir(self.path):
 				if not file.endswith(".zst"):
 					continue
-				if character_filter is not None and character_filter != file[-FileHandle.ext_len - 1:-FileHandle.ext_len]:
+				if character_filter is not None and character_filter != file[:-FileHandle.ext_len]:
 					continue
 				paths.append(os.path.join(self.path, file))
 			return paths
@@ -109,6 +338,17 @@ class FileHandle:
 	def get_count_files(self):
 		return len(self.get_paths())
 
+	# open a file to read straight through. Either memory mapped, with read_ahead reads running in the background, or
+	# as a regular file
+	def open_read(self, path, start_offset=0, end_offset=None):
+		if self.use_mmap:
+			return MappedFile(path, start_offset, end_offset)
+		if self.read_ahead > 0:
+			return ReadAheadFile(path, start_offset, end_offset, depth=self.read_ahead)
+		file_handle = open(path, 'rb')
+		file_handle.seek(start_offset)
+		return file_handle
+
 	# recursively decompress and decode a chunk of bytes. If there's a decode error then read another chunk and try with that, up to a limit of max_window_size bytes
 	@staticmethod
 	def read_and_decode(reader, chunk_size, max_window_size, previous_chunk=None, bytes_read=0):
@@ -123,9 +363,27 @@ class FileHandle:
 				raise UnicodeError(f"Unable to decode frame after reading {bytes_read:,} bytes")
 			return FileHandle.read_and_decode(reader, chunk_size, max_window_size, chunk, bytes_read)
 
-	# open a zst compressed ndjson file, or a regular uncompressed ndjson file and yield lines one at a time
-	# also passes back file progress
-	def yield_lines(self, character_filter=None):
+	# read past the first count lines from a decompression reader without decoding them. Returns what's left of the chunk
+	# the last skipped line ended in, or None if the reader ran out first
+	@staticmethod
+	def skip_lines(reader, count):
+		while count > 0:
+			chunk = reader.read(2**27)
+			if not chunk:
+				return None
+			newlines = chunk.count(FileHandle.newline_encoded)
+			if newlines < count:
+				count -= newlines
+				continue
+			index = -1
+			for i in range(count):
+				index = chunk.index(FileHandle.newline_encoded, index + 1)
+			return chunk[index + 1:]
+		return b''
+
+	# open a zst compressed ndjson file, or a regular uncompressed ndjson file and yield lines one at a time, starting
+	# after the first skip_lines lines. Also passes back file progress
+	def yield_lines(self, character_filter=None, skip_lines=0):
 		if self.is_split:
 			if character_filter is not None:
 				path = os.path.join(self.path, f"{character_filter}.zst")
@@ -134,11 +392,16 @@ class FileHandle:
 		else:
 			path = self.path
 		if os.path.exists(path):
-			with open(path, 'rb') as file_handle:
+			with self.open_read(path) as file_handle:
 				buffer = ''
 				reader = zstandard.ZstdDecompressor(max_window_size=2**31).stream_reader(file_handle)
+				previous_chunk = FileHandle.skip_lines(reader, skip_lines)
+				if previous_chunk is None:
+					reader.close()
+					return
 				while True:
-					chunk = FileHandle.read_and_decode(reader, 2**27, (2**29) * 2)
+					chunk = FileHandle.read_and_decode(reader, 2**27, (2**29) * 2, previous_chunk)
+					previous_chunk = None
 					if not chunk:
 						break
 					lines = (buffer + chunk).split("\n")
@@ -149,6 +412,64 @@ class FileHandle:
 					buffer = lines[-1]
 				reader.close()
 
+	# yield the lines in a byte range of a zst file made of several frames, the range has to start and end on a frame
+	# boundary. Frames don't have to end on a line, so each line belongs to the range it starts in. Unless the range is at
+	# the start of the file the partial first line is skipped, since the range before finishes it by reading on into this
+	# one. Lines are counted from the first full line, so skip_lines works the same as for a whole file. Also passes back
+	# progress through the range
+	def yield_range_lines(self, start_offset, end_offset, skip_lines=0):
+		with open(self.path, 'rb') as file_handle, self.open_read(self.path, start_offset, end_offset) as range_file_handle:
+			file_size = os.fstat(file_handle.fileno()).st_size
+			range_handle = RangeFile(range_file_handle, end_offset - start_offset)
+			reader = zstandard.ZstdDecompressor(max_window_size=2**31).stream_reader(range_handle)
+			buffer = b''
+			previous_chunk = b''
+			skip_first = start_offset != 0
+			if skip_lines:
+				previous_chunk = FileHandle.skip_lines(reader, skip_lines + (1 if skip_first else 0))
+				# the lines that were skipped go right to the end of the range, so there's nothing left to do
+				if previous_chunk is None:
+					reader.close()
+					return
+				skip_first = False
+			while True:
+				chunk = previous_chunk + reader.read(2**27)
+				previous_chunk = b''
+				if not chunk:
+					break
+				lines = (buffer + chunk).split(FileHandle.newline_encoded)
+				if skip_first:
+					if len(lines) == 1:
+						buffer = b''
+						continue
+					lines = lines[1:]
+					skip_first = False
+
+				for line in lines[:-1]:
+					yield line.decode(), range_handle.bytes_read
+
+				buffer = lines[-1]
+			reader.close()
+			# the whole range was in the middle of one line, which the range where it starts handles
+			if skip_first:
+				return
+
+			if end_offset < file_size:
+				file_handle.seek(end_offset)
+				reader = zstandard.ZstdDecompressor(max_window_size=2**31).stream_reader(file_handle)
+				while True:
+					chunk = reader.read(2**20)
+					if not chunk:
+						break
+					newline_index = chunk.find(FileHandle.newline_encoded)
+					if newline_index != -1:
+						buffer += chunk[:newline_index]
+						break
+					buffer += chunk
+				reader.close()
+			if buffer:
+				yield buffer.decode(), range_handle.bytes_read
+
 	# get either the main write handle or the character filter one, opening a new handle as needed
 	def get_write_handle(self, character_filter=None):
 		if character_filter is None:
@@ -161,16 +482,64 @@ class FileHandle:
 				if not os.path.exists(self.path):
 					os.makedirs(self.path)
 				path = os.path.join(self.path, f"{character_filter}.zst")
-			handle = zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+			file = open(path, 'ab' if self.append else 'wb')
+			handle = zstandard.ZstdCompressor().stream_writer(file)
 			self.handles[character_filter] = handle
+			self.files[character_filter] = file
 		return handle
 
+	# end the current zstd frame in every open file and return how long each file is, so a restart can cut them back
+	# to this point and carry on appending. Files that haven't been written since the last restart keep their old length
+	def checkpoint(self):
+		for character_filter, handle in self.handles.items():
+			handle.flush(zstandard.FLUSH_FRAME)
+			self.checkpoint_offsets[str(character_filter)] = self.files[character_filter].tell()
+		return dict(self.checkpoint_offsets)
+
+	# whether every file in a checkpoint is still there and at least as long as it was when the checkpoint was saved.
+	# If not, the checkpoint can't be restored, since the lines written before it would be lost
+	def matches_checkpoint(self, offsets):
+		for character_filter, offset in offsets.items():
+			path = os.path.join(self.path, f"{character_filter}.zst") if self.is_split else self.path
+			if not os.path.exists(path) or os.stat(path).st_size < offset:
+				return False
+		return True
+
+	# cut the files back to the lengths from a checkpoint and append to them from there. Split files that aren't in the
+	# checkpoint were started after it, so they're removed. Restoring an empty checkpoint clears out a previous attempt
+	def restore(self, offsets):
+		self.checkpoint_offsets = dict(offsets)
+		self.append = True
+		if self.is_split:
+			if not os.path.exists(self.path):
+				return
+			for file in os.listdir(self.path):
+				if not file.endswith(".zst"):
+					continue
+				path = os.path.join(self.path, file)
+				offset = offsets.get(file[:-FileHandle.ext_len])
+				if offset is None:
+					os.remove(path)
+				else:
+					os.truncate(path, offset)
+		elif os.path.exists(self.path):
+			if "1" in offsets:
+				os.truncate(self.path, offsets["1"])
+			else:
+				os.remove(self.path)
+
+	# hash the value into one of the split buckets. This spreads the values evenly, unlike splitting on the first
+	# character where a few letters end up with most of the lines
+	@staticmethod
+	def get_bucket(value, split_buckets):
+		return str(zlib.crc32(value.encode('utf-8', errors='surrogatepass')) % split_buckets)
+
 	# write a line, opening the appropriate handle
 	def write_line(self, line, value=None):
 		if self.is_split:
 			if value is None:
 				raise ValueError(f"{self.path} is split but no value passed")
-			character_filter = value[:1]
+			character_filter = FileHandle.get_bucket(value, self.split_buckets)
 			handle = self.get_write_handle(character_filter)
 		else:
 			handle = self.get_write_handle()
@@ -183,6 +552,236 @@ class FileHandle:
 			handle.close()
 
 
+# keeps a bounded number of zst output files open at once, so splitting by a field with tens of thousands of values
+# doesn't run out of file handles or memory for compressors. Lines for files that aren't open are buffered and written
+# in batches. When too many files are open the least recently used one is closed, which ends its zstd frame. If it's
+# written to again it's reopened in append mode and starts a new frame, which is still a valid zst file
+class WriterPool:
+	newline_encoded = "\n".encode('utf-8')
+
+	def __init__(self, max_open_handles=100, flush_bytes=2**20, max_buffered_bytes=2**29):
+		self.max_open_handles = max_open_handles
+		self.flush_bytes = flush_bytes
+		self.max_buffered_bytes = max_buffered_bytes
+		self.handles = OrderedDict()
+		self.buffers = {}
+		self.buffer_sizes = {}
+		self.buffered_bytes = 0
+		self.opened_paths = set()
+
+	def get_handle(self, path):
+		handle = self.handles.get(path)
+		if handle is not None:
+			self.handles.move_to_end(path)
+			return handle
+		while len(self.handles) >= self.max_open_handles:
+			_, old_handle = self.handles.popitem(last=False)
+			old_handle.close()
+		# the first open truncates anything left over from a previous run, after that append a new frame
+		handle = zstandard.ZstdCompressor().stream_writer(open(path, 'ab' if path in self.opened_paths else 'wb'))
+		self.opened_paths.add(path)
+		self.handles[path] = handle
+		return handle
+
+	def flush_buffer(self, path):
+		lines = self.buffers.pop(path)
+		self.buffered_bytes -= self.buffer_sizes.pop(path)
+		handle = self.get_handle(path)
+		lines.append(b"")
+		handle.write(WriterPool.newline_encoded.join(lines))
+
+	def write_line(self, path, line):
+		encoded_line = line.encode('utf-8')
+		handle = self.handles.get(path)
+		if handle is not None:
+			self.handles.move_to_end(path)
+			handle.write(encoded_line)
+			handle.write(WriterPool.newline_encoded)
+			return
+
+		buffer = self.buffers.get(path)
+		if buffer is None:
+			buffer = []
+			self.buffers[path] = buffer
+			self.buffer_sizes[path] = 0
+		buffer.append(encoded_line)
+		self.buffer_sizes[path] += len(encoded_line) + 1
+		self.buffered_bytes += len(encoded_line) + 1
+		if self.buffer_sizes[path] >= self.flush_bytes:
+			self.flush_buffer(path)
+		elif self.buffered_bytes >= self.max_buffered_bytes:
+			# too much buffered overall, write out the biggest buffers until we're down to half
+			for buffer_path in sorted(self.buffer_sizes, key=self.buffer_sizes.get, reverse=True):
+				self.flush_buffer(buffer_path)
+				if self.buffered_bytes < self.max_buffered_bytes / 2:
+					break
+
+	def count_paths(self):
+		return len(self.opened_paths) + len(self.buffers)
+
+	def close(self):
+		for path in list(self.buffers):
+			self.flush_buffer(path)
+		for handle in self.handles.values():
+			handle.close()
+		self.handles = OrderedDict()
+
+
+# used in direct mode to write the matched lines from the workers straight into the final output files, in the same
+# order as the input files, without writing intermediate files first. Lines for the input file that's currently being
+# written go right into the output, lines for files further ahead wait in memory, and if too much is waiting the
+# biggest waiting file is spilled to the working folder. Each input file ends its own zstd frame in the output, and
+# the output offset after each one is saved so a restart can truncate the output back to the last complete file
+class DirectWriter:
+	def __init__(self, input_files, output_folder, working_folder, field, single_output, max_buffered_bytes=2**29):
+		self.output_folder = output_folder
+		self.working_folder = working_folder
+		self.field = field
+		self.single_output = single_output
+		self.max_buffered_bytes = max_buffered_bytes
+		self.type_paths = defaultdict(list)
+		self.file_types = {}
+		self.file_indexes = {}
+		for file in sorted(input_files, key=lambda item: os.path.split(item.input_path)[1]):
+			self.file_indexes[file.input_path] = len(self.type_paths[file.file_type])
+			self.type_paths[file.file_type].append(file.input_path)
+			self.file_types[file.input_path] = file.file_type
+		self.current_indexes = {}
+		self.output_paths = {}
+		self.handles = {}
+		self.written = {}
+		self.finished = set()
+		self.pending = defaultdict(list)
+		self.pending_sizes = defaultdict(int)
+		self.pending_bytes = 0
+		self.spill_handles = {}
+
+		# files count as done only if every file before them is too, everything after the first gap is redone
+		files_by_path = {file.input_path: file for file in input_files}
+		for file_type, input_paths in self.type_paths.items():
+			current_index = 0
+			output_path, output_offset = None, 0
+			for input_path in input_paths:
+				file = files_by_path[input_path]
+				if not file.complete or file.output_offset is None:
+					break
+				if file.output_path is not None:
+					output_path, output_offset = file.output_path, file.output_offset
+				self.written[input_path] = (file.output_path, file.output_offset)
+				current_index += 1
+			for input_path in input_paths[current_index:]:
+				file = files_by_path[input_path]
+				file.complete, file.bytes_processed, file.lines_processed, file.error_lines, file.lines_matched = False, 0, 0, 0, 0
+				file.output_offset = None
+				if os.path.exists(self.get_spill_path(input_path)):
+					os.remove(self.get_spill_path(input_path))
+			self.current_indexes[file_type] = current_index
+			if output_path is not None and os.path.exists(output_path):
+				log.info(f"Resuming {output_path} at {output_offset:,} bytes")
+				output_handle = open(output_path, 'r+b')
+				output_handle.truncate(output_offset)
+				output_handle.seek(output_offset)
+				self.output_paths[file_type] = output_path
+				self.handles[file_type] = (output_handle, zstandard.ZstdCompressor().stream_writer(output_handle, closefd=False))
+
+	def get_spill_path(self, input_path):
+		return os.path.join(self.working_folder, os.path.split(input_path)[1][:-4] + "_direct.zst")
+
+	# get the output file for a type, on the first write it's named from the value of the first line
+	def get_writer(self, file_type, lines_bytes):
+		handles = self.handles.get(file_type)
+		if handles is None:
+			if self.single_output:
+				observed_case = "output"
+			else:
+				observed_case = json.loads(lines_bytes[:lines_bytes.index(b"\n")])[self.field]
+			output_path = os.path.join(self.output_folder, f"{observed_case}_{FileType.to_str(file_type)}.zst")
+			log.info(f"Writing to file {output_path}")
+			output_handle = open(output_path, 'wb')
+			handles = (output_handle, zstandard.ZstdCompressor().stream_writer(output_handle, closefd=False))
+			self.output_paths[file_type] = output_path
+			self.handles[file_type] = handles
+		return handles[1]
+
+	def is_current(self, input_path):
+		file_type = self.file_types[input_path]
+		return self.file_indexes[input_path] == self.current_indexes[file_type]
+
+	def spill(self, input_path):
+		spill_handle = zstandard.ZstdCompressor().stream_writer(open(self.get_spill_path(input_path), 'wb'))
+		for lines_bytes in self.pending.pop(input_path, []):
+			spill_handle.write(lines_bytes)
+		self.pending_bytes -= self.pending_sizes.pop(input_path, 0)
+		self.spill_handles[input_path] = spill_handle
+
+	# add a batch of newline terminated, utf-8 encoded lines from an input file
+	def write(self, input_path, lines_bytes):
+		if self.is_current(input_path):
+			self.get_writer(self.file_types[input_path], lines_bytes).write(lines_bytes)
+		elif input_path in self.spill_handles:
+			self.spill_handles[input_path].write(lines_bytes)
+		else:
+			self.pending[input_path].append(lines_bytes)
+			self.pending_sizes[input_path] += len(lines_bytes)
+			self.pending_bytes += len(lines_bytes)
+			while self.pending_bytes > self.max_buffered_bytes:
+				self.spill(max(self.pending_sizes, key=self.pending_sizes.get))
+
+	# copy anything waiting for the new current file into the output. The spill file is already compressed, so its
+	# frames are copied as is after ending the frame in the output
+	def catch_up(self, file_type, input_path):
+		spill_handle = self.spill_handles.pop(input_path, None)
+		if spill_handle is not None:
+			spill_handle.close()
+			spill_path = self.get_spill_path(input_path)
+			if os.stat(spill_path).st_size > 0:
+				if file_type not in self.handles:
+					with zstandard.ZstdDecompressor(max_window_size=2**31).stream_reader(open(spill_path, 'rb')) as spill_reader:
+						self.get_writer(file_type, spill_reader.read(2**20))
+				output_handle, writer = self.handles[file_type]
+				writer.flush(zstandard.FLUSH_FRAME)
+				with open(spill_path, 'rb') as spill_file:
+					shutil.copyfileobj(spill_file, output_handle, 2**24)
+			os.remove(spill_path)
+		for lines_bytes in self.pending.pop(input_path, []):
+			self.get_writer(file_type, lines_bytes).write(lines_bytes)
+		self.pending_bytes -= self.pending_sizes.pop(input_path, 0)
+
+	# called when a worker finishes an input file, writes out any files that are now next in line
+	def finish(self, input_path):
+		self.finished.add(input_path)
+		file_type = self.file_types[input_path]
+		input_paths = self.type_paths[file_type]
+		while self.current_indexes[file_type] < len(input_paths) and input_paths[self.current_indexes[file_type]] in self.finished:
+			current_path = input_paths[self.current_indexes[file_type]]
+			self.catch_up(file_type, current_path)
+			handles = self.handles.get(file_type)
+			if handles is not None:
+				output_handle, writer = handles
+				writer.flush(zstandard.FLUSH_FRAME)
+				output_handle.flush()
+				self.written[current_path] = (self.output_paths[file_type], output_handle.tell())
+			else:
+				self.written[current_path] = (None, 0)
+			self.current_indexes[file_type] += 1
+			if self.current_indexes[file_type] < len(input_paths):
+				self.catch_up(file_type, input_paths[self.current_indexes[file_type]])
+
+	# copy the output file and offset into the status of each file that's been written
+	def update_files(self, input_files):
+		for file in input_files:
+			written = self.written.get(file.input_path)
+			if written is not None:
+				file.output_path, file.output_offset = written
+
+	def close(self):
+		for spill_handle in self.spill_handles.values():
+			spill_handle.close()
+		for output_handle, writer in self.handles.values():
+			writer.close()
+			output_handle.close()
+
+
 # used for calculating running average of read speed
 class Queue:
 	def __init__(self, max_size):
@@ -205,7 +804,9 @@ def save_file_list(input_files, working_folder, status_json, arg_string, script_
 		os.makedirs(working_folder)
 	simple_file_list = []
 	for file in input_files:
-		simple_file_list.append([file.input_path, file.output_path, file.complete, file.lines_processed, file.error_lines, file.lines_matched])
+		simple_file_list.append([
+			file.input_path, file.output_path, file.complete, file.lines_processed, file.error_lines, file.lines_matched, file.output_offset,
+			file.start_offset, file.end_offset])
 	if completed_prefixes is None:
 		completed_prefixes = []
 	else:
@@ -228,7 +829,7 @@ def load_file_list(status_json):
 			input_files = []
 			for simple_file in output_dict["files"]:
 				input_files.append(
-					FileConfig(simple_file[0], simple_file[1], simple_file[2], simple_file[3], simple_file[4], simple_file[5])
+					FileConfig(*simple_file)
 				)
 			completed_prefixes = set()
 			for prefix in output_dict["completed_prefixes"]:
@@ -238,20 +839,173 @@ def load_file_list(status_json):
 		return None, None, None, set()
 
 
-# base of each separate process. Loads a file, iterates through lines and writes out
-# the ones where the `field` of the object matches `value`. Also passes status
-# information back to the parent via a queue
-def process_file(file, queue, field, values, partial, regex, split_intermediate):
-	queue.put(file)
-	input_handle = FileHandle(file.input_path)
-	output_handle = FileHandle(file.output_path, is_split=split_intermediate)
+# the number of matched lines to send to the parent at once in direct mode
+DIRECT_BATCH_LINES = 10000
+# how often the workers update their progress counters, and how often the parent logs them
+PROGRESS_LINES = 100000
+PROGRESS_SECONDS = 5
+# how often the workers save how far they are through a file, so a restart can pick up from there. Each checkpoint ends
+# a zstd frame in the output files, so this shouldn't be too short
+CHECKPOINT_SECONDS = 10 * 60
+
+# the progress of every file is kept in a shared array, with a slot of these fields for each file. Each worker only
+# writes to the slot of the file it's working on and the parent only reads, so there's no need for a lock
+COUNTER_FIELDS = 4
+LINES_PROCESSED, BYTES_PROCESSED, ERROR_LINES, LINES_MATCHED = range(COUNTER_FIELDS)
+shared_counters = None
+shared_values = None
+
+
+# runs at the start of each worker process to keep a reference to the shared counters, and the shared values if they
+# were put in shared memory
+def init_worker(counters, values=None):
+	global shared_counters, shared_values
+	shared_counters = counters
+	shared_values = values
+
+
+def get_value_hash(value_bytes):
+	return int.from_bytes(hashlib.blake2b(value_bytes, digest_size=8).digest(), 'little', signed=True)
+
+
+# a set of values kept once in shared memory for all the workers, instead of a python set pickled and copied into every
+# process. The values are sorted by a 64 bit hash, with their text in one block of bytes and the offset of each one in
+# another. Checking a value is a binary search for its hash and then comparing the text, so a hash collision can't cause
+# a false match. It can only be sent to the workers when they start, with the pool initializer
+class SharedValues:
+	def __init__(self, values):
+		entries = sorted((get_value_hash(value_bytes), value_bytes) for value_bytes in set(value.encode('utf-8', errors='surrogatepass') for value in values))
+		self.count = len(entries)
+		self.hashes = multiprocessing.RawArray('q', [value_hash for value_hash, value_bytes in entries])
+		self.offsets = multiprocessing.RawArray('q', self.count + 1)
+		text = b"".join(value_bytes for value_hash, value_bytes in entries)
+		self.text = multiprocessing.RawArray('B', len(text))
+		memoryview(self.text).cast('B')[:] = text
+		offset = 0
+		for index, (value_hash, value_bytes) in enumerate(entries):
+			offset += len(value_bytes)
+			self.offsets[index + 1] = offset
+		self.views = None
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state["views"] = None
+		return state
+
+	def __len__(self):
+		return self.count
+
+	def __contains__(self, value):
+		if self.views is None:
+			self.views = (
+				memoryview(self.hashes).cast('B').cast('q'),
+				memoryview(self.offsets).cast('B').cast('q'),
+				memoryview(self.text).cast('B'))
+		hashes, offsets, text = self.views
+		# json can decode an escaped lone surrogate into a field, which plain utf-8 can't encode
+		value_bytes = value.encode('utf-8', errors='surrogatepass')
+		value_hash = get_value_hash(value_bytes)
+		index = bisect.bisect_left(hashes, value_hash)
+		while index < self.count and hashes[index] == value_hash:
+			if text[offsets[index]:offsets[index + 1]] == value_bytes:
+				return True
+			index += 1
+		return False
+
+
+def update_counters(counters, file):
+	offset = file.index * COUNTER_FIELDS
+	counters[offset + LINES_PROCESSED] = file.lines_processed
+	counters[offset + BYTES_PROCESSED] = file.bytes_processed
+	counters[offset + ERROR_LINES] = file.error_lines
+	counters[offset + LINES_MATCHED] = file.lines_matched
+
+
+def sum_counter(counters, field):
+	return sum(counters[field::COUNTER_FIELDS])
+
+
+# the checkpoint for a file is saved next to its output
+def get_checkpoint_path(file):
+	return f"{file.output_path}.checkpoint"
+
+
+def load_checkpoint(file):
+	checkpoint_path = get_checkpoint_path(file)
+	if not os.path.exists(checkpoint_path):
+		return None
+	with open(checkpoint_path, 'r') as checkpoint_file:
+		return json.load(checkpoint_file)
+
+
+# write to a temp file and rename it over the old one, so a crash in the middle doesn't leave a broken checkpoint
+def save_checkpoint(file, output_offsets):
+	checkpoint_path = get_checkpoint_path(file)
+	with open(checkpoint_path + ".temp", 'w') as checkpoint_file:
+		json.dump({
+			"lines_processed": file.lines_processed,
+			"bytes_processed": file.bytes_processed,
+			"error_lines": file.error_lines,
+			"lines_matched": file.lines_matched,
+			"output_offsets": output_offsets,
+		}, checkpoint_file)
+	os.replace(checkpoint_path + ".temp", checkpoint_path)
+
+
+def remove_checkpoint(file):
+	checkpoint_path = get_checkpoint_path(file)
+	if os.path.exists(checkpoint_path):
+		os.remove(checkpoint_path)
+
 
+# base of each separate process. Loads a file, iterates through lines and writes out
+# the ones where the `field` of the object matches `value`. Progress goes into the shared counters and the finished
+# file is returned to the parent. If the output is split by value, the value is written in front of
+# each line, separated by a tab, so the combine step doesn't have to parse the json again to find it. In direct mode
+# the matched lines are sent back to the parent in batches through the queue instead of written to a file, followed
+# by a batch of None once the file is done. Every CHECKPOINT_SECONDS the output files are flushed and the position is
+# saved, and if the file was interrupted before, it starts again from its last checkpoint. Direct mode doesn't save
+# checkpoints, since the parent rewrites the whole file. Takes a single tuple so it can be used with imap_unordered
+def process_file(arguments):
+	file, queue, field, values, partial, regex, split_intermediate, split_buckets, split_by_value, direct, read_ahead, use_mmap = arguments
+	input_handle = FileHandle(file.input_path, read_ahead=read_ahead, use_mmap=use_mmap)
+	output_handle = FileHandle(file.output_path, is_split=split_intermediate, split_buckets=split_buckets)
+	direct_lines = []
+
+	if shared_values is not None:
+		values = shared_values
 	value = None
 	if len(values) == 1:
 		value = min(values)
 
 	try:
-		for line, file_bytes_processed in input_handle.yield_lines():
+		skip_lines = 0
+		if not direct:
+			checkpoint = load_checkpoint(file)
+			if checkpoint is not None and not output_handle.matches_checkpoint(checkpoint["output_offsets"]):
+				log.warning(f"Output for {file.input_path} is missing or shorter than its checkpoint, starting from the beginning")
+				checkpoint = None
+			if checkpoint is not None:
+				skip_lines = checkpoint["lines_processed"]
+				file.lines_processed = skip_lines
+				file.bytes_processed = checkpoint["bytes_processed"]
+				file.error_lines = checkpoint["error_lines"]
+				file.lines_matched = checkpoint["lines_matched"]
+				output_handle.restore(checkpoint["output_offsets"])
+			else:
+				file.lines_processed = 0
+				file.bytes_processed = 0
+				file.error_lines = 0
+				file.lines_matched = 0
+				output_handle.restore({})
+			update_counters(shared_counters, file)
+		last_checkpoint_time = time.time()
+
+		if file.start_offset is not None:
+			lines = input_handle.yield_range_lines(file.start_offset, file.end_offset, skip_lines)
+		else:
+			lines = input_handle.yield_lines(skip_lines=skip_lines)
+		for line, file_bytes_processed in lines:
 			try:
 				obj = json.loads(line)
 				matched = False
@@ -274,21 +1028,85 @@ def process_file(file, queue, field, values, partial, regex, split_intermediate)
 						matched = True
 
 				if matched:
-					output_handle.write_line(line, observed)
+					if direct:
+						direct_lines.append(line)
+						if len(direct_lines) >= DIRECT_BATCH_LINES:
+							queue.put((file.input_path, ("\n".join(direct_lines) + "\n").encode('utf-8')))
+							direct_lines = []
+					elif split_by_value:
+						output_handle.write_line(json.dumps(obj[field]) + "\t" + line, observed)
+					else:
+						output_handle.write_line(line, observed)
 					file.lines_matched += 1
 			except (KeyError, json.JSONDecodeError, AttributeError) as err:
 				file.error_lines += 1
 			file.lines_processed += 1
-			if file.lines_processed % 1000000 == 0:
+			if file.lines_processed % PROGRESS_LINES == 0:
 				file.bytes_processed = file_bytes_processed
-				queue.put(file)
-
+				update_counters(shared_counters, file)
+				if not direct and time.time() - last_checkpoint_time > CHECKPOINT_SECONDS:
+					save_checkpoint(file, output_handle.checkpoint())
+					last_checkpoint_time = time.time()
+
+		if direct:
+			if direct_lines:
+				queue.put((file.input_path, ("\n".join(direct_lines) + "\n").encode('utf-8')))
+			queue.put((file.input_path, None))
 		output_handle.close()
+		remove_checkpoint(file)
 		file.complete = True
 		file.bytes_processed = file.file_size
 	except Exception as err:
 		file.error_message = str(err)
-	queue.put(file)
+	update_counters(shared_counters, file)
+	return file
+
+
+# combine one bucket of the intermediate files into the output files. The bucket is the name of the split file to read,
+# which has every line whose value hashes to it. Each value is in exactly one bucket, so no two buckets write to the same
+# output file and they can all run at once. Inside the bucket the writer pool groups the lines by value while keeping memory and
+# open files bounded, and since the intermediate files are read in order the lines for each value stay in the same
+# order as the input files. Takes a single tuple so it can be used with imap_unordered
+def combine_bucket(arguments):
+	bucket, type_handles, output_folder, max_open_handles, max_buffered_bytes = arguments
+	output_paths = {}
+	output_lines = 0
+	for file_type, input_handles in type_handles.items():
+		writer_pool = WriterPool(max_open_handles=max_open_handles, max_buffered_bytes=max_buffered_bytes)
+		for input_handle in input_handles:
+			for line, file_bytes_processed in input_handle.yield_lines(character_filter=bucket):
+				value_string, line = line.split("\t", 1)
+				observed_case = json.loads(value_string)
+				observed = observed_case.lower()
+				output_lines += 1
+				output_file_path = output_paths.get((file_type, observed))
+				if output_file_path is None:
+					output_file_path = os.path.join(output_folder, f"{observed_case}_{FileType.to_str(file_type)}.zst")
+					output_paths[(file_type, observed)] = output_file_path
+
+				writer_pool.write_line(output_file_path, line)
+		writer_pool.close()
+	return bucket, output_lines, len(output_paths)
+
+
+# when all the intermediate files for a type go into the same output file, the compressed intermediate files are just
+# copied one after the other. A zst file can be made of any number of frames, so this is the same as decompressing and
+# recompressing them, but runs at the speed of the disk
+def concatenate_files(input_handles, output_folder, file_type, field, single_output):
+	if single_output:
+		observed_case = "output"
+	else:
+		lines = input_handles[0].yield_lines()
+		line, file_bytes_processed = next(lines)
+		lines.close()
+		observed_case = json.loads(line)[field]
+	output_file_path = os.path.join(output_folder, f"{observed_case}_{FileType.to_str(file_type)}.zst")
+	log.info(f"Writing to file {output_file_path}")
+	with open(output_file_path, 'wb') as output_handle:
+		for input_handle in input_handles:
+			with open(input_handle.path, 'rb') as input_file_handle:
+				shutil.copyfileobj(input_file_handle, output_handle, 2**24)
+	return output_file_path
 
 
 if __name__ == '__main__':
@@ -303,12 +1121,46 @@ if __name__ == '__main__':
 	parser.add_argument("--file_filter", help="Regex filenames have to match to be processed", default="^RC_|^RS_")
 	parser.add_argument(
 		"--split_intermediate",
-		help="Split the intermediate files by the first letter of the matched field, use if the filter will result in a large number of separate files",
+		help="Split the intermediate files into buckets by a hash of the matched field and combine the buckets in parallel. "
+		"This is always on when there's more than one output file",
 		action="store_true")
+	parser.add_argument(
+		"--split_buckets",
+		help="The number of buckets to split the intermediate files into with --split_intermediate. Each process keeps a file open for every bucket while filtering",
+		default=64, type=int)
+	parser.add_argument(
+		"--max_open_handles",
+		help="The most output files to keep open at once while combining. Lines for the rest are buffered in memory, use a lower number if there are a lot of output files and memory runs low",
+		default=100, type=int)
 	parser.add_argument(
 		"--single_output",
 		help="Output a single combined file instead of splitting by the search term",
 		action="store_true")
+	parser.add_argument(
+		"--direct",
+		help="Send the matched lines straight to the final output files instead of writing intermediate files and combining them after. "
+		"Only works if there's one output file for each type, so with a single value or with --single_output, --partial or --regex",
+		action="store_true")
+	parser.add_argument(
+		"--split_size",
+		help="Split input files bigger than this many bytes into parts that can be processed at the same time. Only works for files "
+		"written in multiple zstd frames, files in one frame are processed whole. Set to 0 to turn off",
+		default=2**30, type=int)
+	parser.add_argument(
+		"--read_ahead",
+		help="How many reads of each input file to keep running in the background while it's decompressed. This helps a lot when "
+		"the files are on a network share. Set to 0 to turn off",
+		default=4, type=int)
+	parser.add_argument(
+		"--mmap",
+		help="Memory map the input files and decompress straight from them instead of reading them through a file handle. "
+		"Usually faster when the files are on a local disk. Overrides --read_ahead",
+		action="store_true")
+	parser.add_argument(
+		"--shared_values",
+		help="Keep the values in shared memory for all the processes instead of giving each one its own copy. Use with a very large "
+		"--value_list, like millions of authors or ids. Only for exact matches, ignored with --partial or --regex",
+		action="store_true")
 	parser.add_argument(
 		"--error_rate", help=
 		"Percentage as an integer from 0 to 100 of the lines where the field can be missing. For the subreddit field especially, "
@@ -325,7 +1177,6 @@ if __name__ == '__main__':
 	script_type = "split"
 
 	args = parser.parse_args()
-	arg_string = f"{args.field}:{(args.value if args.value else args.value_list)}"
 
 	if args.debug:
 		log.setLevel(logging.DEBUG)
@@ -340,6 +1191,10 @@ if __name__ == '__main__':
 		log.info("The partial, regex and single_output flags are not compatible with the split_intermediate flag")
 		sys.exit(1)
 
+	if args.direct and args.split_intermediate:
+		log.info("The direct flag is not compatible with the split_intermediate flag")
+		sys.exit(1)
+
 	values = set()
 	if args.value_list:
 		log.info(f"Reading {args.value_list} for values to compare")
@@ -375,11 +1230,40 @@ if __name__ == '__main__':
 		else:
 			log.info(f"Checking if any of {val_string} exactly match field {args.field}")
 
-	if args.partial or args.regex or args.single_output:
+	single_output = args.partial or args.regex or args.single_output
+	if single_output:
 		log.info(f"Outputing to a single combined file")
+	if args.direct and not single_output and len(values) != 1:
+		log.info("The direct flag needs a single output file, use it with a single value or with --single_output, --partial or --regex")
+		sys.exit(1)
+
+	# with more than one output file, the intermediate files are split into buckets by a hash of the value as they're
+	# written, so each combine task only has to read the lines for its own bucket
+	if not single_output and len(values) > 1 and not args.split_intermediate:
+		log.info(f"Splitting the intermediate files into {args.split_buckets} buckets since there's more than one output file")
+		args.split_intermediate = True
+	# if there's only one output file for each type, the intermediate files can be concatenated into it as is
+	concatenate = not args.split_intermediate and (single_output or len(values) == 1)
+
+	arg_string = f"{args.field}:{(args.value if args.value else args.value_list)}"
+	if args.split_intermediate:
+		arg_string += f":{args.split_buckets}"
+	# direct mode doesn't checkpoint and writes the files differently, so it can't pick up a run started without it
+	if args.direct:
+		arg_string += ":direct"
+
+	# direct mode writes the output in input file order, so it needs whole files
+	split_size = 0 if args.direct else args.split_size
 
 	multiprocessing.set_start_method('spawn')
-	queue = multiprocessing.Manager().Queue()
+	shared_values = None
+	if args.shared_values and not args.partial and not args.regex and len(values) > 1:
+		log.info(f"Putting {len(values):,} values in shared memory")
+		shared_values = SharedValues(values)
+	direct_queue = None
+	if args.direct:
+		# bounded, so the workers wait if the output can't keep up instead of filling up memory
+		direct_queue = multiprocessing.Manager().Queue(args.processes * 20)
 	status_json = os.path.join(args.working, "status.json")
 	input_files, saved_arg_string, saved_type, completed_prefixes = load_file_list(status_json)
 	if saved_arg_string and saved_arg_string != arg_string:
@@ -402,15 +1286,38 @@ if __name__ == '__main__':
 						output_extension = ""
 					else:
 						output_extension = ".zst"
-					output_path = os.path.join(args.working, f"{file_name[:-4]}{output_extension}")
-					input_files.append(FileConfig(input_path, output_path=output_path))
+					file_ranges = None
+					if split_size and os.stat(input_path).st_size > split_size:
+						try:
+							file_ranges = get_file_ranges(input_path, split_size)
+						except ValueError as err:
+							# read it as one file instead, which reports it as errored if it really is bad
+							log.warning(f"Unable to split {input_path}: {err}")
+					if file_ranges is None:
+						output_path = os.path.join(args.working, f"{file_name[:-4]}{output_extension}")
+						input_files.append(FileConfig(input_path, output_path=output_path))
+					else:
+						log.info(f"Splitting {input_path} into {len(file_ranges)} parts")
+						for part, (start_offset, end_offset) in enumerate(file_ranges):
+							output_path = os.path.join(args.working, f"{file_name[:-4]}_{part:04}{output_extension}")
+							input_files.append(FileConfig(input_path, output_path=output_path, start_offset=start_offset, end_offset=end_offset))
 
 		save_file_list(input_files, args.working, status_json, arg_string, script_type)
 	else:
 		log.info(f"Existing input file was read, if this is not correct you should delete the {args.working} folder and run this script again")
 
+	direct_writer = None
+	if args.direct:
+		if args.output and not os.path.exists(args.output):
+			os.makedirs(args.output)
+		direct_writer = DirectWriter(input_files, args.output, args.working, args.field, single_output)
+
 	files_processed, total_bytes, total_bytes_processed, total_lines_processed, total_lines_matched, total_lines_errored = 0, 0, 0, 0, 0, 0
 	files_to_process = []
+	counters = multiprocessing.Array('q', len(input_files) * COUNTER_FIELDS, lock=False)
+	for i, file in enumerate(input_files):
+		file.index = i
+		update_counters(counters, file)
 	# calculate the total file size for progress reports, build a list of incomplete files to process
 	# do this largest to smallest by file size so that we aren't processing a few really big files with only a few threads at the end
 	for file in sorted(input_files, key=lambda item: item.file_size, reverse=True):
@@ -423,6 +1330,9 @@ if __name__ == '__main__':
 			total_lines_errored += file.error_lines
 		else:
 			files_to_process.append(file)
+	# in direct mode process the files in order, so not too many lines are waiting on earlier files to be written
+	if args.direct:
+		files_to_process.sort(key=lambda item: (os.path.split(item.input_path)[1][3:], item.input_path))
 
 	log.info(f"Processed {files_processed} of {len(input_files)} files with {(total_bytes_processed / (2**30)):.2f} of {(total_bytes / (2**30)):.2f} gigabytes")
 
@@ -433,44 +1343,63 @@ if __name__ == '__main__':
 		speed_queue = Queue(40)
 		for file in files_to_process:
 			log.info(f"Processing file: {file.input_path}")
+		files_errored = 0
+		last_log_time = start_time
 		# start the workers
-		with multiprocessing.Pool(processes=min(args.processes, len(files_to_process))) as pool:
-			workers = pool.starmap_async(process_file, [(file, queue, args.field, values, args.partial, args.regex, args.split_intermediate) for file in files_to_process], chunksize=1, error_callback=log.info)
-			while not workers.ready() or not queue.empty():
-				# loop until the workers are all done, pulling in status messages as they are sent
-				file_update = queue.get()
-				if file_update.error_message is not None:
-					log.warning(f"File failed {file_update.input_path}: {file_update.error_message}")
-
-				# this is the workers telling us they are starting a new file, print the debug message but nothing else
-				if file_update.lines_processed == 0:
-					log.debug(f"Starting file: {file_update.input_path} : {file_update.file_size:,}")
-					continue
-
-				# I'm going to assume that the list of files is short enough that it's no
-				# big deal to just iterate each time since that saves a bunch of work
-				total_lines_processed, total_lines_matched, total_bytes_processed, total_lines_errored, files_processed, files_errored, i = 0, 0, 0, 0, 0, 0, 0
-				for file in input_files:
-					if file.input_path == file_update.input_path:
-						input_files[i] = file_update
-						file = file_update
-					total_lines_processed += file.lines_processed
-					total_lines_matched += file.lines_matched
-					total_bytes_processed += file.bytes_processed
-					total_lines_errored += file.error_lines
-					files_processed += 1 if file.complete or file.error_message is not None else 0
-					files_errored += 1 if file.error_message is not None else 0
-					i += 1
-				if file_update.complete or file_update.error_message is not None:
+		with multiprocessing.Pool(processes=min(args.processes, len(files_to_process)), initializer=init_worker, initargs=(counters, shared_values)) as pool:
+			workers = pool.imap_unordered(process_file, [
+				(file, direct_queue, args.field, values if shared_values is None else None, args.partial, args.regex, args.split_intermediate, args.split_buckets, not concatenate, args.direct, args.read_ahead,
+					args.mmap)
+				for file in files_to_process])
+			files_remaining = len(files_to_process)
+			while files_remaining > 0 or (direct_queue is not None and not direct_queue.empty()):
+				# loop until the workers are all done. Finished files come back from the pool, everything else is read from the counters
+				result_timeout = PROGRESS_SECONDS
+				if direct_writer is not None:
+					# in direct mode the workers are waiting on their lines to be written, so do that first
+					result_timeout = 0
+					try:
+						input_path, lines_bytes = direct_queue.get(timeout=1)
+						if lines_bytes is None:
+							direct_writer.finish(input_path)
+						else:
+							direct_writer.write(input_path, lines_bytes)
+					except queue.Empty:
+						pass
+
+				file_update = None
+				if files_remaining > 0:
+					try:
+						file_update = workers.next(timeout=result_timeout)
+					except multiprocessing.TimeoutError:
+						pass
+				if file_update is not None:
+					files_remaining -= 1
+					input_files[file_update.index] = file_update
+					if file_update.error_message is not None:
+						log.warning(f"File failed {file_update.input_path}: {file_update.error_message}")
+						files_errored += 1
+					else:
+						log.debug(f"Finished file: {file_update.input_path} : {file_update.file_size:,}")
+					files_processed += 1
+					if direct_writer is not None:
+						direct_writer.update_files(input_files)
 					save_file_list(input_files, args.working, status_json, arg_string, script_type)
-					log.debug(f"Finished file: {file_update.input_path} : {file_update.file_size:,}")
+
 				current_time = time.time()
+				if current_time - last_log_time < PROGRESS_SECONDS:
+					continue
+				last_log_time = current_time
+				total_lines_processed = sum_counter(counters, LINES_PROCESSED)
+				total_lines_matched = sum_counter(counters, LINES_MATCHED)
+				total_bytes_processed = sum_counter(counters, BYTES_PROCESSED)
+				total_lines_errored = sum_counter(counters, ERROR_LINES)
 				progress_queue.put([current_time, total_lines_processed, total_bytes_processed])
 
 				first_time, first_lines, first_bytes = progress_queue.peek()
 				bytes_per_second = int((total_bytes_processed - first_bytes)/(current_time - first_time))
 				speed_queue.put(bytes_per_second)
-				seconds_left = int((total_bytes - total_bytes_processed) / int(sum(speed_queue.list) / len(speed_queue.list)))
+				seconds_left = int((total_bytes - total_bytes_processed) / max(int(sum(speed_queue.list) / len(speed_queue.list)), 1))
 				minutes_left = int(seconds_left / 60)
 				hours_left = int(minutes_left / 60)
 				days_left = int(hours_left / 24)
@@ -481,8 +1410,28 @@ if __name__ == '__main__':
 					f"{files_processed}({files_errored})/{len(input_files)} files : "
 					f"{(str(days_left) + 'd ' if days_left > 0 else '')}{hours_left - (days_left * 24)}:{minutes_left - (hours_left * 60):02}:{seconds_left - (minutes_left * 60):02} remaining")
 
+		total_lines_processed = sum_counter(counters, LINES_PROCESSED)
+		total_lines_matched = sum_counter(counters, LINES_MATCHED)
+		total_bytes_processed = sum_counter(counters, BYTES_PROCESSED)
+		total_lines_errored = sum_counter(counters, ERROR_LINES)
+
 	log.info(f"{total_lines_processed:,}, {total_lines_errored} errored : {(total_bytes_processed / (2**30)):.2f} gb, {(total_bytes_processed / total_bytes) * 100:.0f}% : {files_processed}/{len(input_files)}")
 
+	if direct_writer is not None:
+		direct_writer.close()
+		count_incomplete = 0
+		for file in input_files:
+			if file.input_path not in direct_writer.written:
+				log.info(f"File {file.input_path} was not written to the output, {'errored ' + file.error_message if file.error_message is not None else 'it or an earlier file is not complete'}")
+				count_incomplete += 1
+			elif file.error_lines > file.lines_processed * (args.error_rate * 0.01):
+				log.info(f"File {file.input_path} has {file.error_lines:,} errored lines out of {file.lines_processed:,}, which is above the limit of {args.error_rate}%")
+		if count_incomplete > 0:
+			log.info(f"{count_incomplete} files were not written, run again to finish them")
+		else:
+			log.info(f"Wrote {total_lines_matched:,} lines to {len(direct_writer.output_paths)} output files")
+		sys.exit()
+
 	type_handles = defaultdict(list)
 	prefixes = set()
 	count_incomplete = 0
@@ -502,9 +1451,9 @@ if __name__ == '__main__':
 					f"{(file.error_lines / file.lines_processed) * (args.error_rate * 0.01):.2f}% which is above the limit of {args.error_rate}%")
 				count_incomplete += 1
 			elif file.output_path is not None and os.path.exists(file.output_path):
-				input_handle = FileHandle(file.output_path, is_split=args.split_intermediate)
+				input_handle = FileHandle(file.output_path, is_split=args.split_intermediate, read_ahead=args.read_ahead, use_mmap=args.mmap)
 				for path in input_handle.get_paths():
-					prefixes.add(path[-FileHandle.ext_len - 1:-FileHandle.ext_len])
+					prefixes.add(os.path.split(path)[1][:-FileHandle.ext_len])
 					count_intermediate_files += 1
 				type_handles[file.file_type].append(input_handle)
 
@@ -518,80 +1467,34 @@ if __name__ == '__main__':
 		if completed_prefix in prefixes:
 			prefixes.remove(completed_prefix)
 
+	if args.output and not os.path.exists(args.output):
+		os.makedirs(args.output)
 	output_lines = 0
-	output_handles = {}
-	files_combined = 0
-	if values:
-		split = True
-	else:
-		split = False
-	if args.split_intermediate:
-		for prefix in sorted(prefixes):
-			log.info(f"From {files_combined}/{count_intermediate_files} files to {len(output_handles):,} output handles : {output_lines:,}/{total_lines_matched:,} lines")
-			for file_type, input_handles in type_handles.items():
-				for input_handle in input_handles:
-					has_lines = False
-					for line, file_bytes_processed in input_handle.yield_lines(character_filter=prefix):
-						if not has_lines:
-							has_lines = True
-							files_combined += 1
-						output_lines += 1
-						obj = json.loads(line)
-						observed_case = obj[args.field]
-						observed = observed_case.lower()
-						if observed not in output_handles:
-							if args.output:
-								if not os.path.exists(args.output):
-									os.makedirs(args.output)
-								output_file_path = os.path.join(args.output, f"{observed_case}_{FileType.to_str(file_type)}.zst")
-							else:
-								output_file_path = f"{observed_case}_{FileType.to_str(file_type)}.zst"
-							log.debug(f"Writing to file {output_file_path}")
-							output_handle = FileHandle(output_file_path)
-							output_handles[observed] = output_handle
-						else:
-							output_handle = output_handles[observed]
-
-						output_handle.write_line(line)
-						if output_lines % 1000000 == 0:
-							log.info(f"From {files_combined}/{count_intermediate_files} files to {len(output_handles):,} output handles : {output_lines:,}/{total_lines_matched:,} lines : {input_handle.path} / {prefix}")
-				for handle in output_handles.values():
-					handle.close()
-				output_handles = {}
-			completed_prefixes.add(prefix)
-			save_file_list(input_files, args.working, status_json, arg_string, script_type, completed_prefixes)
-
-	else:
-		log.info(f"From {files_combined}/{count_intermediate_files} files to {len(output_handles):,} output handles : {output_lines:,}/{total_lines_matched:,} lines")
+	output_files = 0
+	if concatenate:
 		for file_type, input_handles in type_handles.items():
-			for input_handle in input_handles:
-				files_combined += 1
-				for line, file_bytes_processed in input_handle.yield_lines():
-					output_lines += 1
-					obj = json.loads(line)
-					if args.partial or args.regex or args.single_output:
-						observed_case = "output"
-					else:
-						observed_case = obj[args.field]
-					observed = observed_case.lower()
-					if observed not in output_handles:
-						if args.output:
-							if not os.path.exists(args.output):
-								os.makedirs(args.output)
-							output_file_path = os.path.join(args.output, f"{observed_case}_{FileType.to_str(file_type)}.zst")
-						else:
-							output_file_path = f"{observed_case}_{FileType.to_str(file_type)}.zst"
-						log.debug(f"Writing to file {output_file_path}")
-						output_handle = FileHandle(output_file_path)
-						output_handles[observed] = output_handle
-					else:
-						output_handle = output_handles[observed]
+			concatenate_files(input_handles, args.output, file_type, args.field, single_output)
+			output_files += 1
+		output_lines = total_lines_matched
 
-					output_handle.write_line(line)
-					if output_lines % 1000000 == 0:
-						log.info(f"From {files_combined}/{count_intermediate_files} files to {len(output_handles):,} output handles : {output_lines:,}/{total_lines_matched:,} lines : {input_handle.path}")
-			for handle in output_handles.values():
-				handle.close()
-			output_handles = {}
-
-	log.info(f"From {files_combined}/{count_intermediate_files} files to {len(output_handles):,} output handles : {output_lines:,}/{total_lines_matched:,} lines")
+	else:
+		# each combine task is a bucket of values, which is one of the split files
+		buckets = sorted(prefixes)
+
+		log.info(f"Combining {count_intermediate_files} files in {len(buckets)} buckets with {args.processes} processes")
+		buckets_combined = 0
+		# split the memory budget for buffered lines between the processes
+		max_buffered_bytes = 2**29 // args.processes
+		with multiprocessing.Pool(processes=min(args.processes, max(len(buckets), 1))) as pool:
+			bucket_arguments = [
+				(bucket, type_handles, args.output, args.max_open_handles, max_buffered_bytes)
+				for bucket in buckets]
+			for bucket, bucket_lines, bucket_files in pool.imap_unordered(combine_bucket, bucket_arguments):
+				output_lines += bucket_lines
+				output_files += bucket_files
+				buckets_combined += 1
+				completed_prefixes.add(bucket)
+				save_file_list(input_files, args.working, status_json, arg_string, script_type, completed_prefixes)
+				log.info(f"Combined bucket {bucket}, {buckets_combined}/{len(buckets)} buckets to {output_files:,} output files : {output_lines:,}/{total_lines_matched:,} lines")
+
+	log.info(f"From {count_intermediate_files} files to {output_files:,} output files : {output_lines:,}/{total_lines_matched:,} lines")
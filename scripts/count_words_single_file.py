@@ -1,9 +1,14 @@
-# this is an example of loading and iterating over a single file, doing some processing along the way to export a resulting csv
+# this is an example of loading and iterating over a single file, or all the files in a folder, doing some processing along the way to export a resulting csv
 
 import zstandard
 import os
+import sys
 import json
-from collections import defaultdict
+import re
+import heapq
+import calendar
+import time
+import multiprocessing
 from datetime import datetime
 import logging.handlers
 
@@ -46,78 +51,252 @@ def read_lines_zst(file_name):
 		reader.close()
 
 
+# words are runs of letters, numbers and underscores, phrases are split up the same way so "diamond hands" is two words
+word_regex = re.compile(r"\w+")
+
+
+# builds a function that takes the lowercase text of a comment and returns the index of every phrase that's in it.
+# With whole_words, the text is split into words and each run of words as long as a phrase is looked up in a dict, so
+# "sell" doesn't match "seller" and the time doesn't go up with the number of phrases. Otherwise a single regex checks
+# whether any of the phrases are in the text at all before checking them one at a time, since most comments won't
+# have any of them
+def build_matcher(phrases, whole_words):
+	if whole_words:
+		phrase_indexes = {}
+		for index, phrase in enumerate(phrases):
+			words = word_regex.findall(phrase.lower())
+			if len(words):
+				phrase_indexes.setdefault(" ".join(words), []).append(index)
+		lengths = sorted(set(phrase.count(" ") + 1 for phrase in phrase_indexes))
+
+		def match(text):
+			words = word_regex.findall(text)
+			found = set()
+			for length in lengths:
+				for start in range(len(words) - length + 1):
+					indexes = phrase_indexes.get(words[start] if length == 1 else " ".join(words[start:start + length]))
+					if indexes is not None:
+						found.update(indexes)
+			return found
+
+	else:
+		lower_phrases = [phrase.lower() for phrase in phrases]
+		any_phrase_regex = re.compile("|".join(re.escape(phrase) for phrase in lower_phrases))
+
+		def match(text):
+			if any_phrase_regex.search(text) is None:
+				return ()
+			return [index for index, phrase in enumerate(lower_phrases) if phrase in text]
+
+	return match
+
+
+# comments have a body, submissions have a title and selftext
+def get_text(obj):
+	if 'body' in obj:
+		return obj['body']
+	return obj['title'] + "\n" + (obj.get('selftext') or "")
+
+
+# counts the phrases in one file. This runs in a separate process for each file, and returns a dict of the day
+# number, days since 1970, to a list with the count of comments containing each phrase that day
+def count_file(arguments):
+	input_path, phrases, whole_words, start_timestamp = arguments
+	match = build_matcher(phrases, whole_words)
+	day_counts = {}
+	file_lines = 0
+	bad_lines = 0
+	created = None
+	input_size = os.stat(input_path).st_size
+	for line, file_bytes_processed in read_lines_zst(input_path):
+		try:
+			obj = json.loads(line)
+			created = int(obj['created_utc'])
+			# skip if we're before the start date
+			if created >= start_timestamp:
+				day = created // 86400
+				phrase_counts = day_counts.get(day)
+				if phrase_counts is None:
+					phrase_counts = [0] * len(phrases)
+					day_counts[day] = phrase_counts
+				for index in match(get_text(obj).lower()):
+					phrase_counts[index] += 1
+
+		# just in case there's corruption somewhere in the file
+		except (KeyError, ValueError, TypeError, AttributeError) as err:
+			bad_lines += 1
+		file_lines += 1
+		if file_lines % 100000 == 0 and created is not None:
+			log.info(f"{os.path.basename(input_path)} : {datetime.utcfromtimestamp(created).strftime('%Y-%m-%d %H:%M:%S')} : {file_lines:,} : {bad_lines:,} : {(file_bytes_processed / input_size) * 100:.0f}%")
+
+	log.info(f"{os.path.basename(input_path)} complete : {file_lines:,} : {bad_lines:,}")
+	return day_counts, file_lines, bad_lines
+
+
+# writes the counts sorted by key to a tsv, so they can be merged with other sorted files later
+def write_count_file(path, counts):
+	with open(path, 'w', encoding="utf-8") as output_handle:
+		for key, count in sorted(counts.items()):
+			output_handle.write(f"{key}\t{count}\n")
+
+
+def read_count_file(path):
+	with open(path, 'r', encoding="utf-8") as input_handle:
+		for line in input_handle:
+			key, count = line.rstrip("\n").rsplit("\t", 1)
+			yield key, int(count)
+
+
+# k-way merge of sorted count files, adding up the counts for each key. Only one line from each file is in memory at a
+# time, and the keys come out in sorted order
+def merge_count_files(paths):
+	current_key = None
+	current_count = 0
+	for key, count in heapq.merge(*[read_count_file(path) for path in paths]):
+		if key != current_key:
+			if current_key is not None:
+				yield current_key, current_count
+			current_key = key
+			current_count = 0
+		current_count += count
+	if current_key is not None:
+		yield current_key, current_count
+
+
+# counts every word in one file for each day or month. The keys are the period and the word separated by a tab, like
+# "2021-01\tstonks". Once there are more than max_keys different keys, they're written out sorted to a file in the
+# working folder and cleared, so memory stays the same however big the file is. Returns the list of those files
+def count_file_vocabulary(arguments):
+	input_path, file_number, period, start_timestamp, working_folder, max_keys = arguments
+	period_format = '%Y-%m-%d' if period == "day" else '%Y-%m'
+	day_periods = {}
+	counts = {}
+	count_paths = []
+	file_lines = 0
+	bad_lines = 0
+	created = None
+	input_size = os.stat(input_path).st_size
+	for line, file_bytes_processed in read_lines_zst(input_path):
+		try:
+			obj = json.loads(line)
+			created = int(obj['created_utc'])
+			# skip if we're before the start date
+			if created >= start_timestamp:
+				day = created // 86400
+				period_string = day_periods.get(day)
+				if period_string is None:
+					period_string = time.strftime(period_format, time.gmtime(day * 86400)) + "\t"
+					day_periods[day] = period_string
+				for word in word_regex.findall(get_text(obj).lower()):
+					key = period_string + word
+					counts[key] = counts.get(key, 0) + 1
+
+				if len(counts) > max_keys:
+					count_paths.append(os.path.join(working_folder, f"{file_number}_{len(count_paths)}.tsv"))
+					write_count_file(count_paths[-1], counts)
+					counts = {}
+
+		# just in case there's corruption somewhere in the file
+		except (KeyError, ValueError, TypeError, AttributeError) as err:
+			bad_lines += 1
+		file_lines += 1
+		if file_lines % 100000 == 0 and created is not None:
+			log.info(f"{os.path.basename(input_path)} : {datetime.utcfromtimestamp(created).strftime('%Y-%m-%d %H:%M:%S')} : {file_lines:,} : {bad_lines:,} : {(file_bytes_processed / input_size) * 100:.0f}%")
+
+	if len(counts):
+		count_paths.append(os.path.join(working_folder, f"{file_number}_{len(count_paths)}.tsv"))
+		write_count_file(count_paths[-1], counts)
+	log.info(f"{os.path.basename(input_path)} complete : {file_lines:,} : {bad_lines:,} : {len(count_paths)} count files")
+	return count_paths, file_lines, bad_lines
+
+
 if __name__ == "__main__":
-	# the path to the input comment file
+	# the path to the input comment file, or a folder of files to count all of them
 	input_path = r"\\MYCLOUDPR4100\Public\reddit\requests\wallstreetbets_comments.zst"
 	# the path to the output csv file of word counts
 	output_path = r"\\MYCLOUDPR4100\Public\reddit\wallstreetbets_counts.csv"
 	# skip everything before this date. The subreddit was created in 2012, so there's a lot of dates before it gets to the good stuff if you want to skip them
 	start_date = datetime.strptime("2020-01-01", '%Y-%m-%d')
-	# list of word phrases to search for. Make sure these are all lowercase
+	# list of word phrases to search for. Each column in the output is the number of comments that day with the phrase in them
 	phrases = [
 		"diamond hands",
 		"sell",
 	]
+	# phrases are matched anywhere in the text, so "sell" also counts "seller" and "sellers". Set to True to only match
+	# whole words, which is also faster when there are a lot of phrases
+	whole_words = False
+	# how many files to count at once if the input is a folder, each in its own process
+	processes = 4
+	# set this to "day" or "month" to count every word instead of the phrases above. The output is then a tsv with the
+	# period, the word and how many times it was used, sorted by period and then word
+	vocabulary_period = None
+	# in vocabulary mode, words that were used fewer times than this in a period are left out of the output
+	min_word_count = 1
+	# in vocabulary mode, each process writes its counts to a file in this folder once it has this many different words
+	# and periods in memory, then they're all merged at the end
+	working_folder = "word_counts"
+	max_keys_in_memory = 10000000
 
-	# bunch of initialization stuff
-	word_counts = defaultdict(int)
+	if os.path.isdir(input_path):
+		input_paths = [os.path.join(input_path, file_name) for file_name in sorted(os.listdir(input_path)) if file_name.endswith(".zst")]
+	else:
+		input_paths = [input_path]
+	start_timestamp = calendar.timegm(start_date.timetuple())
 	file_lines = 0
-	file_bytes_processed = 0
-	created = None
 	bad_lines = 0
-	current_day = None
-	output_file = open(output_path, 'w')
-	output_file.write(f"Date,{(','.join(phrases))}\n")
-	input_size = os.stat(input_path).st_size
-	try:
-		# this is the main loop where we iterate over every single line in the zst file
-		for line, file_bytes_processed in read_lines_zst(input_path):
-			try:
-				# load the line into a json object
-				obj = json.loads(line)
-				# turn the created timestamp into a date object
-				created = datetime.utcfromtimestamp(int(obj['created_utc']))
-				# skip if we're before the start date defined above
-				if created >= start_date:
-					# if this is a different day than the previous line we looked at, save the word counts to the csv
-					if current_day != created.replace(hour=0, minute=0, second=0, microsecond=0):
-						# don't save the dates if this is the very first day, we're just starting
-						if current_day is not None:
-							# write out the date at the beginning of the line
-							output_file.write(f"{current_day.strftime('%Y-%m-%d')}")
-							# for each phrase in the list, look up the count associated with it and write it out
-							for phrase in phrases:
-								output_file.write(",")
-								output_file.write(str(word_counts[phrase]))
-							output_file.write("\n")
-							# reset the dictionary so we can start counting up for the new day
-							word_counts = defaultdict(int)
-						# update the variable to the new day, so we can then tell when we get to the next day
-						current_day = created.replace(hour=0, minute=0, second=0, microsecond=0)
-
-					# get the lowercase of the object text
-					body_lower = obj['body'].lower()
-					# for each of the phrases in the list
-					for phrase in phrases:
-						# check if it's the text
-						if phrase in body_lower:
-							word_counts[phrase] += 1
-
-			# just in case there's corruption somewhere in the file
-			except (KeyError, json.JSONDecodeError) as err:
-				bad_lines += 1
-			file_lines += 1
-			if file_lines % 100000 == 0:
-				log.info(f"{created.strftime('%Y-%m-%d %H:%M:%S')} : {file_lines:,} : {bad_lines:,} : {(file_bytes_processed / input_size) * 100:.0f}%")
-	except Exception as err:
-		log.info(err)
-
-	# write out the last day
-	output_file.write(f"{current_day.strftime('%Y-%m-%d')}")
-	for phrase in phrases:
-		output_file.write(",")
-		output_file.write(str(word_counts[phrase]))
-	output_file.write("\n")
-
-	output_file.close()
-	log.info(f"Complete : {file_lines:,} : {bad_lines:,}")
+	multiprocessing.set_start_method('spawn')
+
+	if vocabulary_period is not None:
+		log.info(f"Counting every word per {vocabulary_period} in {len(input_paths)} files")
+		if vocabulary_period not in ("day", "month"):
+			log.info(f"vocabulary_period must be day or month: {vocabulary_period}")
+			sys.exit(1)
+		if not os.path.exists(working_folder):
+			os.makedirs(working_folder)
+
+		count_paths = []
+		with multiprocessing.Pool(processes=max(min(processes, len(input_paths)), 1)) as pool:
+			for file_count_paths, lines, bad in pool.imap_unordered(count_file_vocabulary, [
+					(path, file_number, vocabulary_period, start_timestamp, working_folder, max_keys_in_memory)
+					for file_number, path in enumerate(input_paths)]):
+				count_paths.extend(file_count_paths)
+				file_lines += lines
+				bad_lines += bad
+
+		log.info(f"Merging {len(count_paths)} count files")
+		output_lines = 0
+		with open(output_path, 'w', encoding="utf-8") as output_file:
+			output_file.write(f"{vocabulary_period}\tword\tcount\n")
+			for key, count in merge_count_files(count_paths):
+				if count >= min_word_count:
+					output_file.write(f"{key}\t{count}\n")
+					output_lines += 1
+		for count_path in count_paths:
+			os.remove(count_path)
+
+		log.info(f"Complete : {file_lines:,} : {bad_lines:,} : {output_lines:,} words")
+		sys.exit(0)
+
+	log.info(f"Counting {len(phrases)} phrases in {len(input_paths)} files")
+
+	# each file is counted separately, then the counts for each day are added together
+	day_counts = {}
+	with multiprocessing.Pool(processes=max(min(processes, len(input_paths)), 1)) as pool:
+		for file_day_counts, lines, bad in pool.imap_unordered(count_file, [(path, phrases, whole_words, start_timestamp) for path in input_paths]):
+			file_lines += lines
+			bad_lines += bad
+			for day, phrase_counts in file_day_counts.items():
+				total_counts = day_counts.get(day)
+				if total_counts is None:
+					day_counts[day] = phrase_counts
+				else:
+					for index, count in enumerate(phrase_counts):
+						total_counts[index] += count
+
+	# write out a line for each day, with the date at the beginning and the count for each phrase after it
+	with open(output_path, 'w') as output_file:
+		output_file.write(f"Date,{(','.join(phrases))}\n")
+		for day in sorted(day_counts):
+			output_file.write(f"{time.strftime('%Y-%m-%d', time.gmtime(day * 86400))},{','.join(str(count) for count in day_counts[day])}\n")
+
+	log.info(f"Complete : {file_lines:,} : {bad_lines:,} : {len(day_counts):,} days")
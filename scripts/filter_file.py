@@ -1,11 +1,20 @@
 import zstandard
 import os
 import json
+import re
 import sys
+import bisect
+import hashlib
 import csv
+import queue
+import threading
 from datetime import datetime
 import logging.handlers
 import traceback
+import time
+import zlib
+import shutil
+import multiprocessing
 
 # put the path to the input file, or a folder of files to process all of
 input_file = r"\\MYCLOUDPR4100\Public\wallstreetbets_comments.zst"
@@ -71,7 +80,7 @@ to_date = datetime.strptime("2030-12-31", "%Y-%m-%d")
 # single_field = None  # resetting this back so it's not used
 # field = "link_id"  # in the comment object, this is the field that contains the submission id
 # values_file = "submission_ids.txt"
-# exact_match = False  # the link_id field has a prefix on it, so we can't do an exact match
+# exact_match = True  # the link_id field has a t3_ prefix on it, but it's removed from link_id and parent_id before comparing in exact match mode
 #
 # run the script one last time and now you have a file called "filtered_comments.csv" that only has comments from your submissions above
 # if you want only top level comments instead of all comments, you can set field to "parent_id" instead of "link_id"
@@ -80,12 +89,22 @@ to_date = datetime.strptime("2030-12-31", "%Y-%m-%d")
 field = "selftext"
 values = ['']
 # if you have a long list of values, you can put them in a file and put the filename here. If set this overrides the value list above
-# if this list is very large, it could greatly slow down the process
 values_file = None
-# if true, only match the full value, if false match the value anywhere in the text. Partial matches are much slower
+# if true, only match the full value, if false match the value anywhere in the text. Partial matches are slower, especially with a long list of values
 exact_match = False
 # if true, returns rows that do not match the condition
 inverse = False
+# how often to save how far through the input file the script is, so if it crashes or is stopped it can start again from there
+# instead of the beginning. The progress is saved in a file next to the output file. Set to 0 to turn this off
+checkpoint_minutes = 10
+# if the input is a folder, how many files to filter at once, each in its own process. Set to 1 to do them one at a time
+processes = 4
+# if the input is a folder, also join all the output files together into one file named after the output folder, in the
+# same order as the input files. The separate files are kept
+combine_output = False
+# if the input is a folder and there are at least this many values in exact match mode, they're kept once in shared memory
+# for all the processes instead of each process getting its own copy
+shared_values_min = 100000
 
 
 # sets up logging to the console as well as a file
@@ -120,28 +139,98 @@ def write_line_single(handle, obj, field):
 	handle.write("\n")
 
 
-def write_line_csv(writer, obj, is_submission):
-	output_list = []
-	output_list.append(str(obj['score']))
-	output_list.append(datetime.fromtimestamp(int(obj['created_utc'])).strftime("%Y-%m-%d"))
-	if is_submission:
-		output_list.append(obj['title'])
-	output_list.append(f"u/{obj['author']}")
-	if 'permalink' in obj:
-		output_list.append(f"https://www.reddit.com{obj['permalink']}")
-	else:
-		output_list.append(f"https://www.reddit.com/r/{obj['subreddit']}/comments/{obj['link_id'][3:]}/_/{obj['id']}")
-	if is_submission:
+# turns the csv columns into a tuple of functions that each take an object and return the value for that column, so
+# whether it's a submission only has to be checked once instead of for every row
+def get_csv_extractors(is_submission):
+	# the objects are mostly in order, so remember the last minute formatted and reuse it until the minute changes
+	last_minute = None
+	last_created = None
+
+	def get_created(obj):
+		nonlocal last_minute, last_created
+		minute = int(obj['created_utc']) // 60
+		if minute != last_minute:
+			last_created = datetime.fromtimestamp(minute * 60).strftime("%Y-%m-%d")
+			last_minute = minute
+		return last_created
+
+	def get_link(obj):
+		if 'permalink' in obj:
+			return f"https://www.reddit.com{obj['permalink']}"
+		else:
+			return f"https://www.reddit.com/r/{obj['subreddit']}/comments/{obj['link_id'][3:]}/_/{obj['id']}"
+
+	def get_text(obj):
 		if obj['is_self']:
 			if 'selftext' in obj:
-				output_list.append(obj['selftext'])
+				return obj['selftext']
 			else:
-				output_list.append("")
+				return ""
 		else:
-			output_list.append(obj['url'])
+			return obj['url']
+
+	extractors = [lambda obj: str(obj['score']), get_created]
+	if is_submission:
+		extractors.append(lambda obj: obj['title'])
+	extractors.append(lambda obj: f"u/{obj['author']}")
+	extractors.append(get_link)
+	if is_submission:
+		extractors.append(get_text)
 	else:
-		output_list.append(obj['body'])
-	writer.writerow(output_list)
+		extractors.append(lambda obj: obj['body'])
+	return tuple(extractors)
+
+
+def write_line_csv(writer, obj, extractors):
+	writer.writerow([extract(obj) for extract in extractors])
+
+
+# writes rows to a csv writer in batches on a separate thread, so turning the objects into rows and writing them to the
+# file happen at the same time. If the writing fails, the error is raised the next time a row is written
+class CsvBatchWriter:
+	def __init__(self, writer, batch_size=10000, max_batches=4):
+		self.writer = writer
+		self.batch_size = batch_size
+		self.batch = []
+		self.error = None
+		self.batches = queue.Queue(max_batches)
+		self.thread = threading.Thread(target=self.write_batches, daemon=True)
+		self.thread.start()
+
+	def write_batches(self):
+		while True:
+			batch = self.batches.get()
+			try:
+				if batch is None:
+					return
+				if self.error is None:
+					self.writer.writerows(batch)
+			except Exception as err:
+				self.error = err
+			finally:
+				self.batches.task_done()
+
+	def writerow(self, row):
+		if self.error is not None:
+			raise self.error
+		self.batch.append(row)
+		if len(self.batch) >= self.batch_size:
+			self.batches.put(self.batch)
+			self.batch = []
+
+	# blocks until every row so far has been written to the file
+	def flush(self):
+		if len(self.batch):
+			self.batches.put(self.batch)
+			self.batch = []
+		self.batches.join()
+		if self.error is not None:
+			raise self.error
+
+	def close(self):
+		self.flush()
+		self.batches.put(None)
+		self.thread.join()
 
 
 def read_and_decode(reader, chunk_size, max_window_size, previous_chunk=None, bytes_read=0):
@@ -158,12 +247,35 @@ def read_and_decode(reader, chunk_size, max_window_size, previous_chunk=None, by
 		return read_and_decode(reader, chunk_size, max_window_size, chunk, bytes_read)
 
 
-def read_lines_zst(file_name):
+# read past the first count lines without decoding them. Returns what's left of the chunk the last skipped line ended
+# in, or None if the reader ran out first
+def skip_lines_zst(reader, count):
+	while count > 0:
+		chunk = reader.read(2**27)
+		if not chunk:
+			return None
+		newlines = chunk.count(b"\n")
+		if newlines < count:
+			count -= newlines
+			continue
+		index = -1
+		for i in range(count):
+			index = chunk.index(b"\n", index + 1)
+		return chunk[index + 1:]
+	return b''
+
+
+def read_lines_zst(file_name, skip_lines=0):
 	with open(file_name, 'rb') as file_handle:
 		buffer = ''
 		reader = zstandard.ZstdDecompressor(max_window_size=2**31).stream_reader(file_handle)
+		previous_chunk = skip_lines_zst(reader, skip_lines)
+		if previous_chunk is None:
+			reader.close()
+			return
 		while True:
-			chunk = read_and_decode(reader, 2**27, (2**29) * 2)
+			chunk = read_and_decode(reader, 2**27, (2**29) * 2, previous_chunk)
+			previous_chunk = None
 
 			if not chunk:
 				break
@@ -177,30 +289,266 @@ def read_lines_zst(file_name):
 		reader.close()
 
 
-def process_file(input_file, output_file, output_format, field, values, from_date, to_date, single_field, exact_match):
+def get_values_hash(values):
+	return zlib.crc32("\n".join(sorted(values)).encode('utf-8'))
+
+
+def get_value_hash(value_bytes):
+	return int.from_bytes(hashlib.blake2b(value_bytes, digest_size=8).digest(), 'little', signed=True)
+
+
+# a set of values kept once in shared memory for all the workers, instead of a python set pickled and copied into every
+# process. The values are sorted by a 64 bit hash, with their text in one block of bytes and the offset of each one in
+# another. Checking a value is a binary search for its hash and then comparing the text, so a hash collision can't cause
+# a false match. It can only be sent to the workers when they start, with the pool initializer
+class SharedValues:
+	def __init__(self, values, values_hash):
+		entries = sorted((get_value_hash(value_bytes), value_bytes) for value_bytes in set(value.encode('utf-8', errors='surrogatepass') for value in values))
+		self.values_hash = values_hash
+		self.count = len(entries)
+		self.hashes = multiprocessing.RawArray('q', [value_hash for value_hash, value_bytes in entries])
+		self.offsets = multiprocessing.RawArray('q', self.count + 1)
+		text = b"".join(value_bytes for value_hash, value_bytes in entries)
+		self.text = multiprocessing.RawArray('B', len(text))
+		memoryview(self.text).cast('B')[:] = text
+		offset = 0
+		for index, (value_hash, value_bytes) in enumerate(entries):
+			offset += len(value_bytes)
+			self.offsets[index + 1] = offset
+		self.views = None
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state["views"] = None
+		return state
+
+	def __len__(self):
+		return self.count
+
+	def __contains__(self, value):
+		if self.views is None:
+			self.views = (
+				memoryview(self.hashes).cast('B').cast('q'),
+				memoryview(self.offsets).cast('B').cast('q'),
+				memoryview(self.text).cast('B'))
+		hashes, offsets, text = self.views
+		# json can decode an escaped lone surrogate into a field, which plain utf-8 can't encode
+		value_bytes = value.encode('utf-8', errors='surrogatepass')
+		value_hash = get_value_hash(value_bytes)
+		index = bisect.bisect_left(hashes, value_hash)
+		while index < self.count and hashes[index] == value_hash:
+			if text[offsets[index]:offsets[index + 1]] == value_bytes:
+				return True
+			index += 1
+		return False
+
+
+# a string of everything that changes which lines are written, so a checkpoint isn't used if the filter changed
+def get_filter_string(input_file, output_format, field, values, from_date, to_date, single_field, exact_match):
+	values_hash = values.values_hash if isinstance(values, SharedValues) else get_values_hash(values)
+	return f"{input_file}:{os.stat(input_file).st_size}:{output_format}:{field}:{values_hash}:{from_date}:{to_date}:{single_field}:{exact_match}:{inverse}"
+
+
+# load the checkpoint for the output file if there is one and it's from the same filter
+def load_checkpoint(checkpoint_path, filter_string):
+	if not os.path.exists(checkpoint_path):
+		return None
+	with open(checkpoint_path, 'r') as checkpoint_file:
+		checkpoint = json.load(checkpoint_file)
+	if checkpoint["filter"] != filter_string:
+		log.info(f"Checkpoint {checkpoint_path} is from a different input or filter, starting from the beginning")
+		return None
+	return checkpoint
+
+
+# flush everything written so far to the output file and save how far through the input and output we are. For zst the
+# current frame is ended, so the output file is valid up to this point. The checkpoint is written to a temp file and
+# renamed over the old one, so a crash in the middle doesn't leave a broken checkpoint
+def save_checkpoint(checkpoint_path, filter_string, handle, file_handle, output_format, total_lines, matched_lines, bad_lines):
+	if output_format == "zst":
+		handle.flush(zstandard.FLUSH_FRAME)
+	else:
+		handle.flush()
+	output_offset = file_handle.tell()
+	with open(checkpoint_path + ".temp", 'w') as checkpoint_file:
+		json.dump({
+			"filter": filter_string,
+			"total_lines": total_lines,
+			"matched_lines": matched_lines,
+			"bad_lines": bad_lines,
+			"output_offset": output_offset,
+		}, checkpoint_file)
+	os.replace(checkpoint_path + ".temp", checkpoint_path)
+
+
+# when filtering a folder in several processes, the progress of each file is kept in a shared array with a slot of these
+# fields for each file. Each worker only writes to the slot of the file it's working on and the parent only reads
+COUNTER_FIELDS = 4
+LINES_PROCESSED, LINES_MATCHED, BAD_LINES, BYTES_PROCESSED = range(COUNTER_FIELDS)
+PROGRESS_SECONDS = 10
+shared_counters = None
+shared_values = None
+
+
+# runs at the start of each worker process to keep a reference to the shared counters, and the shared values if they
+# were put in shared memory
+def init_worker(counters, values=None):
+	global shared_counters, shared_values
+	shared_counters = counters
+	shared_values = values
+
+
+def update_counters(file_index, total_lines, matched_lines, bad_lines, file_bytes_processed):
+	offset = file_index * COUNTER_FIELDS
+	shared_counters[offset + LINES_PROCESSED] = total_lines
+	shared_counters[offset + LINES_MATCHED] = matched_lines
+	shared_counters[offset + BAD_LINES] = bad_lines
+	shared_counters[offset + BYTES_PROCESSED] = file_bytes_processed
+
+
+def sum_counter(counters, field):
+	return sum(counters[field::COUNTER_FIELDS])
+
+
+# link_id and parent_id are fullnames, with a t3_ prefix for submissions or t1_ for comments. In exact match mode the
+# t3_ prefix is removed from both the field and the values, so they can be matched against a plain list of submission
+# ids. Comment fullnames keep their t1_ prefix, so a reply to a comment never matches a submission with the same id
+PREFIXED_FIELDS = {"link_id", "parent_id"}
+
+
+def strip_submission_prefix(value):
+	if value.startswith("t3_"):
+		return value[3:]
+	return value
+
+
+# builds a regex that matches any of the values by putting them in a tree of characters, so values that start the same
+# share the same branch and the regex only checks each starting character once. A value that's the start of a longer
+# value already matches everything the longer one would, so the longer one is dropped. The tree is as deep as the
+# longest value, so it's walked with a stack instead of recursion, building each node's pattern after its children's
+def get_trie_pattern(trie):
+	patterns = {}
+	stack = [(trie, False)]
+	while stack:
+		node, children_done = stack.pop()
+		if "" in node:
+			patterns[id(node)] = ""
+			continue
+		if not children_done:
+			stack.append((node, True))
+			for child in node.values():
+				stack.append((child, False))
+			continue
+		branches = []
+		characters = []
+		for character, child in sorted(node.items()):
+			child_pattern = patterns.pop(id(child))
+			if child_pattern == "":
+				characters.append(re.escape(character))
+			else:
+				branches.append(re.escape(character) + child_pattern)
+		if len(characters) == 1:
+			branches.append(characters[0])
+		elif len(characters) > 1:
+			branches.append(f"[{''.join(characters)}]")
+		if len(branches) == 1:
+			patterns[id(node)] = branches[0]
+		else:
+			patterns[id(node)] = f"(?:{'|'.join(branches)})"
+	return patterns[id(trie)]
+
+
+# returns a function that takes the lowercase field value and returns whether it matches any of the values. Exact
+# matches look the field up in a set, or the shared values, which already have the prefixes removed. Partial matches
+# search the field with a single regex of all the values
+def get_matcher(field, values, exact_match):
+	if exact_match:
+		if isinstance(values, SharedValues):
+			value_set = values
+		elif field in PREFIXED_FIELDS:
+			value_set = {strip_submission_prefix(value) for value in values}
+		else:
+			value_set = set(values)
+		if field in PREFIXED_FIELDS:
+			return lambda field_value: strip_submission_prefix(field_value) in value_set
+		return lambda field_value: field_value in value_set
+
+	if not len(values):
+		return lambda field_value: False
+	trie = {}
+	for value in values:
+		node = trie
+		for character in value:
+			node = node.setdefault(character, {})
+		node[""] = {}
+	try:
+		values_regex = re.compile(get_trie_pattern(trie))
+	except RecursionError:
+		# the regex compiler recurses into each nested group, so a tree that branches very deep can still be too much
+		# for it. Fall back to just listing the values
+		values_regex = re.compile("|".join(re.escape(value) for value in sorted(values, key=len, reverse=True)))
+	return lambda field_value: values_regex.search(field_value) is not None
+
+
+def process_file(input_file, output_file, output_format, field, values, from_date, to_date, single_field, exact_match, file_index=None):
 	output_path = f"{output_file}.{output_format}"
 	is_submission = "submission" in input_file
 	log.info(f"Input: {input_file} : Output: {output_path} : Is submission {is_submission}")
+	if values is None:
+		values = shared_values
+
+	checkpoint_path = f"{output_path}.checkpoint"
+	filter_string = get_filter_string(input_file, output_format, field, values, from_date, to_date, single_field, exact_match)
+	checkpoint = load_checkpoint(checkpoint_path, filter_string) if checkpoint_minutes else None
+	# the checkpoint can only be used if everything written up to it is still in the output file
+	if checkpoint is not None and (not os.path.exists(output_path) or os.stat(output_path).st_size < checkpoint["output_offset"]):
+		log.warning(f"Output file {output_path} is missing or shorter than the checkpoint, starting from the beginning")
+		checkpoint = None
+	matched_lines = 0
+	bad_lines = 0
+	total_lines = 0
+	mode = 'w'
+	if checkpoint is not None:
+		total_lines = checkpoint["total_lines"]
+		matched_lines = checkpoint["matched_lines"]
+		bad_lines = checkpoint["bad_lines"]
+		log.info(f"Resuming from checkpoint after {total_lines:,} lines")
+		# cut off anything written after the checkpoint and append from there
+		os.truncate(output_path, checkpoint["output_offset"])
+		mode = 'a'
+
 	writer = None
+	extractors = None
 	if output_format == "zst":
-		handle = zstandard.ZstdCompressor().stream_writer(open(output_path, 'wb'))
+		file_handle = open(output_path, mode + 'b')
+		handle = zstandard.ZstdCompressor().stream_writer(file_handle)
 	elif output_format == "txt":
-		handle = open(output_path, 'w', encoding='UTF-8')
+		handle = open(output_path, mode, encoding='UTF-8')
+		file_handle = handle.buffer
 	elif output_format == "csv":
-		handle = open(output_path, 'w', encoding='UTF-8', newline='')
-		writer = csv.writer(handle)
+		# errors='replace' writes a ? for any characters that can't be written in utf-8, like a broken emoji
+		handle = open(output_path, mode, encoding='UTF-8', errors='replace', newline='')
+		file_handle = handle.buffer
+		writer = CsvBatchWriter(csv.writer(handle))
+		extractors = get_csv_extractors(is_submission)
 	else:
-		log.error(f"Unsupported output format {output_format}")
-		sys.exit()
+		raise ValueError(f"Unsupported output format {output_format}")
 
 	file_size = os.stat(input_file).st_size
 	created = None
-	matched_lines = 0
-	bad_lines = 0
-	total_lines = 0
-	for line, file_bytes_processed in read_lines_zst(input_file):
+	last_checkpoint_time = time.time()
+	match = get_matcher(field, values, exact_match)
+	for line, file_bytes_processed in read_lines_zst(input_file, total_lines):
+		# checkpoint before counting the current line, since it hasn't been written yet
+		if checkpoint_minutes and total_lines % 100000 == 0 and time.time() - last_checkpoint_time > checkpoint_minutes * 60:
+			if writer is not None:
+				writer.flush()
+			save_checkpoint(checkpoint_path, filter_string, handle, file_handle, output_format, total_lines, matched_lines, bad_lines)
+			last_checkpoint_time = time.time()
 		total_lines += 1
-		if total_lines % 100000 == 0:
+		if total_lines % 100000 == 0 and file_index is not None:
+			update_counters(file_index, total_lines, matched_lines, bad_lines, file_bytes_processed)
+		elif total_lines % 100000 == 0:
 			log.info(f"{created.strftime('%Y-%m-%d %H:%M:%S')} : {total_lines:,} : {matched_lines:,} : {bad_lines:,} : {file_bytes_processed:,}:{(file_bytes_processed / file_size) * 100:.0f}%")
 
 		try:
@@ -216,17 +564,7 @@ def process_file(input_file, output_file, output_format, field, values, from_dat
 				field_value = obj[field]
 				if field_value is None:
 					continue
-				field_value = field_value.lower()
-				matched = False
-				for value in values:
-					if exact_match:
-						if value == field_value:
-							matched = True
-							break
-					else:
-						if value in field_value:
-							matched = True
-							break
+				matched = match(field_value.lower())
 				if inverse:
 					if matched:
 						continue
@@ -239,7 +577,7 @@ def process_file(input_file, output_file, output_format, field, values, from_dat
 			if output_format == "zst":
 				write_line_zst(handle, line)
 			elif output_format == "csv":
-				write_line_csv(writer, obj, is_submission)
+				write_line_csv(writer, obj, extractors)
 			elif output_format == "txt":
 				if single_field is not None:
 					write_line_single(handle, obj, single_field)
@@ -256,14 +594,33 @@ def process_file(input_file, output_file, output_format, field, values, from_dat
 					log.warning(f"Line decoding failed: {err}")
 				log.warning(line)
 
+	if writer is not None:
+		writer.close()
 	handle.close()
+	if os.path.exists(checkpoint_path):
+		os.remove(checkpoint_path)
+	if file_index is not None:
+		update_counters(file_index, total_lines, matched_lines, bad_lines, file_size)
 	log.info(f"Complete : {total_lines:,} : {matched_lines:,} : {bad_lines:,}")
 
 
+# runs process_file in a worker process. Errors are returned instead of raised so the other files keep going. Takes a
+# single tuple so it can be used with imap_unordered
+def process_file_worker(arguments):
+	try:
+		process_file(*arguments)
+		return arguments[0], None
+	except Exception:
+		return arguments[0], traceback.format_exc()
+
+
 if __name__ == "__main__":
 	if single_field is not None:
 		log.info("Single field output mode, changing output file format to txt")
 		output_format = "txt"
+	if output_format not in ("zst", "txt", "csv"):
+		log.error(f"Unsupported output format {output_format}")
+		sys.exit()
 
 	if values_file is not None:
 		values = []
@@ -277,10 +634,12 @@ if __name__ == "__main__":
 	log.info(f"Filtering field: {field}")
 	if len(values) <= 20:
 		log.info(f"On values: {','.join(values)}")
-	else:
+	elif len(values) <= 1000:
 		log.info(f"On values:")
 		for value in values:
 			log.info(value)
+	else:
+		log.info(f"On {len(values):,} values")
 	log.info(f"Exact match {('on' if exact_match else 'off')}. Single field {single_field}.")
 	log.info(f"From date {from_date.strftime('%Y-%m-%d')} to date {to_date.strftime('%Y-%m-%d')}")
 	log.info(f"Output format set to {output_format}")
@@ -293,12 +652,68 @@ if __name__ == "__main__":
 			if not os.path.isdir(file) and file.endswith(".zst"):
 				input_name = os.path.splitext(os.path.splitext(os.path.basename(file))[0])[0]
 				input_files.append((os.path.join(input_file, file), os.path.join(output_file, input_name)))
+		input_files.sort()
 	else:
 		input_files.append((input_file, output_file))
 	log.info(f"Processing {len(input_files)} files")
-	for file_in, file_out in input_files:
-		try:
-			process_file(file_in, file_out, output_format, field, values, from_date, to_date, single_field, exact_match)
-		except Exception as err:
-			log.warning(f"Error processing {file_in}: {err}")
-			log.warning(traceback.format_exc())
+	errored_files = []
+	if processes > 1 and len(input_files) > 1:
+		multiprocessing.set_start_method('spawn')
+		counters = multiprocessing.Array('q', len(input_files) * COUNTER_FIELDS, lock=False)
+		total_bytes = sum(os.stat(file_in).st_size for file_in, file_out in input_files)
+		files_processed = 0
+		files_errored = 0
+		last_log_time = time.time()
+		file_values = values
+		if exact_match and field is not None and len(values) >= shared_values_min:
+			log.info(f"Putting {len(values):,} values in shared memory")
+			file_values = None
+			shared_values = SharedValues(
+				[strip_submission_prefix(value) for value in values] if field in PREFIXED_FIELDS else values, get_values_hash(values))
+		with multiprocessing.Pool(processes=min(processes, len(input_files)), initializer=init_worker, initargs=(counters, shared_values)) as pool:
+			workers = pool.imap_unordered(process_file_worker, [
+				(file_in, file_out, output_format, field, file_values, from_date, to_date, single_field, exact_match, file_index)
+				for file_index, (file_in, file_out) in enumerate(input_files)])
+			while files_processed < len(input_files):
+				# finished files come back from the pool, the progress of the rest is read from the counters
+				try:
+					file_in, error_message = workers.next(timeout=PROGRESS_SECONDS)
+					files_processed += 1
+					if error_message is not None:
+						log.warning(f"Error processing {file_in}: {error_message}")
+						files_errored += 1
+						errored_files.append(file_in)
+				except multiprocessing.TimeoutError:
+					pass
+
+				current_time = time.time()
+				if current_time - last_log_time >= PROGRESS_SECONDS or files_processed == len(input_files):
+					last_log_time = current_time
+					log.info(
+						f"{sum_counter(counters, LINES_PROCESSED):,} lines : {sum_counter(counters, LINES_MATCHED):,} matched : "
+						f"{sum_counter(counters, BAD_LINES):,} bad : {files_processed}({files_errored})/{len(input_files)} files : "
+						f"{(sum_counter(counters, BYTES_PROCESSED) / total_bytes) * 100:.0f}%")
+	else:
+		for file_in, file_out in input_files:
+			try:
+				process_file(file_in, file_out, output_format, field, values, from_date, to_date, single_field, exact_match)
+			except Exception as err:
+				log.warning(f"Error processing {file_in}: {err}")
+				log.warning(traceback.format_exc())
+				errored_files.append(file_in)
+
+	# the output of a file that errored stops partway through, so don't combine it into something that looks complete
+	if combine_output and os.path.isdir(input_file) and errored_files:
+		log.warning(f"Not combining the output files, {len(errored_files)} files errored:")
+		for file_in in sorted(errored_files):
+			log.warning(file_in)
+	elif combine_output and os.path.isdir(input_file):
+		# zst frames can be joined one after another and still read as a single file, so every format is a plain concatenation
+		combined_path = f"{output_file}.{output_format}"
+		log.info(f"Combining {len(input_files)} output files into {combined_path}")
+		with open(combined_path, 'wb') as combined_handle:
+			for file_in, file_out in input_files:
+				output_path = f"{file_out}.{output_format}"
+				if os.path.exists(output_path):
+					with open(output_path, 'rb') as output_handle:
+						shutil.copyfileobj(output_handle, combined_handle, 2**24)
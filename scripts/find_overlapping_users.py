@@ -1,9 +1,12 @@
 import sys
 from collections import defaultdict
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import time
+import calendar
 import os
+import re
 import logging.handlers
+import multiprocessing
 import zstandard
 import json
 
@@ -28,6 +31,13 @@ output_file_name = "users.txt"
 require_first_subreddit = False  # if true, print users that occur in the first subreddit and any one of the following ones. Otherwise just find the most overlap between all subs
 from_date = datetime.strptime("2005-01-01", "%Y-%m-%d")
 to_date = datetime.strptime("2040-12-31", "%Y-%m-%d")
+# how many subreddits to read at once, each in its own process
+processes = 8
+# set this to a file name to also write a csv with how many users each pair of subreddits has in common
+overlap_matrix_file_name = None
+# the first time a subreddit file is read, a small index of every author in it is saved to this folder. Later runs read
+# the index instead of the whole file, as long as the subreddit file hasn't changed. Set to None to always read the files
+index_folder = "author_indexes"
 
 
 # sets up logging to the console as well as a file
@@ -77,28 +87,190 @@ def read_lines_zst(file_name):
 		reader.close()
 
 
-def get_commenters_from_file(subreddit, subreddit_file, subreddit_commenters, total_lines, files_status, from_date, to_date):
+author_regex = re.compile(r'"author": ?"([^"\\]*)"')
+created_regex = re.compile(r'"created_utc": ?"?(\d+)')
+
+
+# get the author and created timestamp from a line. Usernames can't have quotes or backslashes in them, so if each
+# field shows up only once in the line they can be found without parsing the whole object. Otherwise, like a submission
+# with a crosspost that has its own author in it, fall back to parsing the json
+def get_author_created(line):
+	if line.count('"author"') == 1 and line.count('"created_utc"') == 1:
+		author_match = author_regex.search(line)
+		created_match = created_regex.search(line)
+		if author_match is not None and created_match is not None:
+			return author_match.group(1), int(created_match.group(1))
+	obj = json.loads(line)
+	return obj['author'], int(obj['created_utc'])
+
+
+# months are numbered as year * 12 + month - 1 so they sort and are easy to turn back into a timestamp range
+def get_month(created, day_months):
+	day = created // 86400
+	month = day_months.get(day)
+	if month is None:
+		created_time = time.gmtime(created)
+		month = created_time.tm_year * 12 + created_time.tm_mon - 1
+		day_months[day] = month
+	return month
+
+
+def get_month_range(month):
+	year, month_of_year = divmod(month, 12)
+	start = calendar.timegm((year, month_of_year + 1, 1, 0, 0, 0))
+	year, month_of_year = divmod(month + 1, 12)
+	return start, calendar.timegm((year, month_of_year + 1, 1, 0, 0, 0)) - 1
+
+
+# reads every line of the file, counting the authors in the date range and also building the index of all authors in
+# the file. Each author in the index has their total count, first and last created_utc and a count for each month
+def scan_file(subreddit_file, from_timestamp, to_timestamp):
 	file_lines = 0
-	created = None
-	file_size = os.stat(subreddit_file).st_size
+	commenters = defaultdict(int)
+	authors = {}
+	day_months = {}
 	for line, file_bytes_processed in read_lines_zst(subreddit_file):
-		total_lines += 1
 		file_lines += 1
-		if total_lines % 100000 == 0:
-			log.info(f"{files_status}: {total_lines:,}: r/{subreddit}: {created.strftime('%Y-%m-%d %H:%M:%S')} : {file_lines:,} : {(file_bytes_processed / file_size) * 100:.0f}%")
-
 		try:
-			obj = json.loads(line)
-			created = datetime.utcfromtimestamp(int(obj['created_utc']))
-			if created < from_date or created > to_date:
+			author, created = get_author_created(line)
+			if not isinstance(author, str):
 				continue
+		except (KeyError, ValueError, TypeError) as err:
+			continue
 
-			if obj['author'].lower() not in ignored_users:
-				subreddit_commenters[obj['author']] += 1
-		except (KeyError, json.JSONDecodeError) as err:
-			pass
-	log.info(f"{total_lines:,}: {subreddit_file}: {created.strftime('%Y-%m-%d %H:%M:%S')} : {file_lines:,} : 100%")
-	return total_lines
+		author_index = authors.get(author)
+		if author_index is None:
+			authors[author] = [1, created, created, defaultdict(int)]
+			author_index = authors[author]
+		else:
+			author_index[0] += 1
+			if created < author_index[1]:
+				author_index[1] = created
+			if created > author_index[2]:
+				author_index[2] = created
+		author_index[3][get_month(created, day_months)] += 1
+
+		if from_timestamp <= created <= to_timestamp:
+			commenters[author] += 1
+
+	for author_index in authors.values():
+		author_index[3] = ",".join(f"{month}:{count}" for month, count in sorted(author_index[3].items()))
+	return commenters, authors, file_lines
+
+
+def get_index_path(subreddit_file, index_folder):
+	return os.path.join(index_folder, os.path.basename(subreddit_file)[:-4] + "_authors.zst")
+
+
+def get_file_version(subreddit_file):
+	file_stat = os.stat(subreddit_file)
+	return {"size": file_stat.st_size, "mtime": file_stat.st_mtime_ns}
+
+
+# the first line is the size and modified time of the subreddit file when the index was built, followed by one line per
+# author with their count, first and last created_utc, and counts per month
+def save_author_index(index_path, version, authors, file_lines):
+	temp_path = index_path + ".temp"
+	with open(temp_path, 'wb') as file_handle:
+		writer = zstandard.ZstdCompressor().stream_writer(file_handle)
+		writer.write((json.dumps({**version, "lines": file_lines, "authors": len(authors)}) + "\n").encode('utf-8'))
+		for author, (count, first, last, months) in authors.items():
+			writer.write(f"{author}\t{count}\t{first}\t{last}\t{months}\n".encode('utf-8'))
+		writer.close()
+	os.replace(temp_path, index_path)
+
+
+# returns None if there's no index or the subreddit file has changed since it was built
+def load_author_index(index_path, version):
+	if not os.path.exists(index_path):
+		return None, 0
+	authors = {}
+	header = None
+	for line, file_bytes_processed in read_lines_zst(index_path):
+		if header is None:
+			header = json.loads(line)
+			if header["size"] != version["size"] or header["mtime"] != version["mtime"]:
+				return None, 0
+			continue
+		author, count, first, last, months = line.split("\t")
+		authors[author] = [int(count), int(first), int(last), months]
+	if header is None or len(authors) != header["authors"]:
+		return None, 0
+	return authors, header["lines"]
+
+
+# counts each author's items in the date range from the index. Authors entirely inside or outside the range are answered
+# from their totals, the rest from their monthly counts. If one of those months is only partly in the range the index
+# can't give an exact count, so this returns None and the file has to be read
+def count_from_index(authors, from_timestamp, to_timestamp):
+	commenters = {}
+	month_coverage = {}
+	for author, (count, first, last, months) in authors.items():
+		if first >= from_timestamp and last <= to_timestamp:
+			commenters[author] = count
+		elif last < from_timestamp or first > to_timestamp:
+			continue
+		else:
+			in_range = 0
+			for month_count in months.split(","):
+				month, count = month_count.split(":")
+				covered = month_coverage.get(month)
+				if covered is None:
+					month_start, month_end = get_month_range(int(month))
+					if month_start >= from_timestamp and month_end <= to_timestamp:
+						covered = True
+					elif month_end < from_timestamp or month_start > to_timestamp:
+						covered = False
+					else:
+						return None
+					month_coverage[month] = covered
+				if covered:
+					in_range += int(count)
+			if in_range > 0:
+				commenters[author] = in_range
+	return commenters
+
+
+def get_commenters_from_file(subreddit_file, from_timestamp, to_timestamp, index_folder):
+	if index_folder is None:
+		commenters, authors, file_lines = scan_file(subreddit_file, from_timestamp, to_timestamp)
+		return commenters, file_lines, False
+
+	index_path = get_index_path(subreddit_file, index_folder)
+	version = get_file_version(subreddit_file)
+	authors, file_lines = load_author_index(index_path, version)
+	if authors is not None:
+		commenters = count_from_index(authors, from_timestamp, to_timestamp)
+		if commenters is not None:
+			return commenters, file_lines, True
+		commenters, authors, file_lines = scan_file(subreddit_file, from_timestamp, to_timestamp)
+		return commenters, file_lines, False
+
+	commenters, authors, file_lines = scan_file(subreddit_file, from_timestamp, to_timestamp)
+	save_author_index(index_path, version, authors, file_lines)
+	return commenters, file_lines, False
+
+
+# runs in a separate process for each subreddit. Reads the submissions and comments files, or their indexes, and returns
+# the users that have at least min_comments_per_sub items in the subreddit, along with how many lines were in the files
+# and whether every file was answered from an index. Takes a single tuple so it can be used with imap_unordered
+def get_subreddit_commenters(arguments):
+	subreddit_stat, from_timestamp, to_timestamp, ignored_users, min_comments, index_folder = arguments
+	commenters = defaultdict(int)
+	file_lines = 0
+	all_indexed = True
+	for file_type in ["submissions", "comments"]:
+		if file_type in subreddit_stat:
+			file_commenters, lines, indexed = get_commenters_from_file(subreddit_stat[file_type], from_timestamp, to_timestamp, index_folder)
+			for commenter, count in file_commenters.items():
+				commenters[commenter] += count
+			file_lines += lines
+			all_indexed = all_indexed and indexed
+	return \
+		subreddit_stat["name"], \
+		[commenter for commenter, count in commenters.items() if count >= min_comments and commenter.lower() not in ignored_users], \
+		file_lines, \
+		all_indexed
 
 
 if __name__ == "__main__":
@@ -165,29 +337,54 @@ if __name__ == "__main__":
 		log.error(f"The script can see {len(folder_files)} files in the folder, but not the ones requested: {folder}")
 		sys.exit(0)
 
-	commenterSubreddits = defaultdict(int)
-	is_first = True
+	# each user is given an integer id the first time they're seen, and each subreddit is kept as a set of those ids. Ints
+	# are smaller than strings and faster to hash, so intersecting the sets is quick even for large subreddits
+	user_ids = {}
+	user_names = []
+	subreddit_users = {}
 	total_lines = 0
-	files_processed = 1
+	from_timestamp = int(from_date.replace(tzinfo=timezone.utc).timestamp())
+	to_timestamp = int(to_date.replace(tzinfo=timezone.utc).timestamp())
+	if index_folder is not None and not os.path.exists(index_folder):
+		os.makedirs(index_folder)
+	multiprocessing.set_start_method('spawn')
+	with multiprocessing.Pool(processes=min(processes, len(subreddit_stats))) as pool:
+		workers = pool.imap_unordered(get_subreddit_commenters, [
+			(subreddit_stat, from_timestamp, to_timestamp, ignored_users, min_comments_per_sub, index_folder)
+			for subreddit_stat in subreddit_stats])
+		for subreddit_name, commenters, file_lines, indexed in workers:
+			total_lines += file_lines
+			commenter_ids = set()
+			for commenter in commenters:
+				user_id = user_ids.get(commenter)
+				if user_id is None:
+					user_id = len(user_names)
+					user_ids[commenter] = user_id
+					user_names.append(commenter)
+				commenter_ids.add(user_id)
+			subreddit_users[subreddit_name] = commenter_ids
+			log.info(f"{len(subreddit_users)}|{len(subreddit_stats)}: {total_lines:,}: r/{subreddit_name} : {file_lines:,} lines : {len(commenter_ids):,} users{' : from index' if indexed else ''}")
+
+	# the subreddits are counted in the same order as they were sorted, largest first
+	commenterSubreddits = defaultdict(int)
+	first_users = subreddit_users[subreddit_stats[0]["name"]]
 	for subreddit_stat in subreddit_stats:
-		commenters = defaultdict(int)
-		for file_type in ["submissions", "comments"]:
-			total_lines = get_commenters_from_file(
-				f"{subreddit_stat['name']}_{file_type}",
-				subreddit_stat[file_type],
-				commenters,
-				total_lines,
-				f"{files_processed}|{len(subreddit_stats)}",
-				from_date,
-				to_date
-			)
-		for commenter in commenters:
-			if require_first_subreddit and not is_first and commenter not in commenterSubreddits:
-				continue
-			if commenters[commenter] >= min_comments_per_sub:
-				commenterSubreddits[commenter] += 1
-		is_first = False
-		files_processed += 1
+		users = subreddit_users[subreddit_stat["name"]]
+		if require_first_subreddit and users is not first_users:
+			users = users & first_users
+		for user_id in users:
+			commenterSubreddits[user_names[user_id]] += 1
+
+	if overlap_matrix_file_name is not None:
+		names = [subreddit_stat["name"] for subreddit_stat in subreddit_stats]
+		log.info(f"Writing overlap between {len(names)} subreddits to {overlap_matrix_file_name}")
+		with open(overlap_matrix_file_name, 'w') as matrix_file:
+			matrix_file.write(",".join(["subreddit"] + names) + "\n")
+			for name in names:
+				row = [name]
+				for other_name in names:
+					row.append(str(len(subreddit_users[name] & subreddit_users[other_name])))
+				matrix_file.write(",".join(row) + "\n")
 
 	if require_first_subreddit:
 		count_found = 0
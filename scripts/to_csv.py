@@ -12,6 +12,8 @@ import os
 import json
 import sys
 import csv
+import queue
+import threading
 from datetime import datetime
 import logging.handlers
 
@@ -58,6 +60,102 @@ def read_lines_zst(file_name):
 		reader.close()
 
 
+# writes rows to a csv writer in batches on a separate thread, so turning the objects into rows and writing them to the
+# file happen at the same time. If the writing fails, the error is raised the next time a row is written
+class CsvBatchWriter:
+	def __init__(self, writer, batch_size=10000, max_batches=4):
+		self.writer = writer
+		self.batch_size = batch_size
+		self.batch = []
+		self.error = None
+		self.batches = queue.Queue(max_batches)
+		self.thread = threading.Thread(target=self.write_batches, daemon=True)
+		self.thread.start()
+
+	def write_batches(self):
+		while True:
+			batch = self.batches.get()
+			try:
+				if batch is None:
+					return
+				if self.error is None:
+					self.writer.writerows(batch)
+			except Exception as err:
+				self.error = err
+			finally:
+				self.batches.task_done()
+
+	def writerow(self, row):
+		if self.error is not None:
+			raise self.error
+		self.batch.append(row)
+		if len(self.batch) >= self.batch_size:
+			self.batches.put(self.batch)
+			self.batch = []
+
+	# blocks until every row so far has been written to the file
+	def flush(self):
+		if len(self.batch):
+			self.batches.put(self.batch)
+			self.batch = []
+		self.batches.join()
+		if self.error is not None:
+			raise self.error
+
+	def close(self):
+		self.flush()
+		self.batches.put(None)
+		self.thread.join()
+
+
+# turns the list of field names into a tuple of functions that each take an object and return the value for that field,
+# so the field names only have to be checked once instead of for every row
+def get_extractors(fields):
+	# the objects are mostly in order, so remember the last minute formatted and reuse it until the minute changes
+	last_minute = None
+	last_created = None
+
+	def get_created(obj):
+		nonlocal last_minute, last_created
+		minute = int(obj['created_utc']) // 60
+		if minute != last_minute:
+			last_created = datetime.fromtimestamp(minute * 60).strftime("%Y-%m-%d %H:%M")
+			last_minute = minute
+		return last_created
+
+	def get_link(obj):
+		if 'permalink' in obj:
+			return f"https://www.reddit.com{obj['permalink']}"
+		else:
+			return f"https://www.reddit.com/r/{obj['subreddit']}/comments/{obj['link_id'][3:]}/_/{obj['id']}/"
+
+	def get_author(obj):
+		return f"u/{obj['author']}"
+
+	def get_text(obj):
+		if 'selftext' in obj:
+			return str(obj['selftext'])#[:32000] # remove first # if the subreddit has very large text posts and you want to open this in excel
+		else:
+			return ""
+
+	def get_field(field):
+		return lambda obj: str(obj[field])
+
+	extractors = []
+	for field in fields:
+		if field == "created":
+			extractors.append(get_created)
+		elif field == "link":
+			extractors.append(get_link)
+		elif field == "author":
+			extractors.append(get_author)
+		elif field == "text":
+			extractors.append(get_text)
+		else:
+			extractors.append(get_field(field))
+	return tuple(extractors)
+
+
 if __name__ == "__main__":
 	if len(sys.argv) >= 3:
 		input_file_path = sys.argv[1]
@@ -74,41 +172,24 @@ if __name__ == "__main__":
 	file_size = os.stat(input_file_path).st_size
 	file_lines, bad_lines = 0, 0
 	line, created = None, None
-	output_file = open(output_file_path, "w", encoding='utf-8', newline="")
+	extractors = get_extractors(fields)
+	# errors='replace' writes a ? for any characters that can't be written in utf-8, like a broken emoji
+	output_file = open(output_file_path, "w", encoding='utf-8', errors='replace', newline="")
 	writer = csv.writer(output_file)
 	writer.writerow(fields)
+	batch_writer = CsvBatchWriter(writer)
 	try:
 		for line, file_bytes_processed in read_lines_zst(input_file_path):
 			try:
 				obj = json.loads(line)
-				output_obj = []
-				for field in fields:
-					if field == "created":
-						value = datetime.fromtimestamp(int(obj['created_utc'])).strftime("%Y-%m-%d %H:%M")
-					elif field == "link":
-						if 'permalink' in obj:
-							value = f"https://www.reddit.com{obj['permalink']}"
-						else:
-							value = f"https://www.reddit.com/r/{obj['subreddit']}/comments/{obj['link_id'][3:]}/_/{obj['id']}/"
-					elif field == "author":
-						value = f"u/{obj['author']}"
-					elif field == "text":
-						if 'selftext' in obj:
-							value = obj['selftext']#[:32000] # remove first # if the subreddit has very large text posts and you want to open this in excel
-						else:
-							value = ""
-					else:
-						value = obj[field]
-
-					output_obj.append(str(value).encode("utf-8", errors='replace').decode())
-				writer.writerow(output_obj)
-
-				created = datetime.utcfromtimestamp(int(obj['created_utc']))
+				batch_writer.writerow([extract(obj) for extract in extractors])
+
+				created = obj['created_utc']
 			except json.JSONDecodeError as err:
 				bad_lines += 1
 			file_lines += 1
 			if file_lines % 100000 == 0:
-				log.info(f"{created.strftime('%Y-%m-%d %H:%M:%S')} : {file_lines:,} : {bad_lines:,} : {(file_bytes_processed / file_size) * 100:.0f}%")
+				log.info(f"{datetime.utcfromtimestamp(int(created)).strftime('%Y-%m-%d %H:%M:%S')} : {file_lines:,} : {bad_lines:,} : {(file_bytes_processed / file_size) * 100:.0f}%")
 	except KeyError as err:
 		log.info(f"Object has no key: {err}")
 		log.info(line)
@@ -116,6 +197,9 @@ if __name__ == "__main__":
 		log.info(err)
 		log.info(line)
 
+	try:
+		batch_writer.close()
+	except Exception as err:
+		log.info(err)
 	output_file.close()
 	log.info(f"Complete : {file_lines:,} : {bad_lines:,}")
-